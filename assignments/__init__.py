@@ -42,6 +42,10 @@ class Assignment(ABC):
     def batch_union(self, batch_indices):
         pass
 
+    @abstractmethod
+    def batch_counts(self):
+        pass
+
     @abstractmethod
     def save(self, directory='./saved_assignments/'):
         pass
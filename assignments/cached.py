@@ -5,182 +5,169 @@ approach needs a lot of memory.
 
 '''
 import os
-import uuid
 import logging
-import random
 import itertools
 import numpy as np
+import scipy as sp
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor
 from scipy.special import comb as nchoosek
 import model
 from assignments import Assignment, AssignmentError
+from assignments.labels import Labels
+from assignments.sparse import csr_elements
+
+# maximum number of elements of the dense membership matrices created when
+# building the index
+INDEX_CHUNK_SIZE = 1 << 22
 
 class SparseAssignmentError(AssignmentError):
     '''Base class for exceptions thrown by this module.'''
 
-class Perspective(object):
-    '''Representation of the count vectors from the perspective of a
-    single server
+class PerspectiveIndex(object):
+    '''Dynamic programming index storing the count vectors from the
+    perspective of every server in every set of servers that may finish the
+    map phase first.
 
     Depending on which servers first finish the map computation, a
     different set of batches will be involved in the multicast phase.
+    The rows (batches) involved in each perspective and the perspectives
+    each row is involved in are stored in compressed sparse row (CSR)
+    format, i.e., the rows of perspective p are given by
+    perspective_rows[perspective_indptr[p]:perspective_indptr[p+1]]. These
+    arrays never change and are shared between copies of the index.
 
     Attributes:
 
-    score: The number of additional rows required to decode all
-    partitions.
-
-    count: An array where count[i] is the number of symbols from
-    partition i.
-
-    '''
-    def __init__(self, score, count, rows, perspective_id=None):
-        '''Create a new Perspective object
-
-        Args:
-
-        score: The number of additional rows required to decode all partitions.
+    counts: A num_perspectives by num_partitions array, where counts[p, i]
+    is the number of symbols from partition i available to perspective p
+    minus the number needed to decode it.
 
-        count: An array where count[i] is the number of symbols from partition i.
+    scores: An array where scores[p] is the number of additional rows
+    perspective p requires to decode all partitions.
 
-        rows: TODO: Write description.
+    summary: A num_batches by num_partitions array, where summary[i, j] is
+    the number of perspectives involving row i that need more symbols from
+    partition j.
 
-        perspective_id: A unique ID for this instance. If None, one is
-        generated.
-
-        '''
-        self.score = score
-        self.count = count
-        self.rows = rows
-
-        # Generate a new ID if none was provided
-        if isinstance(perspective_id, uuid.UUID):
-            self.perspective_id = perspective_id
-        else:
-            self.perspective_id = uuid.uuid4()
-
-    def __str__(self):
-        string = 'Score: ' + str(self.score)
-        string += ' Count: ' + str(self.count)
-        string += ' Rows: ' + str(self.rows)
-        return string
-
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.rows == other.rows
-        return False
+    '''
 
-    def __hash__(self):
-        return hash(self.perspective_id)
+    def __init__(self, counts, scores, summary, perspective_indptr,
+                 perspective_rows, row_indptr, row_perspectives):
+        self.counts = counts
+        self.scores = scores
+        self.summary = summary
+        self.perspective_indptr = perspective_indptr
+        self.perspective_rows = perspective_rows
+        self.row_indptr = row_indptr
+        self.row_perspectives = row_perspectives
+        return
 
-    def increment(self, cols, values):
-        '''Increment the column and update the indices.
+    @classmethod
+    def from_perspectives(cls, par, counts, perspective_indptr, perspective_rows):
+        '''Create an index from the count vectors and rows of all
+        perspectives.
 
         Args:
 
-        cols: List of columns indices to increment.
-
-        values: Values to increment by.
-
-        Returns: A new Perspective instance with the updated values.
-
-        '''
-
-        # Copy the count array
-        count = np.array(self.count)
-
-        # Increment the indicated column and update the score
-        count[cols] += values
-        score = remaining_unicasts(count)
-
-        # Return a new instance with the updated values
-        return Perspective(score, count, self.rows, perspective_id=self.perspective_id)
-
-    def decrement(self, cols, values):
-        '''Decrement the column and update the indices.
-
-        Args:
+        par: System parameters.
 
-        cols: List of columns indices to decrement.
+        counts: A num_perspectives by num_partitions array of count vectors.
 
-        values: Values to decrement by.
+        perspective_indptr, perspective_rows: CSR structure, where the rows
+        involved in perspective p are
+        perspective_rows[perspective_indptr[p]:perspective_indptr[p+1]].
 
-        Returns: A new Perspective instance with the updated values.
+        Returns: The index.
 
         '''
-        return self.increment(cols, [-value for value in values])
-
-        # # Copy the count array
-        # count = np.array(self.count)
-
-        # # Increment the indicated column and calculate the updated score
-        # count[col] -= 1
-        # score = remaining_unicasts(count)
-
-        # # Return a new instance with the updated values
-        # return Perspective(score, count, self.rows, perspective_id=self.perspective_id)
-
-class BatchResult(object):
-    '''The results index from the perspective of a row of the assignment
-    matrix
-
-    '''
-
-    def __init__(self, perspectives=None, summary=None):
-        if perspectives is None or summary is None:
-            self.perspectives = dict()
-        else:
-            assert isinstance(perspectives, dict)
-            assert isinstance(summary, np.ndarray)
-            self.perspectives = perspectives
-            self.summary = summary
-
-        return
-
-    def __getitem__(self, key):
-        if not isinstance(key, Perspective):
-            raise TypeError('Key must be of type perspective')
+        counts = np.asarray(counts)
+        perspective_indptr = np.asarray(perspective_indptr, dtype=np.int64)
+        perspective_rows = np.asarray(perspective_rows, dtype=np.int64)
+        lengths = np.diff(perspective_indptr)
+
+        # invert the mapping to get the perspectives involving each row
+        owners = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        row_perspectives = owners[np.argsort(perspective_rows, kind='stable')]
+        row_indptr = np.zeros(par.num_batches + 1, dtype=np.int64)
+        row_indptr[1:] = np.cumsum(np.bincount(perspective_rows, minlength=par.num_batches))
+
+        # the summary initially counts all perspectives involving each row
+        summary = np.repeat(np.diff(row_indptr)[:, None], par.num_partitions, axis=1)
+        return cls(
+            counts,
+            remaining_unicasts(counts),
+            summary.astype(np.int32),
+            perspective_indptr,
+            perspective_rows,
+            row_indptr,
+            row_perspectives,
+        )
 
-        return self.perspectives[key]
+    def score(self):
+        '''Return the sum of the scores of all perspectives.'''
+        return self.scores.sum().item()
 
-    def __setitem__(self, key, value):
-        if not isinstance(key, Perspective) or not isinstance(value, Perspective):
-            raise TypeError('Key and value must be of type perspective')
+    def copy(self):
+        '''Return a copy of the index. The CSR arrays are shared.'''
+        return PerspectiveIndex(
+            np.array(self.counts),
+            np.array(self.scores),
+            np.array(self.summary),
+            self.perspective_indptr,
+            self.perspective_rows,
+            self.row_indptr,
+            self.row_perspectives,
+        )
 
-        self.perspectives[key] = value
+    def apply(self, row, col, value):
+        '''Add value to column col of the count vectors of all perspectives
+        involving row. The index is updated in place.
 
-    def __delitem__(self, key):
-        if not isinstance(key, Perspective):
-            raise TypeError('Key must be of type perspective')
+        Args:
 
-        del self.perspectives[key]
+        row: Row index.
 
-    def __contains__(self, key):
-        if not isinstance(key, Perspective):
-            raise TypeError('Key must be of type perspective')
+        col: Column index.
 
-        return key in self.perspectives
+        value: Value to add.
 
-    def init_summary(self, par):
-        '''Build a summary of the number of perspectives that need symbols
-        from a certain partition.
+        Returns: A tuple (score_change, log), where score_change is the
+        change of the overall score and log is passed to undo() to revert
+        the update.
 
         '''
-
-        num_perspectives = len(self.perspectives)
-
-        # Build a simple summary that keeps track of how many symbols
-        # that need a certain partition.
-        self.summary = np.asarray([num_perspectives] * par.num_partitions, dtype=np.int16)
-
-    def keys(self):
-        '''Return the keys of the perspectives dict.'''
-        return self.perspectives.keys()
-
-    def copy(self):
-        '''Returns a copy of itself'''
-        perspectives = dict(self.perspectives)
-        summary = np.array(self.summary)
-        return BatchResult(perspectives, summary)
+        perspectives = self.row_perspectives[self.row_indptr[row]:self.row_indptr[row+1]]
+        old_counts = self.counts[perspectives, col]
+        new_counts = old_counts + value
+        self.counts[perspectives, col] = new_counts
+
+        old_scores = self.scores[perspectives]
+        new_scores = old_scores + np.minimum(old_counts, 0) - np.minimum(new_counts, 0)
+        self.scores[perspectives] = new_scores
+
+        # Update the summaries of the rows of perspectives for which the
+        # partition became saturated (or stopped being saturated).
+        changed = (new_counts < 0).astype(np.int32) - (old_counts < 0)
+        changed_perspectives = changed.nonzero()[0]
+        elements, lengths = csr_elements(
+            self.perspective_indptr,
+            perspectives[changed_perspectives],
+        )
+        rows = self.perspective_rows[elements]
+        deltas = np.repeat(changed[changed_perspectives], lengths)
+        np.add.at(self.summary[:, col], rows, deltas)
+
+        score_change = (new_scores.sum() - old_scores.sum()).item()
+        return score_change, (perspectives, col, old_counts, old_scores, rows, deltas)
+
+    def undo(self, log):
+        '''Revert an update made by apply().'''
+        perspectives, col, old_counts, old_scores, rows, deltas = log
+        self.counts[perspectives, col] = old_counts
+        self.scores[perspectives] = old_scores
+        np.add.at(self.summary[:, col], rows, -deltas)
+        return
 
 class CachedAssignment(Assignment):
     '''Cached storage design representation
@@ -200,8 +187,8 @@ class CachedAssignment(Assignment):
     gamma: Number of coded rows for each partition stored in all
     batches.
 
-    labels: List of sets, where the elements of the set labels[i] are
-    the rows of the assignment_matrix stored at server i.
+    labels: Labels object, where labels[i] is the set of rows of the
+    assignment_matrix stored at server i.
 
     score: The sum of all unicasts that need to be sent until all
     partitions can be decoded over all subsets that can complete the
@@ -209,10 +196,9 @@ class CachedAssignment(Assignment):
     be built from scratch. Set both to False to prevent the index from
     being built.
 
-    index: A list of BatchResult of length equal to the number of
-    batches. If either score or index is set to None, the index will
-    be built from scratch. Set both to False to prevent the index from
-    being built.
+    index: A PerspectiveIndex. If either score or index is set to None,
+    the index will be built from scratch. Set both to False to prevent
+    the index from being built.
 
     '''
     def __init__(self, par, gamma=0, assignment_matrix=None, labels=None, score=None, index=None):
@@ -227,8 +213,9 @@ class CachedAssignment(Assignment):
             self.assignment_matrix = assignment_matrix
 
         if labels is None:
-            self.labels = [set() for x in range(par.num_servers)]
             self.label()
+        elif isinstance(labels, list):
+            self.labels = Labels.from_sets(labels, par.num_batches)
         else:
             self.labels = labels
 
@@ -288,6 +275,14 @@ class CachedAssignment(Assignment):
         symbols += self.gamma * len(row_indices)
         return symbols
 
+    def batch_counts(self):
+        '''Return a dense num_batches by num_partitions Numpy array, where
+        element [i, j] is the number of rows from partition j stored in
+        batch i, including gamma.
+
+        '''
+        return self.assignment_matrix + self.gamma
+
     def rows_iterator(self):
         '''Iterate over the rows of the assignment matrix.'''
         for row in self.assignment_matrix:
@@ -343,52 +338,80 @@ class CachedAssignment(Assignment):
         return cls(parameters, gamma=int(gamma), assignment_matrix=assignment_matrix,
                    score=False, index=False)
 
-    def build_index(self):
+    def build_index(self, workers=1):
         '''Build the dynamic programming index
 
         Build an index pairing rows of the assignment matrix to which
         perspectives they appear in. Only run once when creating a new
         assignment.
 
-        '''
-        self.score = 0
+        A row is involved in the perspective of server k in the set of
+        servers Q if it's stored at k, or if it's stored at at least
+        multicast_set_size_1 of the other servers in Q. The rows of all
+        perspectives are found from the server/row incidence matrix, and the
+        count vectors are computed as a single sparse matrix product.
 
-        # Index for which sets every row is contained in
-        self.index = [BatchResult(self.par) for _ in range(self.par.num_batches)]
+        Args:
+
+        workers: Number of threads to split the sets of servers between.
+
+        '''
+        assert isinstance(workers, int) and workers > 0
         self.num_subsets = nchoosek(self.par.num_servers, self.par.q, exact=True)
-        subsets = itertools.combinations(range(self.par.num_servers), self.par.q)
-
-        # Build an index for which count vectors every row is part of
-        for Q in subsets:
-            for k in Q:
-                rows = set()
-                for batch in self.labels[k]:
-                    rows.add(batch)
-
-                for j in range(self.par.multicast_set_size_1(), int(self.par.server_storage*self.par.q) + 1):
-                    for subset in itertools.combinations([x for x in Q if x != k], j):
-                        rows = rows | set.intersection(*[self.labels[x] for x in subset])
-
-                selector_vector = np.zeros(self.par.num_batches)
-                for row in rows:
-                    selector_vector[row] = 1
-
-                count_vector = np.dot(selector_vector, self.assignment_matrix)
-                count_vector -= self.par.num_source_rows / self.par.num_partitions
-                #print(count_vector, count_vector + self.gamma*len(rows))
-                count_vector += self.gamma * len(rows)
-                #print(count_vector)
-                score = remaining_unicasts(count_vector)
-                self.score = self.score + score
-
-                perspective = Perspective(score, count_vector, rows)
-                for row in rows:
-                    assert perspective not in self.index[row]
-                    self.index[row][perspective] = perspective
-
-        # Initialize the summaries
-        for batch_result in self.index:
-            batch_result.init_summary(self.par)
+        subsets = np.array(
+            list(itertools.combinations(range(self.par.num_servers), self.par.q)),
+            dtype=np.int64,
+        ).reshape(self.num_subsets, self.par.q)
+
+        # Counts are integer unless the number of rows per partition isn't.
+        rows_per_partition = self.par.num_source_rows / self.par.num_partitions
+        if rows_per_partition % 1 == 0:
+            rows_per_partition = int(rows_per_partition)
+            dtype = np.int64
+        else:
+            dtype = float
+
+        # incidence[k, i] is 1 if row i is stored at server k
+        incidence = self.labels.incidence.astype(np.int64)
+
+        # Rows stored at this many of the other servers are multicasted.
+        multicast_set_size = self.par.multicast_set_size_1()
+        if multicast_set_size > int(self.par.server_storage*self.par.q):
+            multicast_set_size = self.par.num_servers + 1
+
+        def membership(subsets):
+            '''Return the rows of the perspectives of a chunk of subsets as a
+            sparse matrix.'''
+            own = incidence[subsets]
+            others = own.sum(axis=1)[:, None, :] - own
+            member = (own > 0) | (others >= multicast_set_size)
+            return sp.sparse.csr_matrix(
+                member.reshape(-1, self.par.num_batches),
+                dtype=np.int64,
+            )
+
+        # Process the subsets in chunks to bound the memory needed.
+        chunk_size = max(1, INDEX_CHUNK_SIZE // (self.par.q * self.par.num_batches))
+        chunks = [subsets[i:i+chunk_size] for i in range(0, len(subsets), chunk_size)]
+        if workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                matrices = list(executor.map(membership, chunks))
+        else:
+            matrices = [membership(chunk) for chunk in chunks]
+        member = sp.sparse.vstack(matrices, format='csr')
+
+        lengths = np.diff(member.indptr)
+        counts = np.asarray(member @ self.assignment_matrix.astype(np.int64), dtype=dtype)
+        counts += (self.gamma * lengths - rows_per_partition)[:, None]
+
+        self.index = PerspectiveIndex.from_perspectives(
+            self.par,
+            counts,
+            member.indptr,
+            member.indices,
+        )
+        self.score = self.index.score()
+        return
 
     def label(self, shuffle=False):
         '''Label the batches with server subsets
@@ -400,30 +423,23 @@ class CachedAssignment(Assignment):
 
         '''
         assert self.par.server_storage * self.par.q % 1 == 0, 'Must be integer'
-        labels = list(itertools.combinations(range(self.par.num_servers),
-                                             int(self.par.server_storage * self.par.q)))
-        if shuffle:
-            random.shuffle(labels)
-
-        row = 0
-        for label in labels:
-            for server in label:
-                self.labels[server].add(row)
-            row += 1
+        self.labels, _ = Labels.from_combinations(
+            self.par.num_servers,
+            int(self.par.server_storage * self.par.q),
+            shuffle=shuffle,
+        )
         return
 
     def bound(self):
         '''Compute a bound for this assignment'''
         assert self.index and self.score, 'Cannot compute bound if there is no index.'
-        decreased_unicasts = 0
-        for row_index in range(self.assignment_matrix.shape[0]):
-            row = self.assignment_matrix[row_index] + self.gamma
-            remaining_assignments = self.par.rows_per_batch - sum(row)
-            assert remaining_assignments >= 0, remaining_assignments
-            decreased_unicasts += self.index[row_index].summary.max() * remaining_assignments
+        remaining_assignments = self.par.rows_per_batch
+        remaining_assignments -= self.assignment_matrix.sum(axis=1) + self.gamma * self.par.num_partitions
+        assert remaining_assignments.min() >= 0, remaining_assignments.min()
+        decreased_unicasts = np.dot(self.index.summary.max(axis=1), remaining_assignments)
 
         # Bound can't be less than 0
-        return max(self.score - decreased_unicasts, 0)
+        return max(self.score - decreased_unicasts.item(), 0)
 
     def increment(self, row_indices, col_indices, values):
         '''Increment assignment_matrix[row_indices[i], col_indices[i]] by
@@ -445,72 +461,9 @@ class CachedAssignment(Assignment):
         assert isinstance(values, list)
         assert len(row_indices) == len(col_indices)
         assert len(col_indices) == len(values)
-
-        # Copy dynamic programming index
-        index = [x.copy() for x in self.index]
-
-        # Copy assignment matrix and objective value
-        assignment_matrix = np.array(self.assignment_matrix)
-        objective_value = self.score
-
-        # Preprocess indices to eliminate duplicates
-        rows = dict()
-        for row, col, value in zip(row_indices, col_indices, values):
-            if row in rows:
-                cols = rows[row]
-            else:
-                cols = dict()
-                rows[row] = cols
-
-            if col in cols:
-                cols[col] += value
-            else:
-                cols[col] = value
-
-        # Increment
-        for row, cols in rows.items():
-            for col, value in cols.items():
-                assignment_matrix[row, col] += value
-
-        # Update the index
-        for row in rows:
-
-            # Select the perspectives linked to each row
-            perspectives = index[row]
-
-            # Iterate over all perspectives linked to that row
-            for perspective_key in perspectives.keys():
-                perspective = perspectives[perspective_key]
-
-                # Create a new perspective from the updated values
-                # cols, values = rows[row].items()
-                cols = list(rows[row].keys())
-                values = list(rows[row].values())
-                new_perspective = perspective.increment(cols, values)
-
-                # Update the objective function
-                objective_value = objective_value - (perspective.score - new_perspective.score)
-
-                # Update the index for all rows which include this perspective
-                for perspective_row in perspective.rows:
-                    index[perspective_row][perspective] = new_perspective
-
-                # Find partitions that have saturated by checking the sign
-                changed = np.zeros(self.par.num_partitions, dtype=np.int16)
-                changed -= (perspective.count < 0) * (new_perspective.count >= 0)
-                changed += (perspective.count >= 0) * (new_perspective.count < 0)
-
-                # Update summaries if count reached zero for the
-                # indicated column
-                for perspective_row in new_perspective.rows:
-                    index[perspective_row].summary += changed
-
-        # Return a new assignment object
-        return CachedAssignment(self.par, gamma=self.gamma,
-                                assignment_matrix=assignment_matrix,
-                                labels=self.labels,
-                                score=objective_value,
-                                index=index)
+        assignment = self.copy()
+        assignment.apply(row_indices, col_indices, values)
+        return assignment
 
     def decrement(self, rows, cols, values):
         '''Decrement assignment_matrix[rows[i], cols[i]] by values[i] for all i.
@@ -533,6 +486,53 @@ class CachedAssignment(Assignment):
         assert len(cols) == len(values)
         return self.increment(rows, cols, [-value for value in values])
 
+    def apply(self, row_indices, col_indices, values):
+        '''Increment assignment_matrix[row_indices[i], col_indices[i]] by
+        values[i] for all i in place. The index is updated in time
+        proportional to the number of perspectives involving the rows.
+
+        Args:
+
+        row_indices: List of row indices
+
+        col_indices: List of column indices
+
+        values: List of values to increment by
+
+        Returns: An undo log. Pass it to undo() to revert the change.
+
+        '''
+        assert len(row_indices) == len(col_indices)
+        assert len(col_indices) == len(values)
+
+        # Preprocess indices to eliminate duplicates
+        increments = dict()
+        for row, col, value in zip(row_indices, col_indices, values):
+            increments[(row, col)] = increments.get((row, col), 0) + value
+
+        log = list()
+        for (row, col), value in increments.items():
+            self.assignment_matrix[row, col] += value
+            if self.index:
+                score_change, index_log = self.index.apply(row, col, value)
+                self.score += score_change
+            else:
+                score_change, index_log = 0, None
+            log.append((row, col, value, score_change, index_log))
+        return log
+
+    def undo(self, log):
+        '''Revert a change made by apply(). Changes must be reverted in
+        the reverse order they were made in.
+
+        '''
+        for row, col, value, score_change, index_log in reversed(log):
+            self.assignment_matrix[row, col] -= value
+            if index_log is not None:
+                self.index.undo(index_log)
+                self.score -= score_change
+        return
+
     def evaluate(self, row, col):
         '''Return the performance change that incrementing (row, col) would
         induce without changing the assignment.
@@ -540,14 +540,14 @@ class CachedAssignment(Assignment):
         '''
 
         assert self.index and self.score, 'Cannot evaluate if there is no index.'
-        return self.index[row].summary[col]
+        return self.index.summary[row, col]
 
     def copy(self):
         '''Return a deep copy of the assignment.'''
 
         assignment_matrix = np.array(self.assignment_matrix)
         if self.index:
-            index = [x.copy() for x in self.index]
+            index = self.index.copy()
             score = self.score
         else:
             index = False
@@ -594,15 +594,11 @@ def remaining_unicasts(rows_by_partition):
 
     Args:
 
-    rows_by_partition: A numpy array of row counts by partition.
+    rows_by_partition: A numpy array of row counts by partition. If the
+    array has several dimensions, the last axis is taken to be the
+    partitions.
 
     Returns: The number of unicasts required to decode all partitions.
 
     '''
-
-    unicasts = 0
-    for num_rows in rows_by_partition:
-        if num_rows < 0:
-            unicasts -= num_rows
-
-    return unicasts
+    return -np.minimum(rows_by_partition, 0).sum(axis=-1)
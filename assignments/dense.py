@@ -4,11 +4,10 @@ smaller systems.
 '''
 import os
 import logging
-import random
-import itertools
 import numpy as np
 import model
 from assignments import Assignment
+from assignments.labels import Labels
 
 class DenseAssignment(Assignment):
     '''Dense storage design representation
@@ -22,8 +21,8 @@ class DenseAssignment(Assignment):
     where assignment_matrix[i, j] is the number of rows from partition
     j stored in batch i.
 
-    labels: List of sets, where the elements of the set labels[i] are
-    the rows of the assignment_matrix stored at server i.
+    labels: Labels object, where labels[i] is the set of rows of the
+    assignment_matrix stored at server i.
 
     '''
 
@@ -36,21 +35,22 @@ class DenseAssignment(Assignment):
         gamma: Number of coded rows for each partition stored in all
         batches.
 
-        labels: List of sets, where the elements of the set labels[i]
-        are the rows of the assignment_matrix stored at server i. A
-        new one is generated in this is None.
+        labels: Labels object or list of sets, where labels[i] is the
+        set of rows of the assignment_matrix stored at server i. A new
+        one is generated in this is None.
 
         '''
         assert isinstance(par, model.SystemParameters)
         assert isinstance(gamma, int)
-        assert isinstance(labels, list) or labels is None
+        assert isinstance(labels, (list, Labels)) or labels is None
 
         self.par = par
         self.gamma = gamma
         self.assignment_matrix = np.zeros((par.num_batches, par.num_partitions)) + gamma
         if labels is None:
-            self.labels = [set() for x in range(par.num_servers)]
             self.label()
+        elif isinstance(labels, list):
+            self.labels = Labels.from_sets(labels, par.num_batches)
         else:
             self.labels = labels
 
@@ -82,6 +82,14 @@ class DenseAssignment(Assignment):
 
         return symbols
 
+    def batch_counts(self):
+        '''Return a dense num_batches by num_partitions Numpy array, where
+        element [i, j] is the number of rows from partition j stored in
+        batch i. gamma is already included in the assignment matrix.
+
+        '''
+        return np.array(self.assignment_matrix)
+
     def save(self, directory='./saved_assignments/'):
         """ Save the assignment to disk
 
@@ -125,16 +133,11 @@ class DenseAssignment(Assignment):
 
         '''
         assert self.par.server_storage * self.par.q % 1 == 0, 'Must be integer'
-        labels = list(itertools.combinations(range(self.par.num_servers),
-                                             int(self.par.server_storage * self.par.q)))
-        if shuffle:
-            random.shuffle(labels)
-
-        row = 0
-        for label in labels:
-            for server in label:
-                self.labels[server].add(row)
-            row += 1
+        self.labels, _ = Labels.from_combinations(
+            self.par.num_servers,
+            int(self.par.server_storage * self.par.q),
+            shuffle=shuffle,
+        )
         return
 
     def increment(self, rows, cols, data):
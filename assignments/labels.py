@@ -0,0 +1,169 @@
+############################################################################
+# Copyright 2016 Albin Severinson                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+'''Server labels, i.e., which batches are stored at which server. The labels
+are stored as a num_servers by num_batches boolean incidence matrix, meaning
+that unions, intersections and multicast counts over a set of servers are
+computed with vectorized operations on its rows rather than with Python sets.
+
+'''
+
+import itertools
+import random
+import numpy as np
+
+class Labels(object):
+    '''Batches stored at each server. Behaves like the list of sets
+    previously used to represent labels, i.e., labels[i] is the set of
+    batches stored at server i.
+
+    Attributes:
+
+    incidence: A num_servers by num_batches boolean Numpy array, where
+    element [i, j] is True if batch j is stored at server i.
+
+    '''
+
+    def __init__(self, incidence):
+        '''Create labels from an incidence matrix.
+
+        Args:
+
+        incidence: A num_servers by num_batches boolean Numpy array, where
+        element [i, j] is True if batch j is stored at server i.
+
+        '''
+        incidence = np.asarray(incidence, dtype=bool)
+        assert incidence.ndim == 2, incidence.shape
+        self.incidence = incidence
+        return
+
+    @classmethod
+    def from_batch_labels(cls, num_servers, batch_labels):
+        '''Create labels from the server subset of each batch.
+
+        Args:
+
+        num_servers: Total number of servers.
+
+        batch_labels: List where element i is the tuple of servers that
+        batch i is stored at. All tuples must be of equal length.
+
+        '''
+        servers = np.asarray(batch_labels, dtype=np.int64).reshape(len(batch_labels), -1)
+        incidence = np.zeros((num_servers, len(batch_labels)), dtype=bool)
+        incidence[servers, np.arange(len(batch_labels))[:, None]] = True
+        return cls(incidence)
+
+    @classmethod
+    def from_combinations(cls, num_servers, servers_per_batch, shuffle=False):
+        '''Label the batches with all subsets of servers_per_batch servers.
+
+        Args:
+
+        num_servers: Total number of servers.
+
+        servers_per_batch: Number of servers that each batch is stored at.
+
+        shuffle: Shuffle the labeling if True. Otherwise label in the
+        order returned by itertools.combinations.
+
+        Returns: A tuple (labels, batch_labels), where batch_labels is the
+        list of server subsets in the order they were assigned to batches.
+
+        '''
+        batch_labels = list(itertools.combinations(range(num_servers), int(servers_per_batch)))
+        if shuffle:
+            random.shuffle(batch_labels)
+        return cls.from_batch_labels(num_servers, batch_labels), batch_labels
+
+    @classmethod
+    def from_sets(cls, sets, num_batches=None):
+        '''Create labels from a list of sets, where sets[i] is the set of
+        batches stored at server i. The number of batches is inferred from
+        the largest index if num_batches is None.
+
+        '''
+        if num_batches is None:
+            num_batches = max((max(batches) + 1 for batches in sets if batches), default=0)
+        incidence = np.zeros((len(sets), num_batches), dtype=bool)
+        for server, batches in enumerate(sets):
+            incidence[server, list(batches)] = True
+        return cls(incidence)
+
+    @property
+    def num_servers(self):
+        return self.incidence.shape[0]
+
+    @property
+    def num_batches(self):
+        return self.incidence.shape[1]
+
+    def __len__(self):
+        return self.num_servers
+
+    def __getitem__(self, server):
+        '''Return the set of batches stored at a server. The set is a copy,
+        so changing it doesn't change the labels. Use add() instead.
+
+        '''
+        if not -self.num_servers <= server < self.num_servers:
+            raise IndexError('server index out of range')
+        return set(np.flatnonzero(self.incidence[server]).tolist())
+
+    def __iter__(self):
+        for server in range(self.num_servers):
+            yield self[server]
+
+    def __eq__(self, other):
+        if isinstance(other, Labels):
+            return np.array_equal(self.incidence, other.incidence)
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return str(list(self))
+
+    def add(self, server, batch):
+        '''Store a batch at a server.'''
+        self.incidence[server, batch] = True
+        return
+
+    def union(self, servers):
+        '''Return a boolean vector of length num_batches indicating the
+        batches stored at any of the servers.'''
+        return self.incidence[list(servers)].any(axis=0)
+
+    def intersection(self, servers):
+        '''Return a boolean vector of length num_batches indicating the
+        batches stored at all of the servers.'''
+        return self.incidence[list(servers)].all(axis=0)
+
+    def count(self, servers):
+        '''Return a vector of length num_batches with the number of servers
+        among servers that store each batch.'''
+        return self.incidence[list(servers)].sum(axis=0, dtype=np.int64)
+
+    def popcount(self):
+        '''Return a vector of length num_servers with the number of batches
+        stored at each server.'''
+        return self.incidence.sum(axis=1, dtype=np.int64)
+
+    def batches(self, vector):
+        '''Convert a boolean batch vector returned by the other methods into a
+        set of batch indices.'''
+        return set(np.flatnonzero(vector).tolist())
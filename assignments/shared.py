@@ -0,0 +1,234 @@
+############################################################################
+# Copyright 2016 Albin Severinson                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+'''This assignment is a read-only view of another assignment stored in
+shared memory. It's used to give worker processes access to an assignment
+without giving each of them a separate copy.
+
+The assignment matrix is stored in compressed sparse row (CSR) format and the
+labels as the boolean server-to-batch incidence matrix wrapped by a Labels
+object. All arrays are stored in a single shared memory block. Pickling a
+SharedAssignment only pickles the layout of this block, and unpickling it
+attaches to the block.
+
+'''
+
+import logging
+import numpy as np
+import scipy as sp
+import scipy.sparse
+import model
+
+from multiprocessing import shared_memory
+from assignments import Assignment, AssignmentError
+from assignments.labels import Labels
+from assignments.sparse import csr_row_sum
+
+class SharedAssignmentError(AssignmentError):
+    '''Base class for exceptions thrown by this module.'''
+
+class SharedAssignment(Assignment):
+    '''Read-only assignment backed by shared memory.
+
+    Attributes:
+
+    par: System parameters.
+
+    gamma: Number of coded rows for each partition stored in all
+    batches.
+
+    labels: Read-only Labels object, where labels[i] is the set of rows
+    of the assignment matrix stored at server i.
+
+    '''
+
+    # arrays stored in the shared memory block
+    ARRAYS = ['indptr', 'indices', 'data', 'incidence']
+
+    def __init__(self, par, gamma, shm, layout, owner=False):
+        '''Create a view of an assignment stored in shared memory. Use
+        SharedAssignment.share() to export an assignment.
+
+        Args:
+
+        par: System parameters.
+
+        gamma: Number of coded rows for each partition stored in all
+        batches.
+
+        shm: multiprocessing.shared_memory.SharedMemory block.
+
+        layout: Dict mapping array names to tuples (dtype, shape, offset).
+
+        owner: True if this object is responsible for unlinking the block.
+
+        '''
+        assert isinstance(par, model.SystemParameters)
+        self.par = par
+        self.gamma = gamma
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        for name, (dtype, shape, offset) in layout.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            setattr(self, name, array)
+
+        self.labels = Labels(self.incidence)
+        return
+
+    @classmethod
+    def share(cls, assignment):
+        '''Copy an assignment into a new shared memory block.
+
+        Args:
+
+        assignment: Assignment to share.
+
+        Returns: A SharedAssignment owning the shared memory block. Call
+        unlink() to free the block once it's no longer needed.
+
+        '''
+        par = assignment.par
+        if sp.sparse.issparse(assignment.assignment_matrix):
+            matrix = sp.sparse.csr_matrix(assignment.assignment_matrix, dtype=np.int32)
+        else:
+            matrix = sp.sparse.csr_matrix(
+                np.asarray(assignment.batch_counts()) - assignment.gamma,
+                dtype=np.int32,
+            )
+        matrix.eliminate_zeros()
+        labels = assignment.labels
+        if not isinstance(labels, Labels):
+            labels = Labels.from_sets(list(labels), par.num_batches)
+        arrays = {
+            'indptr': matrix.indptr.astype(np.int32),
+            'indices': matrix.indices.astype(np.int32),
+            'data': matrix.data.astype(np.int32),
+            'incidence': labels.incidence,
+        }
+
+        # Place the arrays after each other in a single block.
+        layout = dict()
+        size = 0
+        for name in cls.ARRAYS:
+            array = arrays[name]
+            layout[name] = (array.dtype.str, array.shape, size)
+            size += array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name in cls.ARRAYS:
+            dtype, shape, offset = layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[:] = arrays[name]
+
+        logging.debug('Shared assignment of %d bytes in block %s.', size, shm.name)
+        return cls(par, assignment.gamma, shm, layout, owner=True)
+
+    @classmethod
+    def attach(cls, par, gamma, name, layout):
+        '''Attach to an assignment shared by another process.'''
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(par, gamma, shm, layout)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''Close this process' mapping of the shared memory block. The
+        assignment can't be used afterwards. Called automatically when the
+        object is garbage collected.
+
+        '''
+        # Release the views of the block before the block itself is closed.
+        for name in self.layout:
+            self.__dict__.pop(name, None)
+        self.__dict__.pop('labels', None)
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views of the block are still referenced elsewhere. The mapping
+            # is closed once they're garbage collected.
+            logging.debug('Shared memory block %s is still in use.', self.shm.name)
+        return
+
+    def __reduce__(self):
+        return (self.__class__.attach, (self.par, self.gamma, self.shm.name, self.layout))
+
+    def unlink(self):
+        '''Free the shared memory block and close the mapping of this
+        process. Only the process that shared the assignment may call this
+        method.
+
+        '''
+        if not self.owner:
+            raise SharedAssignmentError('Only the owner may unlink the shared memory.')
+        self.shm.unlink()
+        self.close()
+        return
+
+    def __repr__(self):
+        string = ''
+        string += 'shared memory block: ' + self.shm.name + '\n'
+        string += 'gamma:\n'
+        string += str(self.gamma) + '\n'
+        string += 'labels:\n'
+        string += str(self.labels) + '\n'
+        return string
+
+    def batch_union(self, batch_indices):
+        '''Compute the union of symbols stored in a set of batches.
+
+        Args:
+        batch_indices: Iterable of batch indices.
+
+        Returns: A dense Numpy array containing the counts of symbols
+        stored in a union of batches.
+
+        '''
+        rows = np.fromiter(batch_indices, dtype=np.int64)
+        symbols = csr_row_sum(
+            self.indptr,
+            self.indices,
+            self.data,
+            rows,
+            self.par.num_partitions,
+        )
+        symbols += self.gamma * len(rows)
+        return symbols
+
+    def batch_counts(self):
+        '''Return a dense num_batches by num_partitions Numpy array, where
+        element [i, j] is the number of rows from partition j stored in
+        batch i, including gamma.
+
+        '''
+        matrix = sp.sparse.csr_matrix(
+            (self.data, self.indices, self.indptr),
+            shape=(self.par.num_batches, self.par.num_partitions),
+        )
+        return matrix.toarray() + self.gamma
+
+    def increment(self, rows, cols, values):
+        raise SharedAssignmentError('Shared assignments are read-only.')
+
+    def decrement(self, rows, cols, values):
+        raise SharedAssignmentError('Shared assignments are read-only.')
+
+    def save(self, directory='./saved_assignments/'):
+        raise SharedAssignmentError('Save the original assignment instead.')
+
+    @classmethod
+    def load(cls, par, directory='./saved_assignments/'):
+        raise SharedAssignmentError('Load the original assignment instead.')
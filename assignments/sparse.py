@@ -5,16 +5,121 @@ large systems.
 
 import os
 import logging
-import random
-import itertools
 import scipy as sp
 import numpy as np
 import model
 from assignments import Assignment, AssignmentError
+from assignments.labels import Labels
 
 class SparseAssignmentError(AssignmentError):
     '''Base class for exceptions thrown by this module.'''
 
+# dtype of the assignment matrix and of the arrays used to build it
+MATRIX_DTYPE = np.int32
+
+class SparseAssignmentBuilder(object):
+    '''Collects increments of a sparse assignment matrix in preallocated
+    arrays, which are grown as needed, and materializes them into a CSR
+    matrix once. Duplicate entries are summed.
+
+    '''
+
+    def __init__(self, shape, capacity=1024):
+        self.shape = shape
+        self.size = 0
+        self.rows = np.zeros(capacity, dtype=MATRIX_DTYPE)
+        self.cols = np.zeros(capacity, dtype=MATRIX_DTYPE)
+        self.data = np.zeros(capacity, dtype=MATRIX_DTYPE)
+        return
+
+    def __len__(self):
+        return self.size
+
+    def add(self, rows, cols, data):
+        '''Increment element [rows[i], cols[i]] by data[i] for all i. Scalars
+        are broadcast.'''
+        rows, cols, data = np.broadcast_arrays(
+            np.asarray(rows, dtype=MATRIX_DTYPE),
+            np.asarray(cols, dtype=MATRIX_DTYPE),
+            np.asarray(data, dtype=MATRIX_DTYPE),
+        )
+        count = rows.size
+        if self.size + count > len(self.rows):
+            capacity = max(2 * len(self.rows), self.size + count)
+            for name in ['rows', 'cols', 'data']:
+                array = np.zeros(capacity, dtype=MATRIX_DTYPE)
+                array[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, array)
+
+        self.rows[self.size:self.size+count] = rows.reshape(-1)
+        self.cols[self.size:self.size+count] = cols.reshape(-1)
+        self.data[self.size:self.size+count] = data.reshape(-1)
+        self.size += count
+        return
+
+    def tocsr(self):
+        '''Return the collected increments as a CSR matrix.'''
+        matrix = sp.sparse.csr_matrix(
+            (self.data[:self.size], (self.rows[:self.size], self.cols[:self.size])),
+            shape=self.shape,
+            dtype=MATRIX_DTYPE,
+        )
+        matrix.sum_duplicates()
+        return matrix
+
+def csr_elements(indptr, rows):
+    '''Return the positions in the indices and data arrays of a CSR matrix of
+    all elements of the selected rows, and the number of elements of each
+    selected row.
+
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = indptr[rows]
+    lengths = indptr[rows+1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum()), lengths
+
+def csr_row_sum(indptr, indices, data, rows, num_cols):
+    '''Sum the selected rows of a CSR matrix without densifying it.
+
+    Returns: A dense Numpy array of length num_cols.
+
+    '''
+    elements, _ = csr_elements(indptr, rows)
+    return np.bincount(
+        indices[elements],
+        weights=data[elements],
+        minlength=num_cols,
+    ).astype(np.int64)
+
+def csr_row_sums(indptr, indices, data, row_sets, num_cols):
+    '''Sum each of several sets of rows of a CSR matrix without densifying
+    it.
+
+    Args:
+
+    indptr, indices, data: The CSR matrix.
+
+    row_sets: List of arrays of row indices.
+
+    num_cols: Number of columns of the matrix.
+
+    Returns: A dense len(row_sets) by num_cols Numpy array, where row i is
+    the sum of the rows in row_sets[i].
+
+    '''
+    sizes = [len(rows) for rows in row_sets]
+    rows = np.concatenate(row_sets) if row_sets else np.zeros(0, dtype=np.int64)
+    elements, lengths = csr_elements(indptr, rows)
+
+    # Offset the column of every element by the index of its set.
+    sets = np.repeat(np.repeat(np.arange(len(row_sets)), sizes), lengths)
+    return np.bincount(
+        sets * num_cols + indices[elements],
+        weights=data[elements],
+        minlength=len(row_sets) * num_cols,
+    ).astype(np.int64).reshape(len(row_sets), num_cols)
+
 class SparseAssignment(Assignment):
     '''Sparse storage design representation
 
@@ -28,8 +133,8 @@ class SparseAssignment(Assignment):
     where assignment_matrix[i, j] is the number of rows from partition
     j stored in batch i.
 
-    labels: List of sets, where the elements of the set labels[i] are
-    the rows of the assignment_matrix stored at server i.
+    labels: Labels object, where labels[i] is the set of rows of the
+    assignment_matrix stored at server i.
 
     '''
 
@@ -43,9 +148,9 @@ class SparseAssignment(Assignment):
         gamma: Number of coded rows for each partition stored in all
         batches.
 
-        labels: List of sets, where the elements of the set labels[i]
-        are the rows of the assignment_matrix stored at server i. A
-        new one is generated in this is None.
+        labels: Labels object or list of sets, where labels[i] is the
+        set of rows of the assignment_matrix stored at server i. A new
+        one is generated in this is None.
 
         assignment_marix: A sparse assignment matrix. This argument is
         used when loading an assignment from disk.
@@ -53,21 +158,22 @@ class SparseAssignment(Assignment):
         '''
         assert isinstance(par, model.SystemParameters)
         assert isinstance(gamma, int)
-        assert isinstance(labels, list) or labels is None
+        assert isinstance(labels, (list, Labels)) or labels is None
 
         self.par = par
         self.gamma = gamma
         if assignment_matrix is None:
             self.assignment_matrix = sp.sparse.coo_matrix((par.num_batches,
                                                            par.num_partitions),
-                                                          dtype=np.int16)
+                                                          dtype=MATRIX_DTYPE)
         else:
             self.assignment_matrix = assignment_matrix
 
         self.assignment_matrix_csr = None
         if labels is None:
-            self.labels = [set() for x in range(par.num_servers)]
             self.label()
+        elif isinstance(labels, list):
+            self.labels = Labels.from_sets(labels, par.num_batches)
         else:
             self.labels = labels
 
@@ -118,13 +224,27 @@ class SparseAssignment(Assignment):
         assert isinstance(batch_indices, set)
         if self.assignment_matrix_csr is None:
             self.assignment_matrix_csr = self.assignment_matrix.tocsr()
-        row_indices = list(batch_indices)
-        sorted(row_indices)
-        symbols_slice = self.assignment_matrix_csr.A[row_indices, :]
-        symbols = symbols_slice.sum(axis=0)
+        matrix = self.assignment_matrix_csr
+        symbols = csr_row_sum(
+            matrix.indptr,
+            matrix.indices,
+            matrix.data,
+            np.fromiter(batch_indices, dtype=np.int64, count=len(batch_indices)),
+            self.par.num_partitions,
+        )
         symbols += self.gamma * len(batch_indices)
         return symbols
 
+    def batch_counts(self):
+        '''Return a dense num_batches by num_partitions Numpy array, where
+        element [i, j] is the number of rows from partition j stored in
+        batch i, including gamma.
+
+        '''
+        if self.assignment_matrix_csr is None:
+            self.assignment_matrix_csr = self.assignment_matrix.tocsr()
+        return self.assignment_matrix_csr.toarray() + self.gamma
+
     def rows_iterator(self):
         '''Iterate over the rows of the assignment matrix.'''
         if self.assignment_matrix_csr is None:
@@ -135,38 +255,32 @@ class SparseAssignment(Assignment):
 
         return
 
-    def batch_union_sparse(self, batch_indices):
-        '''Compute the union of symbols stored in a set of batches.
+    def batch_unions(self, batch_sets):
+        '''Compute the union of symbols stored in each of several sets of
+        batches at once.
 
         Args:
-        batch_indices: Iterable of batch indices.
+        batch_sets: Iterable of iterables of batch indices.
 
-        Returns: A dense Numpy array containing the counts of symbols
-        stored in a union of batches.
+        Returns: A dense Numpy array with one row per set of batches,
+        containing the counts of symbols stored in the union of its
+        batches.
 
         '''
-        raise NotImplemented
-
-        assert isinstance(batch_indices, set)
         if self.assignment_matrix_csr is None:
             self.assignment_matrix_csr = self.assignment_matrix.tocsr()
-
-        cols = list(batch_indices)
-        rows = [0] * len(cols)
-        data = [1] * len(cols)
-        #selection_vector = sp.sparse.csr_matrix((data, (rows, cols)), shape=(1, self.par.num_batches))
-        # selection_vector = sp.sparse.coo_matrix((data, (rows, cols)),
-        #                                         shape=(1, self.par.num_batches))
-
-        # symbols = selection_vector.dot(self.assignment_matrix).A[0]
-
-        selection_vector = np.zeros((1, self.par.num_batches))
-        selection_vector[:, cols] = 1
-        symbols = (selection_vector * self.assignment_matrix_csr)
-
-        #print(self.par.num_partitions, selection_vector.shape, self.assignment_matrix.shape, symbols.shape)
-        symbols += self.gamma * len(batch_indices)
-        return symbols[0]
+        batch_sets = [np.fromiter(batches, dtype=np.int64) for batches in batch_sets]
+        matrix = self.assignment_matrix_csr
+        symbols = csr_row_sums(
+            matrix.indptr,
+            matrix.indices,
+            matrix.data,
+            batch_sets,
+            self.par.num_partitions,
+        )
+        symbols += self.gamma * np.array([len(batches) for batches in batch_sets],
+                                         dtype=np.int64)[:, None]
+        return symbols
 
     def save(self, directory='./saved_assignments/'):
         '''Save the assignment to disk.
@@ -224,69 +338,78 @@ class SparseAssignment(Assignment):
 
         '''
         assert self.par.server_storage * self.par.q % 1 == 0, 'Must be integer'
-        self.batch_labels = list(itertools.combinations(range(self.par.num_servers),
-                                                        int(self.par.server_storage * self.par.q)))
+        self.labels, self.batch_labels = Labels.from_combinations(
+            self.par.num_servers,
+            int(self.par.server_storage * self.par.q),
+            shuffle=shuffle,
+        )
+        return
 
-        if shuffle:
-            random.shuffle(self.batch_labels)
+    def builder(self):
+        '''Return a SparseAssignmentBuilder for this assignment. Pass it to
+        build() once all increments have been added to it.'''
+        return SparseAssignmentBuilder(self.assignment_matrix.shape)
 
-        row = 0
-        for label in self.batch_labels:
-            for server in label:
-                self.labels[server].add(row)
-            row += 1
-        return
+    def build(self, builder):
+        '''Add all increments collected by a builder to the assignment matrix.
+
+        Returns: Returns self. Does not copy the assignment.
+
+        '''
+        assert isinstance(builder, SparseAssignmentBuilder)
+        assert builder.shape == self.assignment_matrix.shape
+        self.assignment_matrix = sp.sparse.csr_matrix(
+            self.assignment_matrix + builder.tocsr(),
+            dtype=MATRIX_DTYPE,
+        )
+        self.assignment_matrix.sum_duplicates()
+        self.assignment_matrix.eliminate_zeros()
+        self.assignment_matrix_csr = None
+        return self
 
     def increment(self, rows, cols, data):
         '''Increment assignment_matrix[rows[i], cols[i]] by data[i] for all i.
 
         Args:
-        row: List of row indices
+        row: List or array of row indices
 
-        col: List of column indices
+        col: List or array of column indices
 
-        data: List of values to increment by
+        data: List or array of values to increment by
 
         Returns: Returns self. Does not copy the assignment.
 
         '''
-        assert isinstance(rows, list)
-        assert isinstance(cols, list)
-        assert isinstance(data, list)
+        assert isinstance(rows, (list, np.ndarray))
+        assert isinstance(cols, (list, np.ndarray))
+        assert isinstance(data, (list, np.ndarray))
         assert len(rows) == len(cols)
         assert len(cols) == len(data)
-        self.assignment_matrix += sp.sparse.coo_matrix((data, (rows, cols)), dtype=np.int16,
-                                                       shape=self.assignment_matrix.shape)
-        self.assignment_matrix_csr = None
-
-        # Eliminate duplicate entries
-        self.assignment_matrix.sum_duplicates()
-        return self
+        builder = self.builder()
+        builder.add(rows, cols, data)
+        return self.build(builder)
 
     def decrement(self, rows, cols, data):
         '''Decrement assignment_matrix[rows[i], cols[i]] by data[i] for all i.
 
         Args:
-        row: List of row indices
+        row: List or array of row indices
 
-        col: List of column indices
+        col: List or array of column indices
 
-        data: List of values to increment by
+        data: List or array of values to increment by
 
         Returns: Returns self. Does not copy the assignment.
 
         '''
-        assert isinstance(rows, list)
-        assert isinstance(cols, list)
-        assert isinstance(data, list)
+        assert isinstance(rows, (list, np.ndarray))
+        assert isinstance(cols, (list, np.ndarray))
+        assert isinstance(data, (list, np.ndarray))
         assert len(rows) == len(cols)
         assert len(cols) == len(data)
-        self.assignment_matrix -= sp.sparse.coo_matrix((data, (rows, cols)), dtype=np.int8,
-                                                       shape=self.assignment_matrix.shape)
-
-        # Eliminate duplicate entries
-        self.assignment_matrix.sum_duplicates()
-        return self
+        builder = self.builder()
+        builder.add(rows, cols, -np.asarray(data, dtype=MATRIX_DTYPE))
+        return self.build(builder)
 
     def is_valid(self):
         '''Test if the assignment is valid.
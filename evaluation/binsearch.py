@@ -20,8 +20,18 @@ Carlo simulations by randomizing the order in which servers finish. The number
 of servers needed in a given Monte Carlo iteration is computed by performing
 binary search.
 
+Alternatively, the number of servers needed can be computed incrementally by
+adding one server at a time (see computational_delay_incremental()), or for a
+whole block of completion orders at once using array operations (see
+computational_delay_block()).
+
 The performance is evaluated exhaustively if the number of possible
-realizations is smaller than the number of requested samples.
+realizations is smaller than the number of requested samples. The
+communication load only depends on the first q servers to finish, and is by
+default computed exactly over all of them (see communication_load_exact()).
+If a target confidence interval width is given, completion orders are
+sampled in chunks until the target is reached (see
+SampleEvaluator.evaluate_streaming()).
 
 '''
 
@@ -32,13 +42,19 @@ import itertools
 import datetime
 import numpy as np
 import pandas as pd
+import stats
 
 from functools import partial
 from scipy.special import comb as nchoosek
 from model import SystemParameters, ModelError
 from assignments import Assignment
+from assignments.shared import SharedAssignment
 from evaluation import AssignmentEvaluator
-from multiprocessing import Pool
+from evaluation.executor import get_executor
+
+# Max number of elements of the intermediate arrays used when computing the
+# load exactly.
+LOAD_CHUNK_SIZE = 1 << 22
 
 class SampleEvaluator(AssignmentEvaluator):
     '''This evaluator samples the performance of an assignment. It uses
@@ -46,7 +62,8 @@ class SampleEvaluator(AssignmentEvaluator):
 
     '''
 
-    def __init__(self, num_samples=1000):
+    def __init__(self, num_samples=1000, method='binsearch', exact_load=True,
+                 target=None, confidence=0.95, chunk_size=100, weighted=False):
         '''Create a sample evaluator.
 
         Args:
@@ -55,20 +72,79 @@ class SampleEvaluator(AssignmentEvaluator):
         The performance is evaluated exhaustively if it's faster than
         taking this many samples.
 
+        method: 'binsearch' to evaluate the computational delay of one
+        completion order at a time using binary search, 'incremental' to
+        evaluate one completion order at a time by adding one server at a
+        time, or 'vectorized' to evaluate all completion orders at once using
+        array operations.
+
+        exact_load: Compute the expected communication load over all
+        completion orders (see communication_load_exact()) instead of
+        sampling it whenever there are at most num_samples sets of q
+        servers, i.e., when it's no more expensive than sampling. Only the
+        delay is sampled in this case.
+
+        target: If not None, completion orders are sampled in chunks until
+        the confidence interval half-width of the mean of every sampled
+        column is at most a target fraction of the mean, or until
+        num_samples orders have been sampled.
+
+        confidence: Confidence level of the interval used with target.
+
+        chunk_size: Number of completion orders sampled per chunk when
+        target is not None.
+
+        weighted: If True, the performance is evaluated exactly whenever
+        there are at most num_samples sets of servers making up the
+        prefixes of all completion orders (see
+        computational_delay_distribution()). The result then has one row
+        per number of servers needed, weighted by its probability in the
+        'weight' column. This is the case for much larger systems than
+        exhaustive evaluation of all orders.
+
         '''
         assert isinstance(num_samples, int) and num_samples > 0
+        assert method in ['binsearch', 'incremental', 'vectorized'], method
+        assert isinstance(exact_load, bool)
+        assert target is None or target > 0
+        assert 0 < confidence < 1
+        assert isinstance(chunk_size, int) and chunk_size > 1
         self.num_samples = num_samples
+        self.method = method
+        self.exact_load = exact_load
+        self.target = target
+        self.confidence = confidence
+        self.chunk_size = chunk_size
+        self.weighted = weighted
         return
 
-    def random_completion_orders(self, parameters):
+    def use_exact_load(self, parameters):
+        '''Return True if the load should be computed exactly for these
+        parameters.'''
+        if not self.exact_load:
+            return False
+
+        # Computing the load exactly costs about as much as sampling one
+        # order per set of q servers.
+        if nchoosek(parameters.num_servers, parameters.q, exact=True) > self.num_samples:
+            logging.debug('Too many perspectives to compute the load exactly. Sampling it.')
+            return False
+        return True
+
+    def random_completion_orders(self, parameters, num_samples=None):
         '''Generates random server completion orders.
 
         Args:
 
         parameters: System parameters
 
+        num_samples: Number of orders to generate. Defaults to the
+        num_samples of the evaluator.
+
         '''
-        for _ in range(self.num_samples):
+        if num_samples is None:
+            num_samples = self.num_samples
+        for _ in range(num_samples):
             yield random.sample(range(parameters.num_servers), parameters.num_servers)
 
         return
@@ -91,6 +167,20 @@ class SampleEvaluator(AssignmentEvaluator):
             for remaining_order in itertools.permutations(remaining_servers):
                 yield list(order) + list(remaining_order)
 
+    def use_weighted(self, parameters):
+        '''Return True if the performance should be evaluated exactly over
+        all server subsets for these parameters.'''
+        if not self.weighted or not self.use_exact_load(parameters):
+            return False
+        num_subsets = sum(
+            nchoosek(parameters.num_servers, x, exact=True)
+            for x in range(parameters.q, parameters.num_servers + 1)
+        )
+        if num_subsets > self.num_samples:
+            logging.debug('Too many server subsets to evaluate exactly. Sampling.')
+            return False
+        return True
+
     def evaluate(self, parameters, assignment):
         '''Sample the communication load and computational delay of an
         assignment.
@@ -107,10 +197,9 @@ class SampleEvaluator(AssignmentEvaluator):
         '''
         assert isinstance(parameters, SystemParameters), type(parameters)
         assert isinstance(assignment, Assignment)
-        results = list()
-        printout_interval = datetime.timedelta(seconds=10)
-        last_printout = datetime.datetime.utcnow()
-        start_time = datetime.datetime.utcnow()
+        if self.use_weighted(parameters):
+            results = computational_delay_distribution(parameters, assignment)
+            return results.assign(**communication_load_exact(parameters, assignment))
 
         # Check all or num_samples samples. Whichever is smaller.
         exhaustive_samples = nchoosek(parameters.num_servers, parameters.q)
@@ -120,38 +209,241 @@ class SampleEvaluator(AssignmentEvaluator):
         else:
             completion_orders = self.random_completion_orders(parameters)
 
-        with Pool(processes=12) as pool:
-            i = 0
-            for dct in pool.imap_unordered(partial(
-                    f,
-                    parameters=parameters,
-                    assignment=assignment,
-            ), completion_orders):
-                results.append(dct)
-                i += 1
-
-                # Print progress periodically
-                if datetime.datetime.utcnow() - last_printout > printout_interval:
-                    last_printout = datetime.datetime.utcnow()
-                    elapsed = datetime.datetime.utcnow() - start_time
-                    rate = elapsed / i
-                    remaining = (self.num_samples - i) * rate
-                    logging.info(
-                        '%s %f percent finished. %s remaining.',
-                        parameters.identifier(),
-                        i / self.num_samples * 100,
-                        remaining,
-                    )
+        exact_load = self.use_exact_load(parameters)
+        if self.target is not None and exhaustive_samples > self.num_samples:
+            results = self.evaluate_streaming(parameters, assignment,
+                                              sample_load=not exact_load)
+        elif self.method == 'vectorized':
+            results = self.evaluate_block(parameters, assignment, completion_orders,
+                                          sample_load=not exact_load)
+        else:
+            num_orders = min(exhaustive_samples, self.num_samples)
+            results = self.evaluate_orders(parameters, assignment, completion_orders,
+                                           num_orders, sample_load=not exact_load)
+
+        if exact_load:
+            results = results.assign(**communication_load_exact(parameters, assignment))
+        return results
+
+    def evaluate_streaming(self, parameters, assignment, sample_load=True):
+        '''Evaluate random completion orders in chunks until the mean of
+        every sampled column is within the target confidence interval
+        half-width, or until num_samples orders have been evaluated.
+
+        Args:
+
+        parameters: System parameters
+
+        assignment: Assignment to evaluate.
+
+        sample_load: Compute the communication load of each order if True.
+
+        Returns: A Pandas dataframe with one row per completion order.
+
+        '''
+        columns = ['servers', 'delay']
+        if sample_load:
+            columns += ['unicast_load_1', 'unicast_load_2']
+
+        # The assignment is published once and used for all chunks.
+        published = None
+        if self.method != 'vectorized':
+            published = self.publish(parameters, assignment, sample_load=sample_load)
+
+        moments = stats.RunningMoments()
+        chunks = list()
+        try:
+            while moments.count < self.num_samples:
+                num_orders = min(self.chunk_size, self.num_samples - moments.count)
+                completion_orders = self.random_completion_orders(parameters, num_orders)
+                if published is None:
+                    chunk = self.evaluate_block(parameters, assignment, completion_orders,
+                                                sample_load=sample_load)
+                else:
+                    chunk = self.map_orders(parameters, published, completion_orders,
+                                            num_orders)
+
+                chunks.append(chunk)
+                moments.update(chunk[columns].values)
+                if moments.converged(self.target, confidence=self.confidence):
+                    logging.debug('%s converged after %d samples.',
+                                  parameters.identifier(), moments.count)
+                    break
+        finally:
+            if published is not None:
+                self.release(published)
+
+        return pd.concat(chunks, ignore_index=True)
+
+    def evaluate_orders(self, parameters, assignment, completion_orders, num_orders,
+                        sample_load=True):
+        '''Evaluate the completion orders one at a time using the executor.
+
+        Args:
+
+        parameters: System parameters
+
+        assignment: Assignment to evaluate.
+
+        completion_orders: Iterable of server completion orders.
+
+        num_orders: Number of completion orders.
+
+        sample_load: Compute the communication load of each order if True.
+
+        Returns: A Pandas dataframe with one row per completion order.
+
+        '''
+        published = self.publish(parameters, assignment, sample_load=sample_load)
+        try:
+            return self.map_orders(parameters, published, completion_orders, num_orders)
+        finally:
+            self.release(published)
+
+    def publish(self, parameters, assignment, sample_load=True):
+        '''Publish the assignment and the evaluation function to the workers
+        of the executor. Pass the result to map_orders() any number of times
+        and to release() once done.
+
+        Args:
+
+        parameters: System parameters
+
+        assignment: Assignment to evaluate.
+
+        sample_load: Compute the communication load of each order if True.
+
+        Returns: A tuple (key, shared), where key is the key of the published
+        objects and shared is the SharedAssignment given to the workers, or
+        None if the work is carried out in this process.
+
+        '''
+
+        # Give the workers access to the assignment through shared memory
+        # to avoid storing a copy of it in every worker.
+        executor = get_executor()
+        shared = None
+        if executor.processes > 1:
+            shared = SharedAssignment.share(assignment)
+
+        if self.method == 'incremental' and shared is None:
+            delay_fun = partial(
+                computational_delay_incremental,
+                batch_counts=assignment.batch_counts(),
+            )
+        elif self.method == 'incremental':
+            delay_fun = computational_delay_incremental
+        else:
+            delay_fun = computational_delay_sample
+
+        try:
+            key = executor.publish(
+                parameters=parameters,
+                assignment=shared if shared is not None else assignment,
+                delay_fun=delay_fun,
+                sample_load=sample_load,
+            )
+        except:
+            if shared is not None:
+                shared.unlink()
+            raise
+        return key, shared
+
+    def release(self, published):
+        '''Release objects published with publish().'''
+        key, shared = published
+        get_executor().release(key)
+        if shared is not None:
+            shared.unlink()
+        return
+
+    def map_orders(self, parameters, published, completion_orders, num_orders):
+        '''Evaluate completion orders using objects published with publish().
+        The orders are sent to the workers in chunks.
+
+        Args:
+
+        parameters: System parameters
+
+        published: Value returned by publish().
+
+        completion_orders: Iterable of server completion orders.
+
+        num_orders: Number of completion orders.
+
+        Returns: A Pandas dataframe with one row per completion order.
+
+        '''
+        key, _ = published
+        executor = get_executor()
+        results = list()
+        printout_interval = datetime.timedelta(seconds=10)
+        last_printout = datetime.datetime.utcnow()
+        start_time = datetime.datetime.utcnow()
+        chunksize = max(1, math.ceil(num_orders / (4 * executor.processes)))
+        for i, dct in enumerate(executor.map(f, completion_orders, key=key,
+                                             chunksize=chunksize), 1):
+            results.append(dct)
+
+            # Print progress periodically
+            if datetime.datetime.utcnow() - last_printout > printout_interval:
+                last_printout = datetime.datetime.utcnow()
+                elapsed = datetime.datetime.utcnow() - start_time
+                rate = elapsed / i
+                remaining = (num_orders - i) * rate
+                logging.info(
+                    '%s %f percent finished. %s remaining.',
+                    parameters.identifier(),
+                    i / num_orders * 100,
+                    remaining,
+                )
 
         return pd.DataFrame(results)
 
-def f(completion_order, parameters=None, assignment=None):
+    def evaluate_block(self, parameters, assignment, completion_orders, sample_load=True):
+        '''Evaluate the computational delay of all completion orders at once.
+        The communication load is computed separately for each order.
+
+        Args:
+
+        parameters: System parameters
+
+        assignment: Assignment to evaluate.
+
+        completion_orders: Iterable of server completion orders.
+
+        sample_load: Compute the communication load of each order if True.
+
+        Returns: A Pandas dataframe with one row per completion order.
+
+        '''
+        completion_orders = np.array(list(completion_orders), dtype=np.int64)
+        results = pd.DataFrame(computational_delay_block(
+            parameters,
+            assignment,
+            completion_orders,
+        ))
+        if not sample_load:
+            return results
+
+        loads = pd.DataFrame([
+            communication_load_sample(parameters, assignment, list(order))
+            for order in completion_orders
+        ])
+        return pd.concat([results, loads], axis=1)
+
+def f(completion_order, parameters=None, assignment=None, delay_fun=None,
+      sample_load=True):
+    if delay_fun is None:
+        delay_fun = computational_delay_sample
     result = dict()
-    result.update(computational_delay_sample(
+    result.update(delay_fun(
         parameters,
         assignment,
         completion_order,
     ))
+    if not sample_load:
+        return result
     result.update(communication_load_sample(
         parameters,
         assignment,
@@ -208,9 +500,8 @@ def computational_delay_sample(parameters, assignment, completion_order):
     '''
 
     # Store the batches added permanently
-    permanently_added = set()
-    for server in completion_order[0:parameters.q]:
-        permanently_added.update(assignment.labels[server])
+    labels = assignment.labels
+    permanently_added = labels.batches(labels.union(completion_order[0:parameters.q]))
 
     permanent_count = np.zeros(parameters.num_partitions, dtype=np.int64)
     permanent_count += assignment.batch_union(permanently_added)
@@ -224,9 +515,7 @@ def computational_delay_sample(parameters, assignment, completion_order):
         current = min_bound + math.floor((max_bound - min_bound) / 2)
 
         # Add servers
-        tentatively_added = set()
-        for server in completion_order[min_bound:current]:
-            tentatively_added.update(assignment.labels[server])
+        tentatively_added = labels.batches(labels.union(completion_order[min_bound:current]))
 
         can_decode, tentative_count = decodeable(
             parameters,
@@ -247,6 +536,189 @@ def computational_delay_sample(parameters, assignment, completion_order):
     return {'servers': min_bound, 'batches': min_bound * batches_per_server,
             'delay': parameters.computational_delay(q=min_bound)}
 
+def computational_delay_incremental(parameters, assignment, completion_order,
+                                    batch_counts=None):
+    '''Compute the computational delay of one realization of the server
+    completion order by adding one server at a time.
+
+    A running per-partition symbol count and the number of partitions that
+    are still short of rows_per_partition symbols are updated as the batches
+    of each server are added. The evaluation stops at the first server for
+    which no partition is short, meaning that every batch is added at most
+    once.
+
+    Args:
+
+    parameters: System parameters.
+
+    assignment: Assignment to evaluate.
+
+    completion_order: A list of server indices in the order they completed
+    their map phase computation.
+
+    batch_counts: Array returned by assignment.batch_counts(). Provide it
+    when evaluating many completion orders of the same assignment. If None,
+    the counts of the added batches are computed with assignment.batch_union().
+
+    Returns: A dict containing the results.
+
+    '''
+    count = np.zeros(parameters.num_partitions, dtype=np.int64)
+    short = parameters.num_partitions
+    received = np.zeros(parameters.num_batches, dtype=bool)
+    incidence = assignment.labels.incidence
+    servers = parameters.num_servers
+    for position, server in enumerate(completion_order):
+        new = incidence[server] & ~received
+        batches = np.flatnonzero(new)
+        if len(batches):
+            received |= new
+            was_short = count < parameters.rows_per_partition
+            if batch_counts is None:
+                count += assignment.batch_union(set(batches.tolist()))
+            else:
+                count += batch_counts[batches].sum(axis=0, dtype=np.int64)
+            short -= (was_short & (count >= parameters.rows_per_partition)).sum()
+
+        if position + 1 >= parameters.q and short == 0:
+            servers = position + 1
+            break
+
+    coded_rows_per_server = parameters.num_source_rows * parameters.server_storage
+    batches_per_server = coded_rows_per_server / parameters.rows_per_batch
+    return {'servers': servers, 'batches': servers * batches_per_server,
+            'delay': parameters.computational_delay(q=servers)}
+
+def incidence_matrix(parameters, assignment):
+    '''Compute the server-to-batch incidence matrix of an assignment.
+
+    Args:
+
+    parameters: System parameters.
+
+    assignment: Assignment object.
+
+    Returns: A num_servers by num_batches boolean Numpy array, where element
+    [i, j] is True if batch j is stored at server i.
+
+    '''
+    incidence = assignment.labels.incidence
+    assert incidence.shape == (parameters.num_servers, parameters.num_batches)
+    return incidence
+
+def computational_delay_block(parameters, assignment, completion_orders):
+    '''Compute the computational delay of a block of realizations of the
+    server completion order.
+
+    Servers are added one position at a time for all orders simultaneously.
+    The batches made available by each server are found from the server-to-batch
+    incidence matrix, and the running per-partition symbol counts are updated
+    with a single matrix product per position. Orders are dropped from the
+    computation once decoding is possible.
+
+    Args:
+
+    parameters: System parameters.
+
+    assignment: Assignment to evaluate.
+
+    completion_orders: A num_samples by num_servers Numpy array, where each
+    row holds the server indices in the order they completed their map phase
+    computation.
+
+    Returns: A dict with arrays of length num_samples containing the results.
+
+    '''
+    completion_orders = np.asarray(completion_orders)
+    assert completion_orders.ndim == 2
+    assert completion_orders.shape[1] == parameters.num_servers
+    num_samples = completion_orders.shape[0]
+
+    incidence = incidence_matrix(parameters, assignment)
+    batch_counts = np.asarray(assignment.batch_counts(), dtype=np.float64)
+
+    # Batches received so far and the corresponding symbol counts.
+    received = np.zeros((num_samples, parameters.num_batches), dtype=bool)
+    partition_count = np.zeros((num_samples, parameters.num_partitions))
+
+    # Indices of the orders that can't be decoded yet.
+    pending = np.arange(num_samples)
+    servers = np.zeros(num_samples, dtype=np.int64) + parameters.num_servers
+    for position in range(parameters.num_servers):
+        new = incidence[completion_orders[pending, position]] & ~received[pending]
+        received[pending] |= new
+        partition_count[pending] += new.astype(np.float64).dot(batch_counts)
+        if position + 1 < parameters.q:
+            continue
+
+        decodeable = (partition_count[pending] >= parameters.rows_per_partition).all(axis=1)
+        servers[pending[decodeable]] = position + 1
+        pending = pending[~decodeable]
+        if not len(pending):
+            break
+
+    coded_rows_per_server = parameters.num_source_rows * parameters.server_storage
+    batches_per_server = coded_rows_per_server / parameters.rows_per_batch
+    delay = np.zeros(num_samples)
+    for num_servers in np.unique(servers):
+        delay[servers == num_servers] = parameters.computational_delay(q=int(num_servers))
+
+    return {'servers': servers, 'batches': servers * batches_per_server,
+            'delay': delay}
+
+def computational_delay_distribution(parameters, assignment, chunk_size=LOAD_CHUNK_SIZE):
+    '''Compute the distribution of the computational delay over all server
+    completion orders.
+
+    Whether the first x servers of an order can decode only depends on which
+    servers they are, and decoding remains possible when adding servers. The
+    number of servers needed is thus at most x iff the set of the first x
+    servers can decode. Further, this set is equally likely to be any subset
+    of x servers. Each subset is evaluated once, instead of once for every
+    order it's a prefix of.
+
+    Args:
+
+    parameters: System parameters.
+
+    assignment: Assignment to evaluate.
+
+    chunk_size: Max number of elements of the intermediate arrays.
+
+    Returns: A Pandas dataframe with one row per possible number of servers
+    needed, where the 'weight' column is its probability.
+
+    '''
+    incidence = assignment.labels.incidence
+    batch_counts = np.asarray(assignment.batch_counts(), dtype=np.float64)
+
+    # cdf[i] is the probability of needing at most q + i servers.
+    cdf = np.ones(parameters.num_servers - parameters.q + 1)
+    for i, num_servers in enumerate(range(parameters.q, parameters.num_servers)):
+        num_subsets = nchoosek(parameters.num_servers, num_servers, exact=True)
+        step = max(1, chunk_size // (num_servers * parameters.num_batches))
+        decodeable = 0
+        for subsets in _combination_chunks(parameters.num_servers, num_servers, step):
+            received = incidence[subsets].any(axis=1)
+            count = received.astype(np.float64).dot(batch_counts)
+            decodeable += (count >= parameters.rows_per_partition).all(axis=1).sum()
+
+        cdf[i] = decodeable / num_subsets
+        if decodeable == num_subsets:
+            break
+
+    servers = np.arange(parameters.q, parameters.num_servers + 1)
+    weight = np.diff(cdf, prepend=0)
+    servers, weight = servers[weight > 0], weight[weight > 0]
+    coded_rows_per_server = parameters.num_source_rows * parameters.server_storage
+    batches_per_server = coded_rows_per_server / parameters.rows_per_batch
+    return pd.DataFrame({
+        'servers': servers,
+        'batches': servers * batches_per_server,
+        'delay': [parameters.computational_delay(q=int(x)) for x in servers],
+        'weight': weight,
+    })
+
 def communication_load_sample(parameters, assignment, completion_order):
     '''Compute the communication load of one realization of the server
     completion order.
@@ -275,17 +747,19 @@ def communication_load_sample(parameters, assignment, completion_order):
     assert len(completion_order) == parameters.q
 
     # Sum the corresponding rows of the assignment matrix
-    batches_1 = assignment.labels[server].copy()
+    labels = assignment.labels
+    batches_1 = labels.incidence[server].copy()
+
+    # A batch is in the intersection of the labels of some subset of j
+    # of the remaining servers iff at least j of them store it.
+    stored = labels.count(servers_without_q)
 
     # Multicasting load
     multicast_load_1, multicast_load_2 = parameters.multicast_load()
 
     # Strategy 1 multicasts for all subsets of size from sq to muq.
     try:
-        for j in range(parameters.multicast_set_size_1(), parameters.muq + 1):
-            for multicast_subset in itertools.combinations(servers_without_q, j):
-                batches_1.update(set.intersection(*[assignment.labels[x]
-                                                    for x in multicast_subset]))
+        batches_1 |= stored >= parameters.multicast_set_size_1()
     except ModelError:
         pass
 
@@ -294,27 +768,97 @@ def communication_load_sample(parameters, assignment, completion_order):
     count_vector -= parameters.num_source_rows / parameters.num_partitions
 
     # Add multicasted values
-    count_vector += assignment.batch_union(batches_1)
+    count_vector += assignment.batch_union(labels.batches(batches_1))
 
     # Compute unicasts by summing the negative elements
     unicast_load_1 = abs(count_vector[count_vector < 0].sum())
     unicast_load_1 /= parameters.num_source_rows
 
     # Strategy 2 multicasts for subsets of size sq-1 to muq
-    batches_2 = set()
+    batches_2 = np.zeros(parameters.num_batches, dtype=bool)
     try:
-        for multicast_subset in itertools.combinations(servers_without_q,
-                                                       parameters.multicast_set_size_2()):
-            batches_2.update(set.intersection(*[assignment.labels[x]
-                                                for x in multicast_subset]))
+        batches_2 |= stored >= parameters.multicast_set_size_2()
     except ModelError:
         pass
 
     # Add the new unique batches and compute the strategy 2 unicasts.
-    count_vector += assignment.batch_union(batches_2 - batches_1)
+    count_vector += assignment.batch_union(labels.batches(batches_2 & ~batches_1))
     unicast_load_2 = abs(count_vector[count_vector < 0].sum())
     unicast_load_2 /= parameters.num_source_rows
 
     # Append the results.
     return {'unicast_load_1': unicast_load_1, 'unicast_load_2': unicast_load_2,
             'multicast_load_1': multicast_load_1, 'multicast_load_2': multicast_load_2}
+
+def _combination_chunks(n, k, step):
+    '''Generate all k-subsets of range(n) as Numpy arrays of shape
+    (at most step, k). The subsets are generated lazily.'''
+    combinations = itertools.combinations(range(n), k)
+    while True:
+        chunk = np.array(list(itertools.islice(combinations, step)), dtype=np.int64)
+        if not len(chunk):
+            return
+        yield chunk.reshape(-1, k)
+
+def communication_load_exact(parameters, assignment, chunk_size=LOAD_CHUNK_SIZE):
+    '''Compute the expected communication load over all server completion
+    orders.
+
+    The load of a completion order only depends on which q servers finish
+    first and which of them the load is computed from, i.e., on its
+    perspective (Q, k). Orders sharing a perspective share one computation,
+    and every perspective is equally likely. Further, batches with the same
+    label contribute to the same perspectives, so their symbol counts are
+    summed before evaluating the perspectives in vectorized chunks.
+
+    Args:
+
+    parameters: System parameters.
+
+    assignment: Assignment to evaluate.
+
+    chunk_size: Max number of elements of the intermediate arrays.
+
+    Returns: A dict containing the expected loads.
+
+    '''
+    labels = assignment.labels
+
+    # Group the batches by label.
+    patterns, inverse = np.unique(labels.incidence.T, axis=0, return_inverse=True)
+    pattern_counts = np.zeros((len(patterns), parameters.num_partitions))
+    np.add.at(pattern_counts, inverse.reshape(-1), np.asarray(assignment.batch_counts()))
+    incidence = patterns.T.astype(np.int64)
+
+    # A batch is multicasted if it's stored at this many of the other
+    # servers. Strategies that aren't available multicast no batches.
+    set_size_1 = parameters.muq + 1
+    set_size_2 = parameters.muq + 1
+    try:
+        set_size_1 = parameters.multicast_set_size_1()
+        set_size_2 = parameters.multicast_set_size_2()
+    except ModelError:
+        pass
+
+    rows_per_partition = parameters.num_source_rows / parameters.num_partitions
+    step = max(1, chunk_size // (parameters.q * len(patterns)))
+    unicasts_1 = 0
+    unicasts_2 = 0
+    for subsets in _combination_chunks(parameters.num_servers, parameters.q, step):
+        own = incidence[subsets]
+        others = own.sum(axis=1)[:, None, :] - own
+        batches_1 = (own > 0) | (others >= set_size_1)
+        batches_2 = batches_1 | (others >= set_size_2)
+        count_vector = batches_1.astype(np.float64).dot(pattern_counts) - rows_per_partition
+        unicasts_1 += -np.minimum(count_vector, 0).sum()
+        count_vector = batches_2.astype(np.float64).dot(pattern_counts) - rows_per_partition
+        unicasts_2 += -np.minimum(count_vector, 0).sum()
+
+    num_perspectives = nchoosek(parameters.num_servers, parameters.q, exact=True) * parameters.q
+    multicast_load_1, multicast_load_2 = parameters.multicast_load()
+    return {
+        'unicast_load_1': unicasts_1 / num_perspectives / parameters.num_source_rows,
+        'unicast_load_2': unicasts_2 / num_perspectives / parameters.num_source_rows,
+        'multicast_load_1': multicast_load_1,
+        'multicast_load_2': multicast_load_2,
+    }
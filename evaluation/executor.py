@@ -0,0 +1,230 @@
+############################################################################
+# Copyright 2017 Albin Severinson                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+'''This module provides a process pool that is shared by all evaluations
+performed by a process. The pool is created the first time it's needed and
+lives until the process exits.
+
+Objects needed by every task, e.g., the parameters and the assignment under
+evaluation, are published to the workers once instead of being pickled into
+every task. Work is sent to the workers in chunks.
+
+A process forked from a process holding an executor doesn't inherit it. The
+pool and published objects belong to the parent, so the child starts over
+with a new executor the first time it needs one.
+
+'''
+
+import os
+import atexit
+import pickle
+import logging
+import tempfile
+import collections
+
+from functools import partial
+from multiprocessing import Pool
+
+# number of published objects cached by each worker
+CACHE_SIZE = 4
+
+class EvaluationExecutor(object):
+    '''Process pool for evaluating many samples of the same objects.
+
+    '''
+
+    def __init__(self, processes=None):
+        '''Create an evaluation executor. The process pool is created lazily.
+
+        Args:
+
+        processes: Number of worker processes. Defaults to the number of CPUs.
+        If 1, all work is carried out in the calling process.
+
+        '''
+        if processes is None:
+            processes = os.cpu_count()
+        assert isinstance(processes, int) and processes > 0
+        self.processes = processes
+        self.pid = os.getpid()
+        self._pool = None
+        self._published = dict()
+        return
+
+    @property
+    def pool(self):
+        '''The process pool. Created the first time it's accessed.'''
+        if self._pool is None:
+            logging.debug('Starting evaluation pool with %d processes.', self.processes)
+            self._pool = Pool(processes=self.processes)
+        return self._pool
+
+    def publish(self, **objects):
+        '''Publish objects to the workers. The objects are pickled once and
+        unpickled at most once by each worker.
+
+        Args:
+
+        objects: Keyword arguments passed to the function given to map().
+
+        Returns: A key identifying the published objects. Pass it to map() and
+        release it once done.
+
+        '''
+        fd, key = tempfile.mkstemp(prefix='evaluation_', suffix='.pickle')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._published[key] = objects
+        return key
+
+    def release(self, key):
+        '''Release objects published with publish().'''
+        self._published.pop(key, None)
+        try:
+            os.remove(key)
+        except FileNotFoundError:
+            pass
+        return
+
+    def map(self, fun, iterable, key=None, chunksize=1):
+        '''Compute fun(item, **objects) for every item in iterable, where
+        objects are the keyword arguments given to publish().
+
+        Args:
+
+        fun: Function to apply. Must be picklable.
+
+        iterable: Items to apply fun to.
+
+        key: Key returned by publish().
+
+        chunksize: Number of items sent to a worker at a time.
+
+        Returns: An iterator over the results. Results are returned in
+        arbitrary order.
+
+        '''
+        assert key in self._published, 'objects must be published before mapping'
+        assert isinstance(chunksize, int) and chunksize > 0
+        if self.processes == 1:
+            objects = self._published[key]
+            return (fun(item, **objects) for item in iterable)
+
+        return (
+            result
+            for results in self.pool.imap_unordered(
+                partial(_run_chunk, fun=fun, key=key),
+                _chunks(iterable, chunksize),
+            )
+            for result in results
+        )
+
+    def close(self):
+        '''Terminate the worker processes and remove published objects. Does
+        nothing if called from another process than the one that created the
+        executor, since the pool and published objects belong to that process.
+
+        '''
+        if self.pid != os.getpid():
+            return
+        for key in list(self._published):
+            self.release(key)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        return
+
+# executor shared by all evaluations of this process
+_executor = None
+
+def get_executor():
+    '''Return the executor shared by all evaluations of this process.'''
+    global _executor
+    if _executor is None:
+        _executor = EvaluationExecutor()
+    return _executor
+
+def configure(processes=None):
+    '''Set the number of worker processes used by the shared executor.
+
+    Args:
+
+    processes: Number of worker processes. Defaults to the number of CPUs.
+    If 1, all work is carried out in the calling process.
+
+    '''
+    global _executor
+    if _executor is not None:
+        _executor.close()
+    _executor = EvaluationExecutor(processes=processes)
+    return _executor
+
+@atexit.register
+def _shutdown():
+    if _executor is not None:
+        _executor.close()
+    return
+
+def _discard_after_fork():
+    '''Discard the executor inherited from the parent without closing it.'''
+    global _executor
+    _executor = None
+    return
+
+os.register_at_fork(after_in_child=_discard_after_fork)
+
+def _chunks(iterable, chunksize):
+    '''Split an iterable into lists of length at most chunksize.'''
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+    return
+
+# objects published to this worker
+_worker_cache = collections.OrderedDict()
+
+def _evict_released():
+    '''Drop objects whose key has been released, i.e., whose file has been
+    removed. Shared memory mapped by the objects is closed when they're
+    garbage collected.'''
+    for key in [key for key in _worker_cache if not os.path.isfile(key)]:
+        del _worker_cache[key]
+    return
+
+def _worker_objects(key):
+    '''Return the objects published under key, loading them if needed.
+    Objects released since the last call are evicted first.'''
+    _evict_released()
+    if key in _worker_cache:
+        _worker_cache.move_to_end(key)
+        return _worker_cache[key]
+    with open(key, 'rb') as f:
+        objects = pickle.load(f)
+    _worker_cache[key] = objects
+    if len(_worker_cache) > CACHE_SIZE:
+        _worker_cache.popitem(last=False)
+    return objects
+
+def _run_chunk(chunk, fun=None, key=None):
+    '''Apply fun to every item of a chunk in a worker process.'''
+    objects = _worker_objects(key)
+    return [fun(item, **objects) for item in chunk]
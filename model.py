@@ -22,6 +22,7 @@ system under simulation.
 
 import math
 import functools
+import numpy as np
 from scipy.special import comb as nchoosek
 import complexity
 import stats
@@ -29,6 +30,40 @@ import stats
 class ModelError(Exception):
     '''Base class for exceptions raised by this module.'''
 
+@functools.lru_cache(maxsize=1024)
+def alpha_table(num_servers, q, muq):
+    '''Compute alpha_j for all j between 0 and num_servers. The table is
+    computed once for each combination of arguments.
+
+    Args:
+
+    num_servers: Total number of servers.
+
+    q: Number of servers to wait for.
+
+    muq: Number of servers storing each batch.
+
+    Returns: Read-only Numpy array of length num_servers+1, where element j is
+    alpha_j as defined in the paper.
+
+    '''
+    total = nchoosek(num_servers, muq, exact=True)
+    table = np.zeros(num_servers+1)
+    for j in range(num_servers+1):
+        alpha = nchoosek(q - 1, j, exact=True)
+        alpha *= nchoosek(num_servers - q, muq - j, exact=True)
+        alpha /= q / num_servers
+        alpha /= total
+        table[j] = alpha
+    table.flags.writeable = False
+    return table
+
+def _scalar_or_array(values, scalar):
+    '''Return values as a Python scalar if scalar is True.'''
+    if scalar:
+        return values.item()
+    return values
+
 class SystemParameters(object):
     '''System parameters representation. This object is used to pass
     around parameters associated with the distributed computing system
@@ -261,7 +296,13 @@ class SystemParameters(object):
         string += '_T_' + str(self.num_partitions)
         return string
 
-    @functools.lru_cache(maxsize=128)
+    def alphas(self):
+        '''Return a read-only Numpy array of alpha_j for all j between 0 and
+        num_servers. See alpha_table().
+
+        '''
+        return alpha_table(self.num_servers, self.q, self.muq)
+
     def alphaj(self, j):
         '''Compute alpha_j as defined in the paper.
 
@@ -271,20 +312,19 @@ class SystemParameters(object):
 
         '''
         assert isinstance(j, int) and 0 <= j <= self.num_servers
-        result = nchoosek(self.q - 1, j, exact=True)
-        result *= nchoosek(self.num_servers - self.q, self.muq - j, exact=True)
-        result /= self.q / self.num_servers
-        result /= nchoosek(self.num_servers, self.muq, exact=True)
-        return result
+        return self.alphas()[j].item()
 
-    @functools.lru_cache(maxsize=8)
     def multicast_set_size_1(self, overhead=1):
         '''Compute the size of the smallest multicast set using strategy 1.
         Denoted by s_q in the paper.
 
         Args:
 
-        overhead: Code overhead. Equal to 1 for MDS codes.
+        overhead: Code overhead. Equal to 1 for MDS codes. May be an array of
+        overheads.
+
+        Returns: The set size, or an array of set sizes if overhead is an
+        array.
 
         Raises:
 
@@ -294,18 +334,18 @@ class SystemParameters(object):
         if self.muq == 1:
             raise ModelError('Multicasting requires muq to be larger than 1.')
 
+        scalar = np.ndim(overhead) == 0
+        overhead = np.asarray(overhead, dtype=float)
         if self.muq == 2:
-            return 2
-
-        cumsum = 0
-        set_size = self.muq
-        while set_size > 1:
-            cumsum += self.alphaj(set_size)
-            if cumsum > overhead - self.server_storage:
-                return max(min(set_size + 1, self.muq), 2)
-            set_size -= 1
+            return _scalar_or_array(np.full(overhead.shape, 2), scalar)
 
-        return 2
+        # cumsum[i] is the sum of alpha_j for j between muq-i and muq. find
+        # the largest set size for which the sum exceeds the threshold.
+        cumsum = np.cumsum(self.alphas()[self.muq:1:-1])
+        i = np.searchsorted(cumsum, overhead - self.server_storage, side='right')
+        set_size = np.where(i < len(cumsum), self.muq - i + 1, 2)
+        set_size = np.maximum(np.minimum(set_size, self.muq), 2)
+        return _scalar_or_array(set_size, scalar)
 
     def multicast_set_size_2(self, overhead=1):
         '''Compute the size of the smallest multicast set using strategy 2.
@@ -313,7 +353,8 @@ class SystemParameters(object):
 
         Args:
 
-        overhead: Code overhead. Equal to 1 for MDS codes.
+        overhead: Code overhead. Equal to 1 for MDS codes. May be an array of
+        overheads.
 
         Raises:
 
@@ -321,11 +362,11 @@ class SystemParameters(object):
         parameters.
 
         '''
-        if self.multicast_set_size_1(overhead=overhead) < 3:
+        set_size = self.multicast_set_size_1(overhead=overhead)
+        if np.any(set_size < 3):
             raise ModelError('Shuffling strategy 2 requires multicast_set_size_1 to be at least 3.')
-        return self.multicast_set_size_1(overhead=overhead) - 1
+        return set_size - 1
 
-    @functools.lru_cache(maxsize=128)
     def multicast_load(self, multicast_cost=None, overhead=1):
         '''Compute the multicast load for strategy 1 and 2.
 
@@ -333,38 +374,42 @@ class SystemParameters(object):
 
         multicast_cost: See unpartitioned_load()
 
-        overhead: Code overhead. Equal to 1 for MDS codes.
+        overhead: Code overhead. Equal to 1 for MDS codes. May be an array of
+        overheads.
 
         Returns: tuple (multicast_load_1, multicast_load_2) per source row and
-        input/output vector.
+        input/output vector. The loads are arrays if overhead is an array.
 
         '''
         if not multicast_cost:
             multicast_cost = lambda j: j
 
-        load_1 = 0
-        load_2 = 0
-
-        # Compute load 1 and 2 (leaving out the last term of load 2).
+        scalar = np.ndim(overhead) == 0
+        overhead = np.asarray(overhead, dtype=float)
         try:
-            for j in range(self.multicast_set_size_1(overhead=overhead), self.muq+1):
-                alpha = self.alphaj(j) / multicast_cost(j)
-                load_1 += alpha
-                load_2 += alpha
+            set_size_1 = self.multicast_set_size_1(overhead=overhead)
         except ModelError:
-            pass
-
-        # Add last term of load 2, or set to infinity if unavailable.
-        try:
-            j = self.multicast_set_size_2(overhead=overhead)
-            load_2 += self.alphaj(j) / multicast_cost(j)
-        except ModelError:
-            load_2 = math.inf
+            load_1 = np.zeros(overhead.shape)
+            load_2 = np.full(overhead.shape, math.inf)
+            return _scalar_or_array(load_1, scalar), _scalar_or_array(load_2, scalar)
+
+        # load 1 for each possible set size. load 2 is load 1 plus the load of
+        # the multicasting to set_size_1-1 servers, if available.
+        alphas = self.alphas()
+        terms = [0] * 2 + [alphas[j].item() / multicast_cost(j) for j in range(2, self.muq+1)]
+        loads_1 = np.zeros(self.muq+1)
+        loads_2 = np.full(self.muq+1, math.inf)
+        for set_size in np.unique(set_size_1):
+            loads_1[set_size] = sum(terms[set_size:])
+            if set_size >= 3:
+                loads_2[set_size] = loads_1[set_size] + terms[set_size-1]
 
         # this load is per source row and input/output vector
-        return load_1, load_2
+        return (
+            _scalar_or_array(loads_1[set_size_1], scalar),
+            _scalar_or_array(loads_2[set_size_1], scalar),
+        )
 
-    @functools.lru_cache(maxsize=128)
     def unpartitioned_load(self, strategy='best', multicast_cost=None,
                            overhead=1, design_overhead=None):
         '''Compute the communication load of the unpartitioned scheme.
@@ -383,12 +428,13 @@ class SystemParameters(object):
         default.
 
         overhead: reception overhead. equal to 1 for MDS codes. a higher
-        overhead requires transmitting more values over the network.
+        overhead requires transmitting more values over the network. may be
+        an array of overheads.
 
         design_overhead: the coded shuffling is tuned to target this overhead.
 
         returns: total number of messages per source row and input/output
-        vector.
+        vector, or an array of loads if overhead is an array.
 
         Raises:
 
@@ -396,18 +442,24 @@ class SystemParameters(object):
 
         '''
         assert strategy == 'best' or strategy == '1' or strategy == '2'
-        assert design_overhead is None or overhead >= design_overhead, \
+        assert design_overhead is None or np.all(overhead >= design_overhead), \
             'design_overhead={} must be <= overhead={}'.format(design_overhead, overhead)
         if design_overhead is None:
             design_overhead = overhead
+        scalar = np.ndim(overhead) == 0 and np.ndim(design_overhead) == 0
+        overhead, design_overhead = np.broadcast_arrays(
+            np.asarray(overhead, dtype=float),
+            np.asarray(design_overhead, dtype=float),
+        )
 
         # unicast load
         load_1 = overhead - self.server_storage
-        load_2 = 0
+        load_2 = np.zeros(overhead.shape)
         try:
-            for j in range(self.multicast_set_size_1(overhead=design_overhead), self.muq+1):
-                alpha = self.alphaj(j)
-                load_1 -= alpha
+            set_size_1 = np.asarray(self.multicast_set_size_1(overhead=design_overhead))
+            alphas = self.alphas()
+            for j in range(set_size_1.min(), self.muq+1):
+                load_1 = load_1 - np.where(set_size_1 <= j, alphas[j], 0)
         except ModelError:
             pass
 
@@ -416,18 +468,18 @@ class SystemParameters(object):
             overhead=design_overhead,
             multicast_cost=multicast_cost,
         )
-        load_1 += multicast_load_1
-        load_2 += multicast_load_2
+        load_1 = load_1 + multicast_load_1
+        load_2 = load_2 + multicast_load_2
 
         # Return load of the selected strategy
         if strategy == 'best':
-            return min(load_1, load_2)
+            return _scalar_or_array(np.minimum(load_1, load_2), scalar)
         if strategy == '1':
-            return load_1
-        if strategy == '2' and load_2 == math.inf:
+            return _scalar_or_array(load_1, scalar)
+        if strategy == '2' and np.any(load_2 == math.inf):
             raise ModelError('Strategy 2 not available.')
         elif strategy == '2':
-            return load_2
+            return _scalar_or_array(load_2, scalar)
 
     @functools.lru_cache(maxsize=128)
     def computational_delay(self, q=None, parameter=1, scale=None):
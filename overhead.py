@@ -18,19 +18,18 @@
 compute the average performance impact of requiring any set of m(1 + eps)
 unique rows to decode.
 
-The computation is performed exhaustively when possible and via Monte Carlo
-simulations otherwise.
+The batches are labeled by all subsets of muq servers. Any x servers thus
+store the same number of unique rows, and the number of servers needed to
+decode is computed exactly in closed form (see servers_from_overheads()).
 
 '''
 
-import os
-import math
 import random
 import itertools
 import numpy as np
 import pandas as pd
 import model
-import pynumeric
+from assignments.labels import Labels
 
 from functools import lru_cache
 from scipy.special import comb as nchoosek
@@ -39,27 +38,17 @@ def performance_from_overheads(
         overheads,
         parameters=None,
         design_overhead=None):
-    '''sample the performance for each overhead in overheads. returns a
+    '''compute the performance for each overhead in overheads. returns a
     dataframe with length equal to that of overheads.
 
     '''
-    orders = random_completion_orders(parameters, len(overheads))
-    results = list()
-    for (order, overhead) in zip(orders, overheads):
-        result = dict()
-        result.update(
-            delay_from_order(parameters, order, overhead)
-        )
-        result.update(
-            load_from_order(
-                parameters=parameters,
-                overhead=overhead,
-                design_overhead=design_overhead,
-            )
-        )
-        results.append(result)
-
-    return pd.DataFrame(results)
+    df = delay_from_overheads(parameters, overheads)
+    df['load'] = load_from_overheads(
+        parameters=parameters,
+        overheads=overheads,
+        design_overhead=design_overhead,
+    )
+    return df
 
 def performance_from_overhead(parameters=None, overhead=1, design_overhead=None,
                               num_samples=1000, cachedir=None):
@@ -74,56 +63,19 @@ def performance_from_overhead(parameters=None, overhead=1, design_overhead=None,
 
     design_overhead: see mode.unpartitioned_load()
 
-    cachedir: cache simulations here.
+    num_samples: unused. the performance is computed exactly.
 
-    '''
+    cachedir: unused. the number of servers needed at any overhead is
+    computed from a table cached per number of servers and storage (see
+    _rows_by_servers()), which is shared by all overheads and calls.
 
-    # returned a cached simulation if available
-    if cachedir:
-        if not os.path.exists(cachedir):
-            os.makedirs(cachedir)
-        filename = os.path.join(
-            cachedir,
-            parameters.identifier() + '_overhead_' + str(overhead) + '.csv',
-        )
-        try:
-            df = pd.read_csv(filename)
-            if len(df) >= num_samples:
-                return df[:num_samples]
-        except:
-            pass
-
-    # check all possible completion orders or num_samples randomly selected
-    # orders, whichever is smaller.
-    exhaustive_samples = nchoosek(parameters.num_servers, parameters.q)
-    if exhaustive_samples > num_samples:
-        completion_orders = random_completion_orders(parameters, num_samples)
-    else:
-        exhaustive_samples *= math.factorial(parameters.num_servers - parameters.q)
-        if exhaustive_samples <= num_samples:
-            completion_orders = exhaustive_completion_orders(parameters)
-        else:
-            completion_orders = random_completion_orders(parameters, num_samples)
-
-    results = list()
-    for order in completion_orders:
-        result = dict()
-        result.update(
-            delay_from_order(parameters, order, overhead)
-        )
-        result.update(
-            load_from_order(
-                parameters=parameters,
-                overhead=overhead,
-                design_overhead=design_overhead,
-            )
-        )
-        results.append(result)
-
-    # cache the simulation and return
-    df = pd.DataFrame(results)
-    if cachedir:
-        df.to_csv(filename, index=False)
+    '''
+    df = delay_from_overheads(parameters, [overhead])
+    df['load'] = load_from_order(
+        parameters=parameters,
+        overhead=overhead,
+        design_overhead=design_overhead,
+    )['load']
     return df
 
 def random_completion_orders(parameters=None, num_samples=None):
@@ -152,112 +104,99 @@ def _batches_by_server(num_servers=None, servers_per_batch=None):
 
     servers_per_batch: number of servers that each batch is stored at.
 
-    returns: list of length num_servers where each element is a set of the
-    indices of the batches stored by the corresponding server.
+    returns: Labels object, where element i is the set of the indices of
+    the batches stored by server i.
 
     '''
     assert num_servers is not None
     assert servers_per_batch is not None
 
-    # indices of rows stored by each server
-    storage = [set() for _ in range(num_servers)]
-
-    # generate all server labels, e.g., (1,2), (1,3), (1,4), ....
-    labels = itertools.combinations(
-        range(num_servers),
-        int(servers_per_batch),
-    )
-
-    # add batch indices to servers
-    for batch_index, label in enumerate(labels):
-        for server_index in label:
-            storage[server_index].add(batch_index)
-
-    # TODO: We're returning something mutable
+    # label the batches with all server subsets, e.g., (1,2), (1,3), ....
+    storage, _ = Labels.from_combinations(num_servers, servers_per_batch)
     return storage
 
 def _batches_from_order(storage=None, servers=None):
     assert storage is not None
     assert servers is not None
-    batches = set().union(*(storage[server] for server in servers))
-    return batches
+    return storage.batches(storage.union(servers))
 
 def _rows_from_batches(parameters=None, batches=None):
     assert isinstance(parameters, model.SystemParameters)
     assert batches is not None
     return len(batches) * parameters.rows_per_batch
 
+@lru_cache()
+def _rows_by_servers(num_servers, servers_per_batch, rows_per_batch):
+    '''return a read-only array where element x is the number of unique rows
+    stored at any x servers. the batches not stored at any of the x servers
+    are those labeled by a subset of the remaining num_servers - x servers.
+
+    '''
+    num_batches = nchoosek(num_servers, servers_per_batch, exact=True)
+    rows = np.array([
+        (num_batches - nchoosek(num_servers - x, servers_per_batch, exact=True)) * rows_per_batch
+        for x in range(num_servers + 1)
+    ])
+    rows.flags.writeable = False
+    return rows
+
 def rows_from_q(parameters=None, q=None, num_samples=1000):
-    '''compute the average number of unique rows stored at q servers'''
+    '''compute the number of unique rows stored at q servers. num_samples is
+    ignored since the result is exact.'''
     assert isinstance(parameters, model.SystemParameters)
     if q is None:
         q = parameters.q
-    storage = _batches_by_server(
-        num_servers=parameters.num_servers,
-        servers_per_batch=parameters.muq,
+    rows = _rows_by_servers(
+        parameters.num_servers,
+        int(parameters.muq),
+        parameters.rows_per_batch,
     )
+    return float(rows[q])
+
+def servers_from_overheads(parameters=None, overheads=None):
+    '''compute the number of servers needed to decode at each overhead,
+    i.e., the smallest number of servers, at least q, that store at least
+    ceil(m * overhead) unique rows. all servers are needed if no number of
+    servers store enough rows.
 
-    # check all possible completion orders or num_samples randomly selected
-    # orders, whichever is smaller.
-    exhaustive_samples = nchoosek(parameters.num_servers, parameters.q)
-    if exhaustive_samples > num_samples:
-        completion_orders = random_completion_orders(parameters, num_samples)
-    else:
-        exhaustive_samples *= math.factorial(parameters.num_servers - parameters.q)
-        if exhaustive_samples <= num_samples:
-            completion_orders = exhaustive_completion_orders(parameters)
-        else:
-            completion_orders = random_completion_orders(parameters, num_samples)
-
-    results = list()
-    for order in completion_orders:
-        batches = _batches_from_order(storage=storage, servers=order[:q])
-        rows = _rows_from_batches(parameters=parameters, batches=batches)
-        results.append(rows)
-
-    return np.asarray(results).mean()
+    returns: array with the same shape as overheads.
+
+    '''
+    assert isinstance(parameters, model.SystemParameters)
+    assert overheads is not None
+    rows = _rows_by_servers(
+        parameters.num_servers,
+        int(parameters.muq),
+        parameters.rows_per_batch,
+    )
+    required_rows = np.ceil(parameters.num_source_rows * np.asarray(overheads, dtype=float))
+    servers = np.searchsorted(rows, required_rows)
+    return np.clip(servers, parameters.q, parameters.num_servers)
+
+def delay_from_overheads(parameters=None, overheads=None):
+    '''compute the delay for each overhead in overheads.
+
+    returns: dataframe with columns servers, batches and delay, and length
+    equal to that of overheads.
+
+    '''
+    servers = servers_from_overheads(parameters, np.asarray(overheads, dtype=float).reshape(-1))
+    coded_rows_per_server = parameters.num_source_rows * parameters.server_storage
+    batches_per_server = coded_rows_per_server / parameters.rows_per_batch
+    delays = {x: parameters.computational_delay(q=int(x)) for x in np.unique(servers)}
+    return pd.DataFrame({
+        'servers': servers,
+        'batches': servers * batches_per_server,
+        'delay': [delays[x] for x in servers],
+    })
 
 def delay_from_order(parameters=None, order=None, overhead=None):
-    '''compute the delay for some overhead.'''
+    '''compute the delay for some overhead. the result is the same for any
+    completion order.'''
     assert isinstance(parameters, model.SystemParameters)
     assert order is not None
     assert overhead is not None
-    storage = _batches_by_server(
-        num_servers=parameters.num_servers,
-        servers_per_batch=parameters.muq,
-    )
-    required_rows = math.ceil(parameters.num_source_rows * overhead)
-    permanent_x = parameters.q
-    tentative_x = permanent_x
-    permanent = _batches_from_order(storage, order[:parameters.q])
-    tentative = set()
-
-    if _rows_from_batches(parameters, permanent) >= required_rows:
-        coded_rows_per_server = parameters.num_source_rows * parameters.server_storage
-        batches_per_server = coded_rows_per_server / parameters.rows_per_batch
-        return {
-            'servers': parameters.q,
-            'batches': parameters.q * batches_per_server,
-            'delay': parameters.computational_delay(q=parameters.q)
-        }
-
-    def decodeable(x):
-        '''return 1 if decoding is possible with x servers and 0 otherwise'''
-        # TODO: This includes some variables needed to cache previously
-        # computed results. We currently don't do caching, however.
-        nonlocal permanent, tentative, permanent_x, tentative_x
-        nonlocal parameters, storage, order, required_rows
-        batches = _batches_from_order(storage, order[:x])
-        if _rows_from_batches(parameters, batches) >= required_rows:
-            return 1
-        return 0
-
-    required_servers = pynumeric.numinv(
-        fun=decodeable,
-        target=1,
-        lower=parameters.q,
-        upper=parameters.num_servers,
-    )
+    required_servers = int(servers_from_overheads(parameters, overhead))
     coded_rows_per_server = parameters.num_source_rows * parameters.server_storage
     batches_per_server = coded_rows_per_server / parameters.rows_per_batch
     return {
@@ -275,3 +214,16 @@ def load_from_order(parameters=None, overhead=None, design_overhead=None):
         design_overhead=design_overhead,
     )
     return {'load': load}
+
+def load_from_overheads(parameters=None, overheads=None, design_overhead=None):
+    '''compute the load for each overhead in overheads.
+
+    returns: array of loads with length equal to that of overheads.
+
+    '''
+    assert isinstance(parameters, model.SystemParameters)
+    assert overheads is not None
+    return parameters.unpartitioned_load(
+        overhead=np.asarray(overheads, dtype=float),
+        design_overhead=design_overhead,
+    )
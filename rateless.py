@@ -3,7 +3,6 @@
 '''
 
 import math
-import random
 import logging
 import numpy as np
 import pandas as pd
@@ -11,20 +10,63 @@ import pyrateless
 import stats
 import complexity
 import overhead
-import pynumeric
 import tempfile
 import subprocess
+import diskcache
 
 from os import path
+from functools import lru_cache
 from multiprocessing import Pool
 
-def optimize_lt_parameters(num_inputs=None, target_overhead=None,
-                           target_failure_probability=None):
-    '''find good lt code parameters
-
-    returns: a tuple (c, delta, mode)
+# the decoding CDF is tabulated at this many overheads when sampling. the grid
+# spans overheads from 1 to 1 + LT_CDF_INITIAL_OVERHEAD, and the span is
+# doubled until the probability of not decoding at its end is at most
+# LT_CDF_TAIL or the overhead is at least LT_CDF_MAX_OVERHEAD.
+LT_CDF_GRID_SIZE = 1000
+LT_CDF_INITIAL_OVERHEAD = 0.1
+LT_CDF_TAIL = 1e-9
+LT_CDF_MAX_OVERHEAD = 4
+
+# optimized lt code parameters are cached in this directory. change it with
+# set_lt_parameter_cache_directory().
+LT_PARAMETER_CACHE_DIRECTORY = './results/lt_parameters'
+
+# files with simulated LT code decoding complexities by failure probability
+LT_COMPLEXITY_FILES = {
+    1e-1: './results/LT_1e-1.csv',
+    1e-3: './results/LT_1e-3.csv',
+    1e-6: './results/LT_1e-6.csv',
+    1e-9: './results/LT_1e-9.csv',
+}
+
+@lru_cache()
+def _lt_parameter_cache(directory):
+    '''open the on-disk cache of optimized lt code parameters stored in
+    directory. it's safe to share between processes.'''
+    return diskcache.Cache(directory)
+
+def set_lt_parameter_cache_directory(directory):
+    '''store optimized lt code parameters in directory. parameters optimized
+    earlier by this process are looked up in the new directory.'''
+    global LT_PARAMETER_CACHE_DIRECTORY
+    LT_PARAMETER_CACHE_DIRECTORY = directory
+    _optimize_lt_parameters.cache_clear()
+    return
+
+@lru_cache(maxsize=4096)
+def _optimize_lt_parameters(num_inputs, target_overhead, target_failure_probability):
+    '''find good lt code parameters and the mean degree of the resulting
+    Soliton distribution. results are cached in memory and on disk.
+
+    returns: a tuple (c, delta, mode, mean_degree)
 
     '''
+    key = ('lt_parameters', num_inputs, target_overhead, target_failure_probability)
+    cache = _lt_parameter_cache(LT_PARAMETER_CACHE_DIRECTORY)
+    result = cache.get(key)
+    if result is not None:
+        return result
+
     c, delta = pyrateless.heuristic(
         num_inputs=num_inputs,
         target_failure_probability=target_failure_probability,
@@ -37,8 +79,39 @@ def optimize_lt_parameters(num_inputs=None, target_overhead=None,
         delta=delta,
         c=c,
     )
+    mean_degree = pyrateless.Soliton(
+        delta=delta,
+        mode=mode,
+        symbols=num_inputs).mean()
+    result = (c, delta, mode, mean_degree)
+    cache.set(key, result)
+    return result
+
+def optimize_lt_parameters(num_inputs=None, target_overhead=None,
+                           target_failure_probability=None):
+    '''find good lt code parameters. the optimization is performed once per
+    set of arguments and cached on disk (see LT_PARAMETER_CACHE_DIRECTORY).
+
+    returns: a tuple (c, delta, mode)
+
+    '''
+    c, delta, mode, _ = _optimize_lt_parameters(
+        int(num_inputs),
+        float(target_overhead),
+        float(target_failure_probability),
+    )
     return c, delta, mode
 
+def lt_mean_degree(num_inputs=None, target_overhead=None,
+                   target_failure_probability=None):
+    '''return the mean degree of the Soliton distribution with the parameters
+    found by optimize_lt_parameters().'''
+    return _optimize_lt_parameters(
+        int(num_inputs),
+        float(target_overhead),
+        float(target_failure_probability),
+    )[3]
+
 def lt_encoding_complexity(num_inputs=None, failure_prob=None,
                            target_overhead=None, code_rate=None):
     '''Return the decoding complexity of LT codes. Computed from the
@@ -54,17 +127,17 @@ def lt_encoding_complexity(num_inputs=None, failure_prob=None,
     if num_inputs == 2:
         mode = 2
         delta = 0.9999999701976676
+        avg_degree = pyrateless.Soliton(
+            delta=delta,
+            mode=mode,
+            symbols=num_inputs).mean()
     else:
-        c, delta, mode = optimize_lt_parameters(
+        avg_degree = lt_mean_degree(
             num_inputs=num_inputs,
             target_overhead=target_overhead,
             target_failure_probability=failure_prob,
         )
 
-    avg_degree = pyrateless.Soliton(
-        delta=delta,
-        mode=mode,
-        symbols=num_inputs).mean()
     encoding_complexity = pyrateless.optimize.complexity.encoding_additions(
         avg_degree,
         code_rate,
@@ -79,58 +152,104 @@ def lt_encoding_complexity(num_inputs=None, failure_prob=None,
     ) * complexity.MULTIPLICATION_COMPLEXITY
     return encoding_complexity
 
-def lt_decoding_complexity(num_inputs=None, failure_prob=None,
-                           target_overhead=None):
-    '''Return the decoding complexity of LT codes. Data is manually
-    entered from simulations carried out using
-    https://github.com/severinson/RaptorCodes
+@lru_cache()
+def _lt_decoding_complexity_index(failure_prob):
+    '''load the simulated decoding complexities for some failure probability.
+    the file is parsed once per process.
 
-    '''
+    returns: a dict mapping num_inputs to a tuple (overheads, operations)
+    of arrays sorted by overhead, where the overhead is counted in symbols
+    and operations has columns with the number of additions and
+    multiplications. the complexity constants aren't applied here since
+    they may change between lookups. None if there are no results for this
+    failure probability.
 
-    # maps a tuple (num_inputs, target_failure_probability,
-    # target_overhead) to a tuple (num_inactivations,
-    # num_row_operations). contains simulated results.
-    if failure_prob == 1e-1:
-        filename = './results/LT_1e-1.csv'
-    elif failure_prob == 1e-3:
-        filename = './results/LT_1e-3.csv'
-    elif failure_prob == 1e-6:
-        filename = './results/LT_1e-6.csv'
-    elif failure_prob == 1e-9:
-        filename = './results/LT_1e-9.csv'
-    else:
+    '''
+    filename = LT_COMPLEXITY_FILES.get(failure_prob)
+    if filename is None:
         logging.error('no results for tfp={}'.format(failure_prob))
-
+        return None
     try:
         df = pd.read_csv(filename)
     except:
         logging.error('could not load file {}.'.format(filename))
-        return math.inf
+        return None
+
+    a = df[[
+        'diagonalize_decoding_additions', 'diagonalize_rowadds',
+        'solve_dense_decoding_additions', 'solve_dense_rowadds',
+        'backsolve_decoding_additions', 'backsolve_rowadds',
+    ]].sum(axis=1)
+    m = df[[
+        'diagonalize_decoding_multiplications', 'diagonalize_rowmuls',
+        'solve_dense_decoding_multiplications', 'solve_dense_rowmuls',
+        'backsolve_decoding_multiplications', 'backsolve_rowmuls',
+    ]].sum(axis=1)
+    df = df.assign(additions=a, multiplications=m)
+
+    # average any repeated simulations of the same point
+    df = df.groupby(['num_inputs', 'overhead'])[['additions', 'multiplications']].mean()
+    df = df.reset_index()
+    index = dict()
+    for num_inputs, group in df.groupby('num_inputs'):
+        index[num_inputs] = (
+            group['overhead'].values,
+            group[['additions', 'multiplications']].values,
+        )
+    return index
 
+def _interpolate_overhead(index, num_inputs, target_overhead):
+    '''interpolate the number of additions and multiplications needed to
+    decode num_inputs symbols between the simulated overheads. returns None
+    if the overhead is out of range.'''
+    overheads, operations = index[num_inputs]
     overhead = round(num_inputs*(target_overhead-1))
-    df = df.loc[df['num_inputs'] == num_inputs]
-    df = df.loc[df['overhead'] == overhead]
-    if len(df) != 1:
+    if not overheads[0] <= overhead <= overheads[-1]:
+        return None
+    return np.array([
+        np.interp(overhead, overheads, operations[:, 0]),
+        np.interp(overhead, overheads, operations[:, 1]),
+    ])
+
+def lt_decoding_complexity(num_inputs=None, failure_prob=None,
+                           target_overhead=None):
+    '''Return the decoding complexity of LT codes. Data is manually
+    entered from simulations carried out using
+    https://github.com/severinson/RaptorCodes
+
+    Points that weren't simulated are linearly interpolated between the
+    simulated overheads, and between the closest simulated numbers of inputs
+    if num_inputs wasn't simulated. Returns math.inf if the point is out of
+    the range of the simulations.
+
+    '''
+    index = _lt_decoding_complexity_index(failure_prob)
+    if index is None:
+        return math.inf
+
+    if num_inputs in index:
+        operations = _interpolate_overhead(index, num_inputs, target_overhead)
+    else:
+        operations = None
+        simulated = sorted(index)
+        i = np.searchsorted(simulated, num_inputs)
+        if 0 < i < len(simulated):
+            lower, upper = simulated[i-1], simulated[i]
+            lower_operations = _interpolate_overhead(index, lower, target_overhead)
+            upper_operations = _interpolate_overhead(index, upper, target_overhead)
+            if lower_operations is not None and upper_operations is not None:
+                weight = (num_inputs - lower) / (upper - lower)
+                operations = lower_operations + weight * (upper_operations - lower_operations)
+
+    if operations is None:
         logging.warning(
-            'did not find exactly 1 row for num_inputs={}, failure_prob={}, target_overhead=: {} symbols'.format(
-                num_inputs, failure_prob, overhead, df,))
+            'no results near num_inputs={}, failure_prob={}, target_overhead={}'.format(
+                num_inputs, failure_prob, target_overhead))
         return math.inf
 
-    a = df['diagonalize_decoding_additions']
-    a += df['diagonalize_rowadds']
-    a += df['solve_dense_decoding_additions']
-    a += df['solve_dense_rowadds']
-    a += df['backsolve_decoding_additions']
-    a += df['backsolve_rowadds']
-    a = a.values[0]
-    m = df['diagonalize_decoding_multiplications']
-    m += df['diagonalize_rowmuls']
-    m += df['solve_dense_decoding_multiplications']
-    m += df['solve_dense_rowmuls']
-    m += df['backsolve_decoding_multiplications']
-    m += df['backsolve_rowmuls']
-    m = m.values[0]
-    return a*complexity.ADDITION_COMPLEXITY + m*complexity.MULTIPLICATION_COMPLEXITY
+    additions, multiplications = operations
+    return float(additions * complexity.ADDITION_COMPLEXITY +
+                 multiplications * complexity.MULTIPLICATION_COMPLEXITY)
 
 def evaluate(parameters, target_overhead=None,
              target_failure_probability=None,
@@ -274,16 +393,16 @@ def lt_success_pdf(overhead_levels, num_inputs=None, mode=None, delta=None):
     decoding_pdf = np.diff(decoding_cdf)
     return decoding_pdf
 
-def lt_success_samples(n, target_overhead=None, num_inputs=None, mode=None, delta=None):
-    '''sample the decoding probability distribution.
+@lru_cache()
+def lt_inverse_cdf_table(num_inputs=None, mode=None, delta=None):
+    '''evaluate the decoding success CDF on a grid of overheads starting at 1
+    and ending where decoding is almost certain.
+
+    returns: two read-only arrays (cdf, overheads), where cdf is strictly
+    increasing and overheads[i] is the smallest grid overhead at which the
+    probability of decoding is at least cdf[i].
 
     '''
-    assert n > 0
-    assert n % 1 == 0
-    if target_overhead is None:
-        target_overhead = 1
-    # create a distribution object. this is needed for the decoding success
-    # probability estimate.
     soliton = pyrateless.Soliton(
         symbols=num_inputs,
         mode=mode,
@@ -295,13 +414,45 @@ def lt_success_samples(n, target_overhead=None, num_inputs=None, mode=None, delt
         overhead=x,
     )
 
-    # with Pool(processes=12) as pool:
-    samples = np.fromiter((
-        pynumeric.cnuminv(
-            fun=cdf,
-            target=random.random(),
-            lower=target_overhead,
-        ) for _ in range(n)), dtype=float)
+    # double the grid until decoding is almost certain at its end
+    upper = 1 + LT_CDF_INITIAL_OVERHEAD
+    while cdf(upper) < 1 - LT_CDF_TAIL and upper < LT_CDF_MAX_OVERHEAD:
+        upper = 1 + 2 * (upper - 1)
+
+    overheads = np.linspace(1, upper, LT_CDF_GRID_SIZE)
+    values = np.maximum.accumulate(np.fromiter(
+        (cdf(x) for x in overheads), dtype=float, count=len(overheads),
+    ))
+
+    # keep the first overhead reaching each value to make the CDF strictly
+    # increasing, which is needed for interpolating its inverse.
+    values, index = np.unique(values, return_index=True)
+    overheads = overheads[index]
+    values.flags.writeable = False
+    overheads.flags.writeable = False
+    return values, overheads
+
+def lt_success_samples(n, target_overhead=None, num_inputs=None, mode=None,
+                       delta=None, rng=None):
+    '''sample the decoding probability distribution by inverting a tabulated
+    decoding CDF (see lt_inverse_cdf_table()).
+
+    rng: numpy.random.Generator used to draw the samples. a new generator is
+    created if None.
+
+    '''
+    assert n > 0
+    assert n % 1 == 0
+    if target_overhead is None:
+        target_overhead = 1
+    if rng is None:
+        rng = np.random.default_rng()
+    values, overheads = lt_inverse_cdf_table(
+        num_inputs=num_inputs,
+        mode=mode,
+        delta=delta,
+    )
+    samples = np.interp(rng.random(int(n)), values, overheads)
     return np.maximum(samples, target_overhead)
 
 def random_fountain_success_pdf(overhead_levels, field_size=2, num_inputs=None, mode=None, delta=None):
@@ -335,6 +486,11 @@ def performance_integral(parameters=None, num_inputs=None, target_overhead=None,
     num_overhead_levels: performance is evaluated at num_overhead_levels levels
     of overhead between target_overhead and the maximum possible overhead.
 
+    cachedir: unused. the delay is computed exactly for all levels at once
+    (see overhead.delay_from_overheads()), and the table it's computed from
+    is cached and shared by all calls with the same number of servers and
+    storage (see overhead._rows_by_servers()).
+
     '''
     if pdf_fun is None:
         pdf_fun = lt_success_pdf
@@ -358,30 +514,22 @@ def performance_integral(parameters=None, num_inputs=None, target_overhead=None,
         delta=delta,
     )
 
-    # compute load/delay at the levels of overhead
-    results = list()
-    for overhead_level, decoding_probability in zip(overhead_levels, decoding_probabilities):
-
-        # monte carlo simulation of the load/delay at this overhead
-        df = overhead.performance_from_overhead(
-            parameters=parameters,
-            overhead=overhead_level,
-            design_overhead=target_overhead,
-            cachedir=cachedir,
-        )
-
-        # average the columns of the df
-        result = {label:df[label].mean() for label in df}
-
-        # multiply by the probability of decoding at this overhead level
-        for label in result:
-            result[label] *= decoding_probability
+    # the load is deterministic. compute it for all levels at once.
+    loads = overhead.load_from_overheads(
+        parameters=parameters,
+        overheads=overhead_levels,
+        design_overhead=target_overhead,
+    )
 
-        results.append(result)
+    # the delay at all levels of overhead
+    df = overhead.delay_from_overheads(
+        parameters=parameters,
+        overheads=overhead_levels,
+    )
+    df['load'] = loads
 
-    # create a dataframe and sum along the columns
-    df = pd.DataFrame(results)
-    return {label:df[label].sum() for label in df}
+    # weigh each level by the probability of decoding at it and sum
+    return {label:(df[label] * decoding_probabilities).sum() for label in df}
 
 def order_pdf(parameters=None,
               target_overhead=None,
@@ -393,8 +541,10 @@ def order_pdf(parameters=None,
     '''simulate the order PDF, i.e., the PDF over the number of servers needed to
     decode successfully.
 
-    num_samples: total number of samples to take of the number of servers
-    needed. the PDF is inferred from all samples.
+    num_samples: unused. the number of servers needed at each level of
+    overhead is computed exactly (see overhead.servers_from_overheads()).
+
+    cachedir: unused for the same reason.
 
     returns: two arrays (order_values, order_probabilities) with the possible
     number of servers needed and the probability of needing that number of
@@ -434,33 +584,11 @@ def order_pdf(parameters=None,
         delta=delta,
     )
 
-    # simulate the number of servers needed at each level of overhead. the
-    # number of samples taken is weighted by the probability of needing this
-    # overhead.
-    results = list()
-    for overhead_level, decoding_probability in zip(overhead_levels, decoding_probabilities):
-
-        # the number of samples correspond to the probability of decoding at
-        # this level of overhead.
-        overhead_samples = int(round(decoding_probability * num_samples))
-
-        # monte carlo simulation of the load/delay at this overhead
-        df = overhead.performance_from_overhead(
-            parameters=parameters,
-            overhead=overhead_level,
-            design_overhead=target_overhead,
-            num_samples=overhead_samples,
-            cachedir=cachedir,
-        )
-        results.append(df)
-
-    # concatenate all samples into a single dataframe
-    samples = pd.concat(results, ignore_index=True)
-    print('rateless samples', samples)
-
-    # compute the empiric order cdf and return
-    order_count = samples['servers'].value_counts(normalize=True)
-    order_count.sort_index(inplace=True)
+    # the number of servers needed at each level of overhead. the probability
+    # of needing some number of servers is the total probability of the
+    # levels of overhead that need it.
+    servers = overhead.servers_from_overheads(parameters, overhead_levels)
+    order_count = pd.Series(decoding_probabilities).groupby(servers).sum()
     order_values = np.array(order_count.index)
-    order_probabilities = order_count.values
+    order_probabilities = order_count.values / order_count.values.sum()
     return order_values, order_probabilities
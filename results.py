@@ -0,0 +1,337 @@
+############################################################################
+# Copyright 2017 Albin Severinson                                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+'''This module provides an append-only store for simulation results. Results
+are stored in Parquet files, with each row tagged by the identifier of the
+parameters it was simulated for (see SystemParameters.identifier()).
+
+Every append writes a new part file atomically, meaning that several
+processes may append to the same store concurrently. Part files are merged
+into a single file once there are more than MAX_PARTS of them. If results for
+an identifier are appended several times, the most recent results are used.
+
+Results stored in the per-identifier CSV files used previously are imported
+into the store the first time they're requested.
+
+'''
+
+import os
+import time
+import uuid
+import logging
+import threading
+import collections
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# merge the part files once there are more than this many of them
+MAX_PARTS = 64
+
+# name of the column storing the parameters identifier
+IDENTIFIER = 'identifier'
+
+# number of results kept in memory by each store
+CACHE_SIZE = 32
+
+class ResultsStore(object):
+    '''Append-only results store backed by Parquet files.
+
+    '''
+
+    def __init__(self, directory):
+        '''Create a results store.
+
+        Args:
+
+        directory: Directory to store results in. Part files are stored in its
+        store subdirectory.
+
+        '''
+        assert isinstance(directory, str)
+        self.directory = directory
+        self.path = os.path.join(directory, 'store')
+        self._lock = threading.RLock()
+        self._index = dict()
+        self._indexed = set()
+        self._cache = collections.OrderedDict()
+        return
+
+    def _files(self):
+        '''Return the part files of this store, oldest first.'''
+        try:
+            filenames = os.listdir(self.path)
+        except FileNotFoundError:
+            return list()
+        return sorted(filename for filename in filenames if filename.endswith('.parquet'))
+
+    def _refresh(self):
+        '''Index any part files written since the last refresh. Only the
+        identifier column of each file is read.
+
+        '''
+        with self._lock:
+            files = self._files()
+            for filename in files:
+                if filename in self._indexed:
+                    continue
+                try:
+                    table = pq.read_table(
+                        os.path.join(self.path, filename),
+                        columns=[IDENTIFIER],
+                    )
+                except FileNotFoundError:
+                    # removed by a merge in another process
+                    continue
+                for identifier in set(table.column(IDENTIFIER).to_pylist()):
+                    self._index[identifier] = filename
+                    self._cache.pop(identifier, None)
+                self._indexed.add(filename)
+
+            # drop files removed by a merge
+            removed = self._indexed - set(files)
+            if removed:
+                self._indexed -= removed
+                self._index = {
+                    identifier: filename
+                    for identifier, filename in self._index.items()
+                    if filename not in removed
+                }
+                self._indexed.clear()
+                self._refresh()
+        return
+
+    def _cache_put(self, identifier, dataframe):
+        '''Cache the results of an identifier, evicting the least recently
+        used results if there are more than CACHE_SIZE of them.
+
+        '''
+        with self._lock:
+            self._cache[identifier] = dataframe
+            self._cache.move_to_end(identifier)
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return
+
+    def contains(self, identifier):
+        '''Return True if there are results stored for identifier.'''
+        with self._lock:
+            if identifier in self._index:
+                return True
+            self._refresh()
+            return identifier in self._index or os.path.isfile(self._legacy_filename(identifier))
+
+    def _legacy_filename(self, identifier):
+        return os.path.join(self.directory, identifier + '.csv')
+
+    def _import_legacy(self, identifier):
+        '''Import results from a legacy CSV file. Returns None if there is no
+        such file.
+
+        '''
+        try:
+            dataframe = pd.read_csv(self._legacy_filename(identifier))
+        except FileNotFoundError:
+            return None
+        dataframe = dataframe.drop(columns=['Unnamed: 0'], errors='ignore')
+        logging.debug('Importing %s into the results store.', self._legacy_filename(identifier))
+        self.append(identifier, dataframe)
+        return dataframe
+
+    def _read(self, filename, identifiers, columns=None):
+        '''Read the rows of some identifiers from a part file.
+
+        Returns: Dict mapping identifiers to dataframes.
+
+        '''
+        if columns is not None:
+            columns = list(columns) + [IDENTIFIER]
+        table = pq.read_table(
+            os.path.join(self.path, filename),
+            columns=columns,
+            filters=[(IDENTIFIER, 'in', list(identifiers))],
+        )
+        dataframe = table.to_pandas()
+        return {
+            identifier: group.drop(columns=[IDENTIFIER]).reset_index(drop=True)
+            for identifier, group in dataframe.groupby(IDENTIFIER, sort=False)
+        }
+
+    def load(self, identifier, columns=None):
+        '''Load the results stored for an identifier.
+
+        Args:
+
+        identifier: Parameters identifier.
+
+        columns: Columns to read. All columns are read if None.
+
+        Returns: A DataFrame with the results, or None if there are no results
+        for this identifier.
+
+        '''
+        return self.load_many([identifier], columns=columns).get(identifier)
+
+    def load_many(self, identifiers, columns=None):
+        '''Load the results stored for several identifiers. Each part file is
+        read at most once.
+
+        Args:
+
+        identifiers: Iterable of parameters identifiers.
+
+        columns: Columns to read. All columns are read if None.
+
+        Returns: A dict mapping identifiers to DataFrames. Identifiers without
+        stored results are left out.
+
+        '''
+        identifiers = list(identifiers)
+        with self._lock:
+            if any(identifier not in self._index for identifier in identifiers):
+                self._refresh()
+
+            results = dict()
+            by_file = dict()
+            for identifier in identifiers:
+                if columns is None and identifier in self._cache:
+                    self._cache.move_to_end(identifier)
+                    results[identifier] = self._cache[identifier]
+                elif identifier in self._index:
+                    by_file.setdefault(self._index[identifier], set()).add(identifier)
+
+            for filename, file_identifiers in by_file.items():
+                try:
+                    dataframes = self._read(filename, file_identifiers, columns=columns)
+                except FileNotFoundError:
+                    # the file was merged by another process
+                    self._refresh()
+                    return self.load_many(identifiers, columns=columns)
+                for identifier, dataframe in dataframes.items():
+                    results[identifier] = dataframe
+                    if columns is None:
+                        self._cache_put(identifier, dataframe)
+
+        for identifier in identifiers:
+            if identifier in results:
+                continue
+            dataframe = self._import_legacy(identifier)
+            if dataframe is not None:
+                results[identifier] = dataframe
+
+        return {identifier: results[identifier].copy() for identifier in results}
+
+    def append(self, identifier, dataframe):
+        '''Append results to the store. The results replace any results
+        previously stored for the identifier.
+
+        Args:
+
+        identifier: Parameters identifier.
+
+        dataframe: DataFrame with the results.
+
+        '''
+        assert isinstance(identifier, str)
+        assert isinstance(dataframe, pd.DataFrame)
+        dataframe = dataframe.reset_index(drop=True)
+        table = pa.Table.from_pandas(
+            dataframe.assign(**{IDENTIFIER: identifier}),
+            preserve_index=False,
+        )
+        filename = self._write(table)
+        with self._lock:
+            self._index[identifier] = filename
+            self._indexed.add(filename)
+            self._cache_put(identifier, dataframe.copy())
+            if len(self._indexed) > MAX_PARTS:
+                self.merge()
+        return
+
+    def _write(self, table, timestamp=None):
+        '''Atomically write a table to a new part file.
+
+        Returns: The name of the new file.
+
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        if timestamp is None:
+            timestamp = time.time_ns()
+        filename = '{:020d}-{}.parquet'.format(timestamp, uuid.uuid4().hex)
+        tmpfilename = os.path.join(self.path, '.' + filename + '.tmp')
+        pq.write_table(table, tmpfilename)
+        os.replace(tmpfilename, os.path.join(self.path, filename))
+        return filename
+
+    def merge(self):
+        '''Merge all part files into a single file, keeping only the most
+        recent results for each identifier.
+
+        '''
+        with self._lock:
+            self._refresh()
+            files = sorted(self._indexed)
+            if len(files) < 2:
+                return
+
+            # read the latest rows for each identifier
+            tables = list()
+            for filename in files:
+                identifiers = [
+                    identifier for identifier, latest in self._index.items()
+                    if latest == filename
+                ]
+                if not identifiers:
+                    continue
+                try:
+                    tables.append(pq.read_table(
+                        os.path.join(self.path, filename),
+                        filters=[(IDENTIFIER, 'in', identifiers)],
+                    ))
+                except FileNotFoundError:
+                    # another process is merging the files
+                    return
+            table = pa.concat_tables(tables, promote_options='default')
+
+            # the merged file takes the place of the newest merged file such
+            # that results appended concurrently take precedence.
+            timestamp = int(files[-1].split('-')[0])
+            merged = self._write(table, timestamp=timestamp)
+            for filename in files:
+                try:
+                    os.remove(os.path.join(self.path, filename))
+                except FileNotFoundError:
+                    pass
+
+            self._indexed = {merged}
+            self._index = {identifier: merged for identifier in self._index}
+            logging.debug('Merged %d files of results store %s.', len(files), self.path)
+        return
+
+# stores opened by this process
+_stores = dict()
+_stores_lock = threading.Lock()
+
+def get_store(directory):
+    '''Return the results store of a directory. The same object is returned
+    for every call with the same directory.
+
+    '''
+    key = os.path.abspath(directory)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = ResultsStore(directory)
+        return _stores[key]
@@ -30,21 +30,20 @@ import scipy.stats
 import complexity
 import model
 import stats
+import results
+import evaluation.executor
 
 from functools import partial
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from solvers import Solver
 from model import SystemParameters
 from assignments.sparse import SparseAssignment
 from evaluation import AssignmentEvaluator
 
-# create a process and thread pool executor for this module. these are used to
-# increase computing and I/O throughput, respectively.
-# there is a bug when using more than 1 worker:
-# https://bitbucket.org/pypy/pypy/issues/2530/segfault-with-threadpool-pandas-when
-process_pool = Pool(processes=12)
-thread_executor = ThreadPoolExecutor(max_workers=1)
+# create a thread pool executor for this module. it's used to increase I/O
+# throughput when loading cached results. simulations are run in a process
+# pool (see run_sweep()).
+thread_executor = ThreadPoolExecutor(max_workers=8)
 
 def completion_cdf(x, distributions=None, probabilities=None):
     '''CDF of the computational delay.
@@ -161,13 +160,15 @@ def cdf_from_samples(samples, loc=None, n=1):
 
 def delay_samples(dataframe, num_samples=100000, parameters=None, map_complexity_fun=None,
                   encode_complexity_fun=None, reduce_complexity_fun=None,
-                  order_values=None, order_probabilities=None):
+                  order_values=None, order_probabilities=None, method='gamma',
+                  rng=None):
     '''find the delay distribution via Monte Carlo simulations
 
     args:
 
     dataframe: dataframe of performance samples. used to infer the PDF over the
-    number of servers needed to decode.
+    number of servers needed to decode. rows are weighted by the 'weight'
+    column if there is one.
 
     num_sample: number of samples to take.
 
@@ -191,6 +192,12 @@ def delay_samples(dataframe, num_samples=100000, parameters=None, map_complexity
     corresponding number of servers in order_values. inferred from the
     dataframe if None.
 
+    method: 'gamma' approximates the order statistics by gamma distributions.
+    'exact' samples them exactly (see stats.order_samples_shiftexp()).
+
+    rng: numpy.random.Generator used to draw all samples. a new generator is
+    created if None.
+
     returns: array or samples drawn from the overall delay distribution.
 
     '''
@@ -209,6 +216,9 @@ def delay_samples(dataframe, num_samples=100000, parameters=None, map_complexity
     else:
         assert order_values is not None
         assert len(order_values) == len(order_probabilities)
+    assert method in ['gamma', 'exact'], method
+    if rng is None:
+        rng = np.random.default_rng()
 
     samples = np.zeros(num_samples)
 
@@ -219,18 +229,22 @@ def delay_samples(dataframe, num_samples=100000, parameters=None, map_complexity
             total=parameters.num_servers,
             order=parameters.num_servers,
         )
-        samples += encoding_distribution.sample(n=num_samples)
+        samples += encoding_distribution.sample(n=num_samples, method=method, rng=rng)
     if reduce_complexity_fun:
         reduce_distribution = stats.ShiftexpOrder(
             parameter=reduce_complexity_fun(parameters) / parameters.q,
             total=parameters.q,
             order=parameters.q,
         )
-        samples += reduce_distribution.sample(n=num_samples)
+        samples += reduce_distribution.sample(n=num_samples, method=method, rng=rng)
 
     # next, get the empiric PDF of the number of servers we need to wait for in
     # the map phase (if it wasn't provided)
-    if order_values is None:
+    if order_values is None and 'weight' in dataframe:
+        order_counts = dataframe.groupby('servers')['weight'].sum()
+        order_values = order_counts.index
+        order_probabilities = order_counts.values / order_counts.values.sum()
+    elif order_values is None:
         order_counts = dataframe['servers'].value_counts(normalize=True)
         order_values = order_counts.index
         order_probabilities = order_counts.values
@@ -240,12 +254,8 @@ def delay_samples(dataframe, num_samples=100000, parameters=None, map_complexity
     # phase.
     i = 0
     a = 0
+    orders = np.zeros(num_samples, dtype=np.int64)
     for order, probability in zip(order_values, order_probabilities):
-        map_distribution = stats.ShiftexpOrder(
-            parameter=map_complexity_fun(parameters),
-            total=parameters.num_servers,
-            order=order,
-        )
         a += num_samples*probability
         num_order_samples = min(
             num_samples-i,
@@ -253,10 +263,30 @@ def delay_samples(dataframe, num_samples=100000, parameters=None, map_complexity
         )
         if num_order_samples <= 0:
             continue
-        samples[i:i+num_order_samples] += map_distribution.sample(n=num_order_samples)
+        if method == 'gamma':
+            map_distribution = stats.ShiftexpOrder(
+                parameter=map_complexity_fun(parameters),
+                total=parameters.num_servers,
+                order=order,
+            )
+            samples[i:i+num_order_samples] += map_distribution.sample(
+                n=num_order_samples,
+                rng=rng,
+            )
+        orders[i:i+num_order_samples] = order
         i += num_order_samples
         a -= num_order_samples
 
+    # the exact samples of all orders are drawn at once
+    if method == 'exact':
+        samples[:i] += stats.order_samples_shiftexp(
+            parameters.num_servers,
+            orders[:i],
+            parameter=map_complexity_fun(parameters),
+            n=i,
+            rng=rng,
+        )
+
     # normalize the values
     samples /= parameters.num_source_rows * parameters.num_outputs
 
@@ -288,13 +318,24 @@ def set_load(dataframe, strategy='best'):
         dataframe['load'] = load_best
     return dataframe
 
+def weighted_mean(dataframe, column):
+    '''return the average of a column, weighted by the 'weight' column if the
+    dataframe has one (see evaluation.binsearch.SampleEvaluator).
+
+    '''
+    if 'weight' not in dataframe:
+        return dataframe[column].mean()
+    weight = dataframe['weight']
+    return (dataframe[column] * weight).sum() / weight.sum()
+
 def flatten_dataframes(dataframe_iter):
     '''flatten an iterable of dataframes by creating a new dataframe where the i-th
     row is the average of all columns from the i-th dataframe in the list.
+    rows are weighted by the 'weight' column if there is one.
 
     '''
     return pd.DataFrame([
-        {column:dataframe[column].mean() for column in dataframe}
+        {column:weighted_mean(dataframe, column) for column in dataframe}
         for dataframe in dataframe_iter
     ])
 
@@ -320,7 +361,9 @@ def simulate_parameter_list(parameter_list=None,
                             simulate_fun=None,
                             map_complexity_fun=None,
                             encode_delay_fun=None,
-                            reduce_delay_fun=None):
+                            reduce_delay_fun=None,
+                            directory=None,
+                            processes=None):
     '''Run simulations for a list of parameters.
 
     args
@@ -346,6 +389,14 @@ def simulate_parameter_list(parameter_list=None,
     reduce_delay_fun: function that takes parameters as its single argument and
     returns the delay of the reduce phase. set to False if not applicable.
 
+    directory: results directory of simulate_fun. the stored results of all
+    parameters are loaded in a single bulk read before running the
+    simulations. if None, the directory keyword argument of simulate_fun is
+    used if simulate_fun is a functools.partial object.
+
+    processes: number of processes to run simulations in. defaults to the
+    number of CPUs. see run_sweep().
+
     '''
     assert parameter_list is not None
     assert callable(simulate_fun), simulate_fun
@@ -354,9 +405,28 @@ def simulate_parameter_list(parameter_list=None,
     assert callable(reduce_delay_fun) or reduce_delay_fun is False, reduce_delay_fun
     logging.info('Running simulations for %d parameters.', len(parameter_list))
 
-    # run simulations for all parameters. we use a thread pool as most of the
-    # time is spent waiting for I/O when loading cached results from disk.
-    dataframe_iter = thread_executor.map(simulate_fun, parameter_list)
+    # load all stored results at once. simulate() finds them in the cache of
+    # the results store.
+    keywords = simulate_fun.keywords if isinstance(simulate_fun, partial) else dict()
+    if directory is None:
+        directory = keywords.get('directory')
+    cached = set()
+    if directory is not None and not keywords.get('rerun', False):
+        stored = results.get_store(directory).load_many(
+            parameters.identifier() for parameters in parameter_list
+        )
+        cached = {
+            i for i, parameters in enumerate(parameter_list)
+            if parameters.identifier() in stored
+        }
+
+    # run simulations for all parameters
+    dataframe_iter = run_sweep(
+        simulate_fun,
+        parameter_list,
+        cached=cached,
+        processes=processes,
+    )
 
     # recompute the delay of the map phase if a ratio is given
     if tail_scale is not None:
@@ -405,6 +475,94 @@ def simulate_parameter_list(parameter_list=None,
 
     return dataframe
 
+def simulation_cost(parameters):
+    '''estimate of the relative time needed to simulate a set of parameters.'''
+    return parameters.num_batches * parameters.num_servers
+
+def _init_sweep_worker():
+    '''evaluate assignments serially in sweep workers since the sweep already
+    keeps all CPUs busy. the executor inherited from the parent is discarded
+    when forking, so this never touches the pool of the parent.'''
+    evaluation.executor.configure(processes=1)
+    return
+
+def run_sweep(simulate_fun, parameter_list, cached=(), processes=None):
+    '''apply simulate_fun to every parameters object in parameter_list.
+
+    parameters with cached results are loaded using the thread pool of this
+    module. all other parameters are simulated in a process pool, with the
+    most expensive parameters (see simulation_cost()) scheduled first. the
+    progress of the sweep is logged as results come in.
+
+    args:
+
+    simulate_fun: function to apply to each SystemParameters object. must be
+    picklable unless processes is 1.
+
+    parameter_list: list of SystemParameters.
+
+    cached: indices into parameter_list of parameters with cached results.
+
+    processes: number of processes to simulate in. defaults to the number of
+    CPUs. if 1, simulations are run one at a time in the calling process.
+
+    returns: list of the results of simulate_fun, in the order of
+    parameter_list.
+
+    '''
+    assert callable(simulate_fun), simulate_fun
+    if processes is None:
+        processes = os.cpu_count()
+    assert isinstance(processes, int) and processes > 0, processes
+    cached = set(cached)
+    misses = sorted(
+        (i for i in range(len(parameter_list)) if i not in cached),
+        key=lambda i: simulation_cost(parameter_list[i]),
+        reverse=True,
+    )
+    total_cost = sum(simulation_cost(parameter_list[i]) for i in misses)
+    logging.info('Sweep of %d parameters: %d cached, %d to simulate.',
+                 len(parameter_list), len(parameter_list) - len(misses), len(misses))
+
+    if processes > 1:
+        sweep_executor = ProcessPoolExecutor(
+            max_workers=min(processes, max(len(misses), 1)),
+            initializer=_init_sweep_worker,
+        )
+    else:
+        sweep_executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        # submit the misses first. the sweep workers are forked on the first
+        # submit, which must happen before the threads loading cached results
+        # start, since they may hold the lock of the results store.
+        futures = dict()
+        for i in misses:
+            futures[sweep_executor.submit(simulate_fun, parameter_list[i])] = i
+        for i in range(len(parameter_list)):
+            if i in cached:
+                futures[thread_executor.submit(simulate_fun, parameter_list[i])] = i
+
+        dataframes = [None] * len(parameter_list)
+        start = datetime.datetime.now()
+        completed_cost = 0
+        for completed, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            dataframes[i] = future.result()
+            if i in cached:
+                continue
+            completed_cost += simulation_cost(parameter_list[i])
+            elapsed = datetime.datetime.now() - start
+            eta = elapsed * ((total_cost - completed_cost) / completed_cost)
+            logging.info(
+                'Sweep progress: %d/%d parameters done in %s. ETA: %s.',
+                completed, len(parameter_list), elapsed, eta,
+            )
+    finally:
+        sweep_executor.shutdown(cancel_futures=True)
+
+    return dataframes
+
 def parameter_sample(i, parameters=None, parameter_eval=None):
     assert i >= 0 and i % 1 == 0
     assert parameters is not None
@@ -459,7 +617,8 @@ def simulate(parameters, directory='./results/', rerun=False, samples=None,
 
     parameters: SystemParameters to simulate.
 
-    directory: directory to store results in.
+    directory: directory to store results in. results are stored in a
+    results.ResultsStore in this directory.
 
     rerun: rerun simulations even if there are results on disk.
 
@@ -509,22 +668,13 @@ def simulate(parameters, directory='./results/', rerun=False, samples=None,
     if assignment_type is None:
         assignment_type = SparseAssignment
 
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
     # first, attempt to return a cached result
-    filename = os.path.join(directory, parameters.identifier() + '.csv')
+    store = results.get_store(directory)
     if not rerun:
-        try:
-            dataframe = pd.read_csv(filename)
-
+        dataframe = store.load(parameters.identifier())
+        if dataframe is not None:
             # add the system parameters to the dataframe
-            for key, value in parameters.asdict().items():
-                dataframe[key] = value
-
-            return dataframe
-        except FileNotFoundError:
-            pass
+            return dataframe.assign(**parameters.asdict())
 
     best_assignment = None
     best_avg_load = math.inf
@@ -548,14 +698,11 @@ def simulate(parameters, directory='./results/', rerun=False, samples=None,
 
     # run simulations in parallel using a process pool
     # with Pool(processes=8) as pool:
-    results = map(f, range(samples))
+    dataframes = map(f, range(samples))
 
     # concatenate the DataFrames and write the result to disk
-    dataframe = pd.concat(results)
-    dataframe.to_csv(filename)
+    dataframe = pd.concat(dataframes)
+    store.append(parameters.identifier(), dataframe)
 
     # add the system parameters to the dataframe
-    for key, value in parameters.asdict().items():
-        dataframe[key] = value
-
-    return dataframe
+    return dataframe.assign(**parameters.asdict())
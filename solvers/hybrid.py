@@ -17,62 +17,73 @@
 '''Hybrid assignment solver. Quickly finds a candidate solution and
 then improves on it iteratively through branch-and-bound search.
 
+The solver can run a portfolio of independent improvement chains in worker
+processes, each starting from its own seed and initial solver. The chains
+run for a number of iterations at a time, after which the best-scoring
+assignment is shared with all chains.
+
 '''
 
-import uuid
-import random
+import time
+import heapq
 import logging
 import numpy as np
 import model
+from concurrent.futures import ProcessPoolExecutor
 from solvers import Solver
 from assignments.cached import CachedAssignment
 
+# Stop improving once the moving average of the relative improvement
+# falls below this threshold.
+STOP_THRESHOLD = 0.0001
+
 class Node(object):
-    '''Branch and bound node. Contains an assignment and meta data
-    required for the search.
+    '''Branch and bound node. Nodes don't hold an assignment. Instead they
+    store the path of increments leading to them from the root assignment,
+    which is applied to and undone from a single working assignment when
+    the node is expanded.
 
     '''
-    def __init__(self, parameters, assignment, row, partition_count):
-        '''Create a branch-and-bound node. These nodes are created for each
-        branch searched.
-
-        Args:
+    __slots__ = ['path', 'row_index', 'remaining', 'last_col',
+                 'partition_count', 'bound']
 
-        parameters: Parametrs object.
+    def __init__(self, path, row_index, remaining, last_col, partition_count, bound):
+        '''Create a branch-and-bound node.
 
-        assignment: Assignment object.
+        Args:
 
-        row: The row of the assignment matrix to consider next.
+        path: Tuple of (row, col) pairs incremented on the path from the
+        root.
 
-        partition_count: Vector of length num_partitions with symbols
-        counts by partition.
+        row_index: Index into the list of partial rows of the row to
+        consider next.
 
-        '''
-        assert isinstance(parameters, model.SystemParameters)
-        assert isinstance(assignment, CachedAssignment)
-        assert isinstance(row, int) and 0 <= row < parameters.num_batches
-        assert isinstance(partition_count, list)
+        remaining: Number of symbols missing from that row.
 
-        self.parameters = parameters
-        self.assignment = assignment
-        self.complete = False
-        self.row = row
+        last_col: Smallest partition to consider for the row. Partitions
+        are assigned to a row in non-decreasing order to avoid visiting
+        the same assignment more than once.
 
-        # Find the next partially assigned row
-        while (self.row < parameters.num_batches and
-               assignment.batch_union({self.row}).sum() == parameters.rows_per_batch):
-            self.row += 1
+        partition_count: Tuple of length num_partitions with symbols
+        counts by partition.
 
-        # Mark assignment as completed if no partial rows
-        if self.row == parameters.num_batches:
-            self.complete = True
-            self.row = None
+        bound: Bound on the score of any completion of this node.
 
+        '''
+        self.path = path
+        self.row_index = row_index
+        self.remaining = remaining
+        self.last_col = last_col
         self.partition_count = partition_count
+        self.bound = bound
         return
 
+    @property
+    def depth(self):
+        return len(self.path)
+
     def __str__(self):
-        return 'Row: {} Complete: {} Score: {}'.format(self.row, self.complete, self.assignment.score)
+        return 'Row index: {} Depth: {} Bound: {}'.format(self.row_index, self.depth, self.bound)
 
 class HybridSolver(Solver):
     '''Hybrid assignment solver. Quickly finds a candidate solution and
@@ -80,12 +91,16 @@ class HybridSolver(Solver):
 
     '''
 
-    def __init__(self, initialsolver=None, directory=None, clear=3):
+    def __init__(self, initialsolver=None, directory=None, clear=3, chains=1,
+                 seed=None, time_budget=None, score_budget=None, sync_interval=10,
+                 node_budget=None, search_time_budget=None):
         '''Create a hybrid solver.
 
         Args:
 
-        initialsolver: The solver used to find the initial assignment.
+        initialsolver: The solver used to find the initial assignment,
+        or a list of solvers. Chain i uses solver i modulo the number of
+        solvers.
 
         directory: Store intermediate assignments in this directory.
         Set to None to not store intermediate assignments.
@@ -93,55 +108,207 @@ class HybridSolver(Solver):
         clear: Number of elements of the assignment matrix to
         re-assign per iteration.
 
+        chains: Number of improvement chains. Chains are run in separate
+        worker processes if more than 1.
+
+        seed: Seed of the random number generator. Each chain is given an
+        independent stream derived from it.
+
+        time_budget: Stop after this many seconds of wall-clock time,
+        including any branch-and-bound search in progress. The initial
+        assignment is always found. Set to None to only stop once the
+        improvement converges.
+
+        score_budget: Stop once an assignment with a score less than or
+        equal to this value is found. Set to None to disable.
+
+        sync_interval: Number of iterations each chain runs before the
+        best assignment is shared between chains.
+
+        node_budget: Maximum number of nodes expanded per branch-and-bound
+        search. Set to None for no limit.
+
+        search_time_budget: Maximum number of seconds spent per
+        branch-and-bound search. Set to None for no limit.
+
         '''
         assert initialsolver is not None
         assert isinstance(directory, str) or directory is None
-        self.initialsolver = initialsolver
+        assert isinstance(chains, int) and chains > 0
+        assert time_budget is None or time_budget > 0
+        assert isinstance(sync_interval, int) and sync_interval > 0
+        assert node_budget is None or (isinstance(node_budget, int) and node_budget > 0)
+        assert search_time_budget is None or search_time_budget > 0
+        if not isinstance(initialsolver, list):
+            initialsolver = [initialsolver]
+        self.initialsolvers = initialsolver
         self.directory = directory
         self.clear = clear
+        self.chains = chains
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.time_budget = time_budget
+        self.score_budget = score_budget
+        self.sync_interval = sync_interval
+        self.node_budget = node_budget
+        self.search_time_budget = search_time_budget
+        self.statistics = dict()
         return
 
-    def branch_and_bound(self, parameters, assignment, partition_count, best_assignment):
-        '''Assign any remaining elements optimally.'''
-        stack = list()
-        stack.append(Node(parameters, assignment, 0, partition_count))
-        completed = 0
-        pruned = 0
-        best_assignment = best_assignment
-        while stack:
-            node = stack.pop()
-
-            # Store completed nodes with a better score
-            if node.complete and node.assignment.score <= best_assignment.score:
-                logging.debug('Completed assignment with improvement %d.',
-                              best_assignment.score - node.assignment.score)
-                best_assignment = node.assignment
-                completed += 1
-
-            for partition in range(parameters.num_partitions):
-                if not node.partition_count[partition]:
-                    continue
+    @property
+    def initialsolver(self):
+        '''The solver used to find the initial assignment of the first chain.'''
+        return self.initialsolvers[0]
+
+    def branch_and_bound(self, parameters, assignment, partition_count, best_assignment,
+                         deadline=None):
+        '''Assign any remaining elements optimally through best-first search.
+        Nodes are expanded in order of increasing bound, and the search
+        stops early if the node or time budget is exhausted or once the
+        deadline passes. Statistics of the search are stored in
+        self.statistics. In portfolio mode, they're the combined statistics
+        of the last search of every chain (see combine_statistics()).
+
+        Args:
 
-                # Only consider zero-valued elements
-                # if node.assignment.assignment_matrix[node.row, partition]:
-                #     continue
+        parameters: Parametrs object.
 
-                # logging.debug('Completed %d, Pruned %d, Stack size %d: row/col: [%d, %d]',
-                #               completed, pruned, len(stack), node.row, partition)
+        assignment: CachedAssignment with partially assigned rows. It's
+        used as the working assignment of the search and is restored
+        before returning.
+
+        partition_count: Vector of length num_partitions with symbols
+        counts by partition.
 
-                assignment = node.assignment.increment([node.row], [partition], [1])
-                # logging.debug('Best: %d. Bound: %d.', best_assignment.score, assignment.bound())
-                if assignment.bound() >= best_assignment.score:
-                    pruned += 1
+        best_assignment: The best known complete assignment.
+
+        deadline: Stop once time.time() exceeds this value, regardless of
+        the search time budget.
+
+        Returns: The best assignment found. This is best_assignment if no
+        better assignment was found.
+
+        '''
+        start = time.time()
+        if self.search_time_budget is not None:
+            if deadline is None:
+                deadline = start + self.search_time_budget
+            else:
+                deadline = min(start + self.search_time_budget, deadline)
+
+        # Rows are filled in order, so a node is identified by the index
+        # of its row and the number of symbols missing from it.
+        remaining_by_row = parameters.rows_per_batch - (
+            assignment.assignment_matrix.sum(axis=1) + assignment.gamma * parameters.num_partitions
+        )
+        partial_rows = np.flatnonzero(remaining_by_row > 0)
+        assert remaining_by_row[partial_rows].sum() == sum(partition_count), \
+            'partition_count must match the missing symbols.'
+
+        statistics = {'expanded': 0, 'pruned': 0, 'completed': 0, 'depth': 0,
+                      'exhausted': False}
+        best_score = best_assignment.score
+        if not len(partial_rows):
+            if assignment.score <= best_score:
+                best_assignment = assignment
+            statistics['elapsed'] = time.time() - start
+            self.statistics = statistics
+            return best_assignment
+
+        root = Node((), 0, int(remaining_by_row[partial_rows[0]]), 0,
+                    tuple(partition_count), assignment.bound())
+        # Nodes are ordered by bound. Ties are broken in favour of deeper
+        # nodes to find complete assignments sooner.
+        queue = [(root.bound, 0, 0, root)]
+        pushed = 1
+
+        # The working assignment is moved between nodes by undoing and
+        # applying the increments where their paths differ.
+        path, path_logs = (), list()
+        while queue:
+            bound, _, _, node = heapq.heappop(queue)
+
+            # All remaining nodes have at least this bound
+            if bound >= best_score:
+                statistics['pruned'] += len(queue) + 1
+                break
+
+            if self.node_budget is not None and statistics['expanded'] >= self.node_budget:
+                statistics['exhausted'] = True
+                break
+            if deadline is not None and time.time() >= deadline:
+                statistics['exhausted'] = True
+                break
+
+            statistics['expanded'] += 1
+            statistics['depth'] = max(statistics['depth'], node.depth + 1)
+
+            # Move the working assignment to this node
+            common = 0
+            for step, node_step in zip(path, node.path):
+                if step != node_step:
+                    break
+                common += 1
+            while len(path_logs) > common:
+                assignment.undo(path_logs.pop())
+            for row, col in node.path[common:]:
+                path_logs.append(assignment.apply([row], [col], [1]))
+            path = node.path
+
+            # Position of the children
+            row = int(partial_rows[node.row_index])
+            row_index, remaining = node.row_index, node.remaining - 1
+            if not remaining:
+                row_index += 1
+                if row_index < len(partial_rows):
+                    remaining = int(remaining_by_row[partial_rows[row_index]])
+            complete = row_index == len(partial_rows)
+
+            for partition in range(node.last_col, parameters.num_partitions):
+                if not node.partition_count[partition]:
                     continue
 
-                partition_count = node.partition_count[:]
-                partition_count[partition] -= 1
-                stack.append(Node(parameters, assignment, node.row, partition_count))
+                # Evaluate the child in place and roll it back. Only the
+                # best complete assignment is copied.
+                log = assignment.apply([row], [partition], [1])
+                if complete:
+                    if assignment.score < best_score:
+                        best_assignment = assignment.copy()
+                        best_score = assignment.score
+                        statistics['completed'] += 1
+                        logging.debug('Completed assignment with score %d.', best_score)
+                    else:
+                        statistics['pruned'] += 1
+                    assignment.undo(log)
+                    continue
 
+                child_bound = assignment.bound()
+                assignment.undo(log)
+                if child_bound >= best_score:
+                    statistics['pruned'] += 1
+                    continue
+
+                child_count = list(node.partition_count)
+                child_count[partition] -= 1
+                child = Node(node.path + ((row, partition),), row_index, remaining,
+                             partition if row_index == node.row_index else 0,
+                             tuple(child_count), child_bound)
+                heapq.heappush(queue, (child_bound, -child.depth, pushed, child))
+                pushed += 1
+
+        # Restore the working assignment
+        while path_logs:
+            assignment.undo(path_logs.pop())
+
+        statistics['elapsed'] = time.time() - start
+        self.statistics = statistics
+        logging.debug('Branch-and-bound expanded %d nodes, pruned %d, completed %d, '
+                      'max depth %d in %f seconds.', statistics['expanded'],
+                      statistics['pruned'], statistics['completed'],
+                      statistics['depth'], statistics['elapsed'])
         return best_assignment
 
-    def deassign(self, parameters, assignment, partition_count, deassignments):
+    def deassign(self, parameters, assignment, partition_count, deassignments, rng=None):
         '''De-assign an element randomly.
 
         Args:
@@ -155,18 +322,23 @@ class HybridSolver(Solver):
 
         deassignments: Number of deassignments to make.
 
+        rng: numpy.random.Generator. The generator of the solver is used
+        if None.
+
         Returns: The updated assignment.
 
         '''
         assert isinstance(deassignments, int) and deassignments > 0
+        if rng is None:
+            rng = self.rng
 
         # Cache the row and col indices to decrement.
         indices = dict()
 
         # Select row, col pairs.
         while deassignments > 0:
-            row = random.randint(0, parameters.num_batches - 1)
-            col = random.randint(0, parameters.num_partitions - 1)
+            row = int(rng.integers(parameters.num_batches))
+            col = int(rng.integers(parameters.num_partitions))
 
             # Ensure that there are remaining values to decrement.
             remaining = assignment.assignment_matrix[row, col] - 1
@@ -190,29 +362,75 @@ class HybridSolver(Solver):
         cols = [index[1] for index in keys]
         return assignment.decrement(rows, cols, values)
 
-    def solve(self, parameters, assignment_type=None):
-        '''Find an assignment using this solver.
+    def initial_assignment(self, parameters, initialsolver=None, directory=None):
+        '''Load an assignment from disk or find one using the initial
+        solver, and make sure its dynamic programming index is built.
 
         Args:
 
         parameters: System parameters
 
-        Returns: The resulting assignment
+        initialsolver: The solver used if no assignment is stored on disk.
+        Defaults to the initial solver of the first chain. Set to False
+        to raise FileNotFoundError instead.
 
-        '''
-        assert isinstance(parameters, model.SystemParameters)
-        assert assignment_type is None or assignment_type is CachedAssignment, \
-            'Solver must be used with CachedAssignment.'
+        directory: Load and store the assignment in this directory. Set
+        to None to always use the initial solver.
 
-        # Load solution or find one using the initial solver.
+        Returns: A CachedAssignment with an index.
+
+        '''
+        if initialsolver is None:
+            initialsolver = self.initialsolver
         try:
-            assignment = CachedAssignment.load(parameters, directory=self.directory)
+            assignment = CachedAssignment.load(parameters, directory=directory)
             logging.debug('Loaded a candidate solution from disk.')
         except FileNotFoundError:
-            logging.debug('Finding a candidate solution using solver %s.', self.initialsolver.identifier)
-            assignment = self.initialsolver.solve(parameters, assignment_type=CachedAssignment)
-            if self.directory:
-                assignment.save(directory=self.directory)
+            if initialsolver is False:
+                raise
+            logging.debug('Finding a candidate solution using solver %s.', initialsolver.identifier)
+            assignment = initialsolver.solve(parameters, assignment_type=CachedAssignment)
+            if directory:
+                assignment.save(directory=directory)
+
+        # Make sure the dynamic programming index is built
+        if not assignment.index or not assignment.score:
+            assignment = CachedAssignment(parameters, gamma=assignment.gamma,
+                                          assignment_matrix=assignment.assignment_matrix,
+                                          labels=assignment.labels)
+        return assignment
+
+    def improve(self, parameters, assignment, rng=None, moving_average=1,
+                iterations=None, deadline=None, directory=None):
+        '''Iteratively improve an assignment by de-assigning elements
+        randomly and re-assigning them optimally.
+
+        Args:
+
+        parameters: System parameters
+
+        assignment: CachedAssignment with an index.
+
+        rng: numpy.random.Generator. The generator of the solver is used
+        if None.
+
+        moving_average: Initial moving average of the relative
+        improvement. Pass the value returned by a previous call to
+        continue a chain.
+
+        iterations: Stop after this many iterations. Set to None to run
+        until the improvement converges or a budget is exhausted.
+
+        deadline: Stop once time.time() exceeds this value.
+
+        directory: Store improved assignments in this directory.
+
+        Returns: Tuple (assignment, moving_average) with the best
+        assignment found and the moving average when stopping.
+
+        '''
+        if rng is None:
+            rng = self.rng
 
         # Ensure there is room for optimization.
         counts = np.zeros(parameters.num_partitions)
@@ -221,45 +439,131 @@ class HybridSolver(Solver):
 
         if counts.sum() < self.clear:
             logging.debug('Initial solution leaves no room for optimization. Returning.')
-            return assignment
-
-        # Make sure the dynamic programming index is built
-        if not assignment.index or not assignment.score:
-            assignment = CachedAssignment(parameters, gamma=assignment.gamma,
-                                          assignment_matrix=assignment.assignment_matrix,
-                                          labels=assignment.labels)
+            return assignment, 0
 
         original_score = max(assignment.score, 1)
         best_assignment = assignment.copy()
 
         # Iteratively improve the assignment
-        iterations = 0
+        iteration = 0
         total_improvement = 0
-        moving_average = 1
-        stop_threshold = 0.0001
-        while moving_average > stop_threshold:
+        while moving_average > STOP_THRESHOLD:
+            if iterations is not None and iteration >= iterations:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            if self.score_budget is not None and best_assignment.score <= self.score_budget:
+                break
+
             # Count symbols by partition
             partition_count = [0] * parameters.num_partitions
 
             # De-assign elements
             decremented_assignment = self.deassign(parameters, best_assignment,
-                                                   partition_count, self.clear)
+                                                   partition_count, self.clear, rng=rng)
 
             # Re-assign optimally
             improved_assignment = self.branch_and_bound(parameters, decremented_assignment,
-                                                        partition_count, best_assignment)
+                                                        partition_count, best_assignment,
+                                                        deadline=deadline)
 
-            iterations += 1
+            iteration += 1
             improvement = (best_assignment.score - improved_assignment.score) / original_score
             total_improvement += improvement
             moving_average *= 0.9
             moving_average += improvement
             best_assignment = improved_assignment.copy()
             logging.info('Improved %f%% over %d iterations. Moving average: %f%%. Stop threshold: %f%%.',
-                         total_improvement * 100, iterations, moving_average * 100, stop_threshold * 100)
+                         total_improvement * 100, iteration, moving_average * 100, STOP_THRESHOLD * 100)
 
-            if self.directory and improvement > 0:
-                best_assignment.save(directory=self.directory)
+            if directory and improvement > 0:
+                best_assignment.save(directory=directory)
+
+        return best_assignment, moving_average
+
+    def solve(self, parameters, assignment_type=None):
+        '''Find an assignment using this solver.
+
+        Args:
+
+        parameters: System parameters
+
+        Returns: The resulting assignment
+
+        '''
+        assert isinstance(parameters, model.SystemParameters)
+        assert assignment_type is None or assignment_type is CachedAssignment, \
+            'Solver must be used with CachedAssignment.'
+
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+
+        if self.chains > 1:
+            return self.solve_portfolio(parameters, deadline)
+
+        assignment = self.initial_assignment(parameters, directory=self.directory)
+        best_assignment, _ = self.improve(parameters, assignment, deadline=deadline,
+                                          directory=self.directory)
+        return best_assignment
+
+    def solve_portfolio(self, parameters, deadline=None):
+        '''Improve assignments in parallel chains, sharing the best
+        assignment between chains every sync_interval iterations.
+
+        Args:
+
+        parameters: System parameters
+
+        deadline: Stop once time.time() exceeds this value.
+
+        Returns: The best assignment found by any chain.
+
+        '''
+
+        # Start all chains from the stored assignment if there is one.
+        # Otherwise each chain finds its own using its initial solver.
+        try:
+            assignment = self.initial_assignment(parameters, initialsolver=False,
+                                                 directory=self.directory)
+        except FileNotFoundError:
+            assignment = None
+
+        seeds = np.random.SeedSequence(self.seed).spawn(self.chains)
+        assignments = [assignment] * self.chains
+        moving_averages = [1] * self.chains
+        best_assignment = None
+        rounds = 0
+        with ProcessPoolExecutor(max_workers=self.chains) as executor:
+            while True:
+                futures = [executor.submit(
+                    _improve_chain, self, parameters, assignments[i],
+                    self.initialsolvers[i % len(self.initialsolvers)],
+                    seeds[i].spawn(1)[0], moving_averages[i], deadline,
+                ) for i in range(self.chains)]
+                results = [future.result() for future in futures]
+                moving_averages = [moving_average for _, moving_average, _ in results]
+                self.statistics = combine_statistics(
+                    [statistics for _, _, statistics in results])
+                rounds += 1
+
+                # Share the best assignment between chains
+                chain_best = min((chain_assignment for chain_assignment, _, _ in results),
+                                 key=lambda chain_assignment: chain_assignment.score)
+                if best_assignment is None or chain_best.score < best_assignment.score:
+                    best_assignment = chain_best
+                    if self.directory:
+                        best_assignment.save(directory=self.directory)
+                assignments = [best_assignment] * self.chains
+                logging.info('Portfolio round %d: best score %d over %d chains.',
+                             rounds, best_assignment.score, self.chains)
+
+                if max(moving_averages) <= STOP_THRESHOLD:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    break
+                if self.score_budget is not None and best_assignment.score <= self.score_budget:
+                    break
 
         return best_assignment
 
@@ -267,3 +571,70 @@ class HybridSolver(Solver):
     def identifier(self):
         '''Return a string identifier for this object.'''
         return self.__class__.__name__
+
+def _improve_chain(solver, parameters, assignment, initialsolver, seed,
+                   moving_average, deadline):
+    '''Run one round of an improvement chain of a portfolio. This is a
+    module-level function so that it can be run in a worker process.
+
+    Args:
+
+    solver: HybridSolver.
+
+    parameters: System parameters
+
+    assignment: CachedAssignment to start from. Found using initialsolver
+    if None.
+
+    initialsolver: The solver used to find the initial assignment.
+
+    seed: numpy.random.SeedSequence of this chain and round.
+
+    moving_average: Moving average of the relative improvement of the
+    chain.
+
+    deadline: Stop once time.time() exceeds this value.
+
+    Returns: Tuple (assignment, moving_average, statistics), where
+    statistics are the statistics of the last branch-and-bound search of
+    the chain. They're empty if no search was run.
+
+    '''
+    rng = np.random.default_rng(seed)
+    if assignment is None:
+        # Give seeded initial solvers a stream of their own
+        if hasattr(initialsolver, 'rng'):
+            initialsolver.rng = rng
+        assignment = solver.initial_assignment(parameters, initialsolver)
+    solver.statistics = dict()
+    assignment, moving_average = solver.improve(
+        parameters, assignment, rng=rng, moving_average=moving_average,
+        iterations=solver.sync_interval, deadline=deadline,
+    )
+    return assignment, moving_average, solver.statistics
+
+def combine_statistics(statistics):
+    '''Combine the statistics of several branch-and-bound searches. Counts
+    are summed, the depth and elapsed time are the maximum over the
+    searches, and the budget is considered exhausted if it was for any
+    search.
+
+    Args:
+
+    statistics: List of dicts stored in HybridSolver.statistics. Empty
+    dicts are ignored.
+
+    Returns: A dict with the combined statistics.
+
+    '''
+    statistics = [dct for dct in statistics if dct]
+    if not statistics:
+        return dict()
+    return {
+        'expanded': sum(dct['expanded'] for dct in statistics),
+        'pruned': sum(dct['pruned'] for dct in statistics),
+        'completed': sum(dct['completed'] for dct in statistics),
+        'depth': max(dct['depth'] for dct in statistics),
+        'elapsed': max(dct['elapsed'] for dct in statistics),
+        'exhausted': any(dct['exhausted'] for dct in statistics),
+    }
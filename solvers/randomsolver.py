@@ -16,7 +16,7 @@
 
 '''This solver creates a random assignment'''
 
-import random
+import numpy as np
 import model
 from assignments import Assignment
 from assignments.sparse import SparseAssignment
@@ -26,7 +26,7 @@ class RandomSolver(Solver):
     '''Create an assignment matrix randomly.'''
 
 
-    def __init__(self, optimized=False):
+    def __init__(self, optimized=False, seed=None):
         '''Create a randomized solver.
 
         Args:
@@ -35,9 +35,14 @@ class RandomSolver(Solver):
         as possible to all elements of the assignment matrix, and then
         assign any remaining rows randomly. Defaults to False.
 
+        seed: Seed of the random number generator. Assignments are
+        different for every call to solve() but the sequence of
+        assignments is reproducible if a seed is given.
+
         '''
         assert isinstance(optimized, bool)
         self.optimized = optimized
+        self.rng = np.random.default_rng(seed)
         return
 
     def solve(self, par, assignment_type=None):
@@ -77,49 +82,42 @@ class RandomSolver(Solver):
 
         assignment: Assignment object
 
-        count_by_partition: A list of row counts by partition.
+        count_by_partition: A list of row counts by partition. Updated
+        in place with the assigned rows.
+
+        Returns: The resulting assignment object.
 
         '''
 
         assert len(count_by_partition) == par.num_partitions, \
             'count_by_partition must be of length equal to the number of partitions.'
 
-        # Create a set containing the indices of the partially assigned
-        # partitions
-        coded_rows_per_partition = par.num_coded_rows / par.num_partitions
-        partial_partitions = set()
-
-        for partition in range(par.num_partitions):
-            if count_by_partition[partition] < coded_rows_per_partition:
-                partial_partitions.add(partition)
-
-        # Assign symbols randomly row-wise
-        rows = dict()
-        for row in range(par.num_batches):
-            cols = dict()
-            row_sum = assignment.batch_union({row}).sum()
-            while row_sum < par.rows_per_batch:
-                col = random.sample(partial_partitions, 1)[0]
-                if col in cols:
-                    cols[col] += 1
-                else:
-                    cols[col] = 1
-
-                # Increment the count
-                count_by_partition[col] += 1
-                row_sum += 1
-
-                # Remove the partition index if there are no more assignments
-                if count_by_partition[col] == coded_rows_per_partition:
-                    partial_partitions.remove(col)
-
-            rows[row] = cols
-
-        for row, cols in rows.items():
-            assignment = assignment.increment([row]*len(cols),
-                                              list(cols.keys()),
-                                              list(cols.values()))
-        return assignment
+        # Build the multiset of symbols remaining per partition
+        coded_rows_per_partition = int(par.num_coded_rows / par.num_partitions)
+        remaining_by_partition = coded_rows_per_partition - np.asarray(count_by_partition)
+        assert remaining_by_partition.min() >= 0
+        symbols = np.repeat(np.arange(par.num_partitions), remaining_by_partition)
+
+        # Number of symbols missing from each row
+        remaining_by_row = par.rows_per_batch - assignment.batch_counts().sum(axis=1)
+        remaining_by_row = np.asarray(remaining_by_row, dtype=np.int64).reshape(-1)
+        assert remaining_by_row.min() >= 0
+        assert remaining_by_row.sum() == len(symbols), \
+            'The remaining symbols must fill the remaining rows exactly.'
+
+        # Shuffle the symbols and hand them out to the rows in order
+        self.rng.shuffle(symbols)
+        row_of_symbol = np.repeat(np.arange(par.num_batches), remaining_by_row)
+        counts = np.bincount(row_of_symbol * par.num_partitions + symbols,
+                             minlength=par.num_batches * par.num_partitions)
+        for partition, count in enumerate(np.bincount(symbols, minlength=par.num_partitions)):
+            count_by_partition[partition] += int(count)
+
+        # Apply all increments at once
+        elements = np.flatnonzero(counts)
+        row_indices, col_indices = np.divmod(elements, par.num_partitions)
+        return assignment.increment(row_indices.tolist(), col_indices.tolist(),
+                                    counts[elements].tolist())
 
     @property
     def identifier(self):
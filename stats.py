@@ -17,9 +17,7 @@
 '''Project statistics module.'''
 
 import math
-import random
 import functools
-import statistics
 import numpy as np
 import scipy as sp
 import scipy.stats
@@ -27,37 +25,108 @@ import matplotlib.pyplot as plt
 
 from scipy.special import gamma, gammainc
 
-def order_sample(icdf=None, total=None, order=None):
+# number of exponential variables drawn at a time by order_samples_shiftexp
+SAMPLE_CHUNK_SIZE = 1 << 22
+
+def order_sample(icdf=None, total=None, order=None, rng=None):
     '''Sample the order statistic.
 
     Args:
 
-    icdf: Distribution ICDF function.
+    icdf: Distribution ICDF function. Must accept Numpy arrays.
 
     total: Total number of realizations.
 
     order: Order of the statistic.
 
+    rng: numpy.random.Generator. A new generator is created if None.
+
     Returns: A sample of the order statistic.
 
+    '''
+    return order_samples(icdf=icdf, total=total, order=order, samples=1, rng=rng)[0]
+
+def order_samples(icdf=None, total=None, order=None, samples=None, rng=None):
+    '''Sample the order statistic of the distribution given by the icdf.
+
+    Args:
+
+    icdf: Distribution ICDF function. Must accept Numpy arrays.
+
+    total: Total number of realizations.
+
+    order: Order of the statistic.
+
+    samples: Number of samples.
+
+    rng: numpy.random.Generator. A new generator is created if None.
+
+    Returns: Array of samples of the order statistic.
+
     '''
     assert isinstance(total, int)
     assert isinstance(order, int)
     assert total >= order, 'order must be less or equal to total.'
-    samples = [icdf(random.random()) for _ in range(total)]
-    partition = np.partition(np.asarray(samples), order-1)
-    return partition[order-1]
+    if rng is None:
+        rng = np.random.default_rng()
+    realizations = icdf(rng.random((samples, total)))
+    return np.partition(realizations, order-1, axis=1)[:, order-1]
+
+def order_samples_shiftexp(total, order, parameter=1, scale=None, n=1, rng=None):
+    '''Sample the shifted exponential order statistic exactly using the Renyi
+    representation, i.e., the order-th smallest of total shifted exponentials
+    is distributed as parameter + scale * sum(E_i / (total-i)) over i in
+    range(order), where E_i are standard exponential variables.
 
-def order_samples(icdf=None, total=None, order=None, samples=None):
-    '''Sample the order statistic of the distribution given by the icdf'''
-    return [order_sample(icdf, total, order) for _ in range(samples)]
+    Args:
+
+    total: Total number of variables.
+
+    order: Statistic order. Either an integer or an array of length n with
+    the order of each sample.
+
+    parameter: Distribution parameter.
+
+    scale: scale factor for the tail of the shifted exponential
+    distribution. if None, it is equal to parameter.
+
+    n: Number of samples.
+
+    rng: numpy.random.Generator. A new generator is created if None.
+
+    Returns: Array of n samples.
+
+    '''
+    if scale is None:
+        scale = parameter
+    if rng is None:
+        rng = np.random.default_rng()
+    order = np.broadcast_to(np.asarray(order, dtype=np.int64), (n,))
+    assert np.all(0 <= order) and np.all(order <= total), 'order must be between 0 and total.'
+    max_order = int(order.max(initial=0))
+    rates = total - np.arange(max_order)
+    samples = np.zeros(n)
+    if max_order == 0:
+        return parameter + samples
+
+    # draw the exponentials for a chunk of samples in a single call and
+    # discard those beyond the order of each sample.
+    chunk_size = max(1, SAMPLE_CHUNK_SIZE // max_order)
+    for start in range(0, n, chunk_size):
+        orders = order[start:start+chunk_size]
+        exponentials = rng.standard_exponential((len(orders), max_order))
+        exponentials /= rates
+        exponentials[np.arange(max_order) >= orders[:, None]] = 0
+        samples[start:start+chunk_size] = exponentials.sum(axis=1)
+
+    return parameter + scale * samples
 
 def order_mean_empiric(icdf, total, order, samples=1000):
     '''Compute the order static mean numerically.
 
     Args:
 
-    icdf: Distribution ICDF function.
+    icdf: Distribution ICDF function. Must accept Numpy arrays.
 
     total: Total number of realizations.
 
@@ -69,14 +138,63 @@ def order_mean_empiric(icdf, total, order, samples=1000):
     the given distribution.
 
     '''
-    samples = [order_sample(icdf, total, order) for _ in range(samples)]
-    mean = statistics.mean(samples)
-    variance = statistics.variance(samples, xbar=mean)
+    samples = order_samples(icdf, total, order, samples)
+    mean = samples.mean()
+    variance = samples.var(ddof=1)
     return mean, variance
 
-@functools.lru_cache(maxsize=1024)
+@functools.lru_cache(maxsize=16)
+def _harmonic_table(size, power):
+    '''Return a read-only array of the generalized harmonic numbers H[n] =
+    sum(1 / k**power for k in range(1, n+1)) for all n smaller than size.
+
+    '''
+    table = np.zeros(size)
+    np.cumsum(1 / np.power(np.arange(1, size, dtype=float), power), out=table[1:])
+    table.flags.writeable = False
+    return table
+
+def harmonic_sum(total, order, power=1):
+    '''Compute sum(1 / i**power for i in range(total-order+1, total+1)).
+    Accepts arrays for total and order.
+
+    Args:
+
+    total: Total number of variables. Must be integer.
+
+    order: Statistic order. Must be integer and at most total.
+
+    power: Power of the summands.
+
+    Returns: The sum, or an array of sums if total or order is an array.
+
+    '''
+    total = np.asarray(total)
+    order = np.asarray(order)
+    if np.any(total % 1 != 0):
+        raise ValueError("total={} must be an integer".format(total))
+    if np.any(order % 1 != 0):
+        raise ValueError("order={} must be an integer".format(order))
+    if np.any(order > total) or np.any(order < 0):
+        raise ValueError("order={} must be between 0 and total={}".format(order, total))
+    total = total.astype(np.int64)
+    order = order.astype(np.int64)
+
+    # the tables are computed for sizes rounded up to a power of two such
+    # that few tables are needed.
+    size = 1 << int(total.max(initial=0)).bit_length()
+    table = _harmonic_table(size, power)
+    return table[total] - table[total-order]
+
+def _scalar_or_array(values):
+    '''Return 0-dimensional arrays as floats.'''
+    if np.ndim(values) == 0:
+        return float(values)
+    return values
+
 def order_mean_shiftexp(total, order, parameter=1, scale=None):
-    '''Compute the mean of the shifted exponential order statistic.
+    '''Compute the mean of the shifted exponential order statistic. Accepts
+    arrays for all arguments, which are broadcast against each other.
 
     Args:
 
@@ -95,19 +213,12 @@ def order_mean_shiftexp(total, order, parameter=1, scale=None):
     '''
     if scale is None:
         scale = parameter
-    if total % 1 != 0:
-        raise ValueError("total={} must be an integer".format(total))
-    if order % 1 != 0:
-        raise ValueError("order={} must be an integer".format(order))
-    total, order = int(total), int(order)
-    mean = parameter
-    for i in range(total-order+1, total+1):
-        mean += scale / i
-    return mean
+    mean = parameter + np.multiply(scale, harmonic_sum(total, order))
+    return _scalar_or_array(mean)
 
-@functools.lru_cache(maxsize=1024)
 def order_variance_shiftexp(total, order, parameter):
     '''Compute the variance of the shifted exponential order statistic.
+    Accepts arrays for all arguments, which are broadcast against each other.
 
     Args:
 
@@ -121,16 +232,14 @@ def order_variance_shiftexp(total, order, parameter):
     the shifted exponential distribution.
 
     '''
-    variance = 0
-    for i in range(total-order+1, total+1):
-        variance += 1 / math.pow(i, 2)
+    variance = harmonic_sum(total, order, power=2) * np.power(parameter, 2)
+    return _scalar_or_array(variance)
 
-    variance *= math.pow(parameter, 2)
-    return variance
-
-@functools.lru_cache(maxsize=1024)
 def order_cdf_shiftexp(value, total=None, order=None, parameter=None):
-    '''CDF of the shifted exponential order statistic.
+    '''CDF of the shifted exponential order statistic. Accepts arrays for
+    all arguments, which are broadcast against each other. For example, use
+    value[:, None] and an array of orders to evaluate the CDF of every order
+    at every value.
 
     args:
 
@@ -146,16 +255,17 @@ def order_cdf_shiftexp(value, total=None, order=None, parameter=None):
     value.
 
     '''
-    assert 0 <= value <= math.inf
-    if value < parameter:
-        return 0
-    a = order_mean_shiftexp(total, order, parameter) - parameter
-    a /= order_variance_shiftexp(total, order, parameter)
-    b = pow(order_mean_shiftexp(total, order, parameter) - parameter, 2)
-    b /= order_variance_shiftexp(total, order, parameter)
+    value = np.asarray(value, dtype=float)
+    assert np.all(0 <= value) and np.all(value <= math.inf)
+    mean = harmonic_sum(total, order) * parameter
+    variance = harmonic_sum(total, order, power=2) * np.power(parameter, 2)
+    a = mean / variance
+    b = np.power(mean, 2) / variance
 
     # the CDF is given by the regularized lower incomplete gamma function.
-    return gammainc(b, a*(value-parameter))
+    shifted = np.maximum(value - parameter, 0)
+    cdf = np.where(value < parameter, 0, gammainc(b, a*shifted))
+    return _scalar_or_array(cdf)
 
 def order_aggregate_cdf_shiftexp(value, parameter=None, total=None,
                                  orders=None, order_probabilities=None):
@@ -166,7 +276,7 @@ def order_aggregate_cdf_shiftexp(value, parameter=None, total=None,
 
     args:
 
-    value: value to evaluate the aggregate CDF at.
+    value: value to evaluate the aggregate CDF at. may be an array of values.
 
     parameter: shifted exponential distribution parameter.
 
@@ -183,18 +293,15 @@ def order_aggregate_cdf_shiftexp(value, parameter=None, total=None,
     assert len(orders) == len(order_probabilities)
     assert np.allclose(order_probabilities.sum(), 1)
 
-    # evaluate the shifted exponential order statistic CDF at each order
-    cdf_values = np.fromiter(
-        (order_cdf_shiftexp(value, total=total, order=i, parameter=parameter) for i in orders),
-        dtype=float,
+    # evaluate the shifted exponential order statistic CDF at each order and
+    # value. the weighted average over the orders is the aggregate CDF.
+    cdf_values = order_cdf_shiftexp(
+        np.asarray(value, dtype=float)[..., None],
+        total=total,
+        order=np.asarray(orders),
+        parameter=parameter,
     )
-
-    # weigh the results by the probability of the respective order
-    cdf_values *= order_probabilities
-
-    # summing the array gives the weighted average, which is the value of the
-    # aggregate CDF.
-    return cdf_values.sum()
+    return _scalar_or_array(np.dot(cdf_values, order_probabilities))
 
 class ShiftexpOrder(object):
     '''Shifted exponential order statistic random variable.'''
@@ -222,7 +329,7 @@ class ShiftexpOrder(object):
 
     def pdf(self, value):
         '''Probability density function.'''
-        assert 0 <= value <= math.inf
+        assert np.all(0 <= np.asarray(value)) and np.all(np.asarray(value) <= math.inf)
         return scipy.stats.gamma.pdf(
             value,
             self.b,
@@ -257,13 +364,35 @@ class ShiftexpOrder(object):
             self.parameter,
         )
 
-    def sample(self, n=1):
-        '''sample the distribution'''
+    def sample(self, n=1, method='gamma', rng=None):
+        '''sample the distribution
+
+        args:
+
+        n: number of samples.
+
+        method: 'gamma' samples the gamma distribution with the same mean and
+        variance as this variable. 'exact' samples the order statistic
+        exactly (see order_samples_shiftexp()).
+
+        rng: numpy.random.Generator. A new generator is created if None.
+
+        '''
+        assert method in ['gamma', 'exact'], method
+        if method == 'exact':
+            return order_samples_shiftexp(
+                self.total,
+                self.order,
+                parameter=self.parameter,
+                n=n,
+                rng=rng,
+            )
         return scipy.stats.gamma.rvs(
             self.b,
             scale=1/self.a,
             loc=self.parameter,
             size=n,
+            random_state=rng,
         )
 
 class Shiftexp(object):
@@ -298,9 +427,9 @@ class Shiftexp(object):
             return 1 - math.exp(-(value / self.parameter - 1))
 
     def icdf(self, value):
-        '''Shifted exponential distribution inverse CDF.'''
-        assert 0 <= value < 1, 'Value must be <= 0 and < 1.'
-        return self.parameter * (1 - math.log(1 - value))
+        '''Shifted exponential distribution inverse CDF. Accepts arrays.'''
+        assert np.all(0 <= value) and np.all(value < 1), 'Value must be <= 0 and < 1.'
+        return self.parameter * (1 - np.log(1 - value))
 
     def mean(self):
         '''Expected value.'''
@@ -326,6 +455,55 @@ class ExpSum(object):
     def cdf(self, value):
         return scipy.stats.gamma.cdf(value, self.b, scale=self.scale, loc=0)
 
+class RunningMoments(object):
+    '''Running mean and variance of a stream of samples, updated one chunk
+    at a time. Each sample may be a vector, in which case the moments are
+    computed element-wise.
+
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        return
+
+    def update(self, samples):
+        '''Add a chunk of samples. The first axis of samples is taken to be
+        the sample axis.'''
+        samples = np.asarray(samples, dtype=np.float64)
+        count = len(samples)
+        if not count:
+            return
+        mean = samples.mean(axis=0)
+        m2 = ((samples - mean) ** 2).sum(axis=0)
+
+        # Combine the moments of the chunk with the previous moments.
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        return
+
+    def variance(self):
+        '''Unbiased sample variance.'''
+        if self.count < 2:
+            return np.full_like(np.asarray(self.mean), math.inf)
+        return self.m2 / (self.count - 1)
+
+    def half_width(self, confidence=0.95):
+        '''Half-width of the normal-approximation confidence interval of the
+        mean.'''
+        assert 0 < confidence < 1
+        z = scipy.stats.norm.ppf((1 + confidence) / 2)
+        return z * np.sqrt(self.variance() / max(self.count, 1))
+
+    def converged(self, target, confidence=0.95):
+        '''Return True if the confidence interval half-width is at most a
+        target fraction of the mean for all elements.'''
+        return bool(np.all(self.half_width(confidence) <= target * np.abs(self.mean)))
+
 def validate():
     '''Validate the analytic computation of the order stats.'''
     total = 9
@@ -351,19 +529,19 @@ def validate():
 
     plt.figure()
     plt.hist(samples, bins=100, cumulative=True, density=True)
-    cdf = [x_order.cdf(i) for i in t]
+    cdf = x_order.cdf(t)
     plt.plot(t, cdf)
     plt.grid()
 
     plt.figure()
     plt.hist(samples, bins=100, cumulative=True, density=True)
-    cdf = [order_aggregate_cdf_shiftexp(
-        i,
+    cdf = order_aggregate_cdf_shiftexp(
+        t,
         parameter=mu,
         total=total,
         orders=np.array([order, order+1]),
         order_probabilities=np.array([0.75, 0.25])
-    ) for i in t]
+    )
     plt.plot(t, cdf)
     plt.grid()
     plt.show()
@@ -1,12 +1,17 @@
 '''Tests of the assignments package.'''
 
+import pickle
 import unittest
+import unittest.mock
 import itertools
 import tempfile
 import numpy as np
 import model
+import assignments.cached
 from assignments.cached import CachedAssignment
 from assignments.sparse import SparseAssignment
+from assignments.labels import Labels
+from assignments.shared import SharedAssignment, SharedAssignmentError
 
 class SparseTests(unittest.TestCase):
     '''Tests fort he sparse assignment module.'''
@@ -20,6 +25,61 @@ class SparseTests(unittest.TestCase):
             self.assertEqual(len(batches), batches_per_server)
         return
 
+    def test_label_operations(self):
+        '''Verify the vectorized label operations against sets.'''
+        par = self.get_parameters()
+        labels = SparseAssignment(par).labels
+        sets = list(labels)
+        self.assertEqual(Labels.from_sets(sets, par.num_batches), labels)
+        self.assertEqual(list(labels.popcount()), [len(batches) for batches in sets])
+        for servers in itertools.combinations(range(par.num_servers), 3):
+            self.assertEqual(labels.batches(labels.union(servers)),
+                             set.union(*[sets[x] for x in servers]))
+            self.assertEqual(labels.batches(labels.intersection(servers)),
+                             set.intersection(*[sets[x] for x in servers]))
+            count = labels.count(servers)
+            for batch in range(par.num_batches):
+                self.assertEqual(count[batch], sum(batch in sets[x] for x in servers))
+        return
+
+    def test_batch_union(self):
+        '''Verify the sparse batch unions against the dense batch counts.'''
+        par = self.get_parameters_2()
+        assignment = SparseAssignment(par, gamma=1)
+        rows = list(range(par.num_batches))
+        cols = [row % par.num_partitions for row in rows]
+        data = [par.rows_per_batch - par.num_partitions] * par.num_batches
+        assignment = assignment.increment(rows, cols, data)
+        counts = assignment.batch_counts()
+        batch_sets = [set(), {0}, set(range(0, par.num_batches, 2)), set(rows)]
+        unions = assignment.batch_unions(batch_sets)
+        for batches, union in zip(batch_sets, unions):
+            correct = counts[list(batches)].sum(axis=0)
+            self.assertTrue(np.array_equal(assignment.batch_union(batches), correct))
+            self.assertTrue(np.array_equal(union, correct))
+        return
+
+    def test_builder(self):
+        '''Verify that bulk increments match incremental ones.'''
+        par = self.get_parameters_2()
+        assignment = SparseAssignment(par)
+        incremented = SparseAssignment(par)
+        builder = assignment.builder()
+        for row in range(par.num_batches):
+            cols = [row % par.num_partitions, (row + 1) % par.num_partitions]
+            incremented = incremented.increment([row, row], cols, [1, 1])
+            builder.add(row, cols, 1)
+        self.assertEqual(len(builder), 2 * par.num_batches)
+        built = assignment.build(builder)
+        self.assertEqual(built.assignment_matrix.dtype, np.int32)
+        self.assertTrue(np.array_equal(built.assignment_matrix.toarray(),
+                                       incremented.assignment_matrix.toarray()))
+        decremented = built.decrement(list(range(par.num_batches)),
+                                      [row % par.num_partitions for row in range(par.num_batches)],
+                                      [1] * par.num_batches)
+        self.assertEqual(decremented.assignment_matrix.sum(), par.num_batches)
+        return
+
     def test_save_load(self):
         '''Verify that saving and loading works.'''
         par = self.get_parameters_2()
@@ -80,6 +140,43 @@ class SparseTests(unittest.TestCase):
                                       1/2, # Server storage (\mu)
                                       5) # Partitions (T)
 
+class SharedTests(unittest.TestCase):
+    '''Tests for the shared assignment module.'''
+
+    def test_share(self):
+        '''Verify that a shared assignment is equal to the original.'''
+        par = SparseTests().get_parameters_2()
+        rows = list(range(par.num_batches))
+        cols = list(range(par.num_partitions)) * int(par.num_batches / par.num_partitions)
+        data = [par.rows_per_batch - 1] * par.num_batches
+        for assignment_type in [SparseAssignment, CachedAssignment]:
+            assignment = assignment_type(par, gamma=0)
+            assignment = assignment.increment(rows, cols, data)
+            shared = SharedAssignment.share(assignment)
+            try:
+                # Unpickling attaches to the shared memory block.
+                attached = pickle.loads(pickle.dumps(shared))
+                self.assertEqual(list(attached.labels), list(assignment.labels))
+                self.assertTrue(np.array_equal(attached.batch_counts(),
+                                               assignment.batch_counts()))
+                for batches in [{0}, {1, 2, 7}, set(range(par.num_batches))]:
+                    self.assertTrue(np.array_equal(attached.batch_union(batches),
+                                                   assignment.batch_union(batches)))
+                with self.assertRaises(SharedAssignmentError):
+                    attached.increment([0], [0], [1])
+                with self.assertRaises(SharedAssignmentError):
+                    attached.unlink()
+
+                # Dropping a view closes its mapping of the block
+                shm = attached.shm
+                del attached
+                self.assertIsNone(shm.buf)
+            finally:
+                shared.unlink()
+            self.assertIsNone(shared.shm.buf)
+
+        return
+
 class CachedTests(unittest.TestCase):
     '''Tests for the cached assignment module.'''
 
@@ -175,6 +272,24 @@ class CachedTests(unittest.TestCase):
         self.assertEqual(assignment, dec_assignment)
         return
 
+    def test_apply_undo(self):
+        '''Test in-place changes to the assignment and rolling them back.'''
+        par = self.get_parameters_2()
+        assignment = CachedAssignment(par)
+        inc_assignment = assignment.increment([0, 1, 0], [0, 2, 0], [1, 2, 3])
+
+        log = assignment.apply([0, 1, 0], [0, 2, 0], [1, 2, 3])
+        self.assertEqual(assignment, inc_assignment)
+        self.assertEqual(assignment.score, inc_assignment.score)
+        self.assertEqual(assignment.bound(), inc_assignment.bound())
+
+        assignment.undo(log)
+        self.assertEqual(assignment.score, 3600)
+        self.assertEqual(assignment.bound(), 720)
+        self.assertEqual(assignment.evaluate(0, 0), 32)
+        self.assertEqual(assignment.assignment_matrix.sum(), 0)
+        return
+
     def test_index(self):
         '''Test the dynamic programming index.'''
         par = self.get_parameters_2()
@@ -190,6 +305,28 @@ class CachedTests(unittest.TestCase):
         self.assertEqual(assignment.evaluate(0, 0), 9)
         return
 
+    def test_build_index_workers(self):
+        '''Test building the index in several threads.'''
+        par = self.get_parameters_2()
+        assignment = CachedAssignment(par).increment([0, 1, 5], [0, 2, 1], [2, 1, 3])
+        parallel = CachedAssignment(par, assignment_matrix=np.array(assignment.assignment_matrix),
+                                    labels=assignment.labels, score=False, index=False)
+
+        # Split the server subsets into chunks of two to use several threads
+        chunk_size = 2 * par.q * par.num_batches
+        with unittest.mock.patch.object(assignments.cached, 'INDEX_CHUNK_SIZE', chunk_size), \
+             unittest.mock.patch.object(assignments.cached, 'ThreadPoolExecutor',
+                                        wraps=assignments.cached.ThreadPoolExecutor) as pool:
+            parallel.build_index(workers=2)
+        pool.assert_called_once_with(max_workers=2)
+
+        self.assertEqual(parallel.score, assignment.score)
+        self.assertTrue(np.array_equal(parallel.index.summary, assignment.index.summary))
+        self.assertTrue(np.array_equal(parallel.index.counts, assignment.index.counts))
+        self.assertTrue(np.array_equal(parallel.index.scores, assignment.index.scores))
+        self.assertEqual(parallel.bound(), assignment.bound())
+        return
+
     def test_bound(self):
         '''Test the dynamic programming bound.'''
         par = self.get_parameters_2()
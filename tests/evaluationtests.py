@@ -19,14 +19,24 @@
 '''
 
 import math
+import itertools
 import unittest
+import unittest.mock
 import tempfile
+import numpy as np
+import pandas as pd
 import model
+import stats
 import simulation
 from solvers.heuristicsolver import HeuristicSolver
 from solvers import randomsolver
 from evaluation import binsearch
 from evaluation import analytic
+from evaluation import executor
+
+def _add(value, offset=None):
+    '''Helper function used by the executor test.'''
+    return value + offset
 
 class EvaluationTests(unittest.TestCase):
     '''Tests for the evaluation'''
@@ -130,6 +140,156 @@ class EvaluationTests(unittest.TestCase):
         self.verify_solver(solver, [parameters], [correct])
         return
 
+    def test_vectorized(self):
+        '''Test that the vectorized delay evaluation agrees with binary
+        search.'''
+        solver = HeuristicSolver()
+        evaluator = binsearch.SampleEvaluator(num_samples=100)
+        for par in self.get_parameters_partitioning():
+            assignment = solver.solve(par)
+            orders = list(evaluator.random_completion_orders(par))
+            block = binsearch.computational_delay_block(par, assignment, orders)
+            for i, order in enumerate(orders):
+                result = binsearch.computational_delay_sample(par, assignment, order)
+                self.assertEqual(block['servers'][i], result['servers'])
+                self.assertAlmostEqual(block['delay'][i], result['delay'])
+
+        return
+
+    def test_incremental(self):
+        '''Test that the incremental delay evaluation agrees with binary
+        search.'''
+        solver = HeuristicSolver()
+        evaluator = binsearch.SampleEvaluator(num_samples=100)
+        for par in self.get_parameters_partitioning():
+            assignment = solver.solve(par)
+            batch_counts = assignment.batch_counts()
+            for order in evaluator.random_completion_orders(par):
+                result = binsearch.computational_delay_sample(par, assignment, order)
+                incremental = binsearch.computational_delay_incremental(
+                    par, assignment, order, batch_counts=batch_counts,
+                )
+                self.assertEqual(incremental, result)
+
+        return
+
+    def test_evaluation_vectorized(self):
+        '''Test the vectorized evaluation.'''
+        parameters = model.SystemParameters(rows_per_batch=5, num_servers=10, q=9, num_outputs=9,
+                                            server_storage=1/3, num_partitions=5)
+        correct = {'servers': 9, 'batches': 324, 'delay': 25.460714285714285/9,
+                   'unicast_load_1': 720/540/9, 'multicast_load_1': 840/540/9,
+                   'unicast_load_2': 0, 'multicast_load_2': 1470/540/9}
+        assignment = HeuristicSolver().solve(parameters)
+        evaluator = binsearch.SampleEvaluator(num_samples=100, method='vectorized')
+        result = evaluator.evaluate(parameters, assignment)
+        self.assertEqual(len(result), 10)
+        self.verify_result(result, correct)
+        return
+
+    def test_exact_load(self):
+        '''Test that the exact load agrees with averaging the sampled load
+        over all perspectives.'''
+        solver = HeuristicSolver()
+        for par in self.get_parameters_partitioning():
+            assignment = solver.solve(par)
+            exact = binsearch.communication_load_exact(par, assignment, chunk_size=100)
+            samples = list()
+            for subset in itertools.combinations(range(par.num_servers), par.q):
+                for server in subset:
+                    order = [x for x in subset if x != server] + [server]
+                    samples.append(binsearch.communication_load_sample(par, assignment, order))
+
+            for key, value in pd.DataFrame(samples).mean().items():
+                self.assertAlmostEqual(exact[key], value)
+
+            evaluator = binsearch.SampleEvaluator(num_samples=100)
+            result = evaluator.evaluate(par, assignment)
+            self.assertEqual(len(result), 100)
+            self.assertTrue((result['unicast_load_1'] == exact['unicast_load_1']).all())
+
+            # The load is sampled if that's cheaper
+            evaluator = binsearch.SampleEvaluator(num_samples=10)
+            self.assertFalse(evaluator.use_exact_load(par))
+
+        return
+
+    def test_streaming(self):
+        '''Test that the streaming evaluation stops once the target is
+        reached and otherwise stops at num_samples.'''
+        parameters = self.get_parameters_partitioning()
+        constant = HeuristicSolver().solve(parameters[0])
+        varying = HeuristicSolver().solve(parameters[2])
+        for method in ['binsearch', 'vectorized']:
+            evaluator = binsearch.SampleEvaluator(num_samples=400, method=method,
+                                                  target=1e-6, chunk_size=50)
+            self.assertEqual(len(evaluator.evaluate(parameters[0], constant)), 50)
+            with unittest.mock.patch.object(evaluator, 'publish',
+                                            wraps=evaluator.publish) as publish:
+                result = evaluator.evaluate(parameters[2], varying)
+            self.assertEqual(len(result), 400)
+
+            # The assignment is published once for all chunks
+            self.assertEqual(publish.call_count, 0 if method == 'vectorized' else 1)
+
+        moments = stats.RunningMoments()
+        columns = ['servers', 'delay', 'unicast_load_1']
+        for start in range(0, len(result), 64):
+            moments.update(result[columns].values[start:start+64])
+        self.assertTrue(np.allclose(moments.mean, result[columns].mean()))
+        self.assertTrue(np.allclose(moments.variance(), result[columns].var()))
+        return
+
+    def test_weighted(self):
+        '''Test that the weighted evaluation agrees with evaluating all
+        completion orders.'''
+        solver = HeuristicSolver()
+        exhaustive = binsearch.SampleEvaluator(num_samples=1000)
+        weighted = binsearch.SampleEvaluator(num_samples=1000, weighted=True)
+        for par in self.get_parameters_partitioning():
+            assignment = solver.solve(par)
+            result = weighted.evaluate(par, assignment)
+            self.assertAlmostEqual(result['weight'].sum(), 1)
+            correct = exhaustive.evaluate(par, assignment)
+            probabilities = correct['servers'].value_counts(normalize=True)
+            for servers, weight in zip(result['servers'], result['weight']):
+                self.assertAlmostEqual(weight, probabilities[servers])
+
+            flat = simulation.flatten_dataframes([result, correct])
+            for column in ['servers', 'delay', 'unicast_load_1']:
+                self.assertAlmostEqual(flat[column][0], flat[column][1])
+
+        return
+
+    def test_executor(self):
+        '''Test that published objects reach the workers.'''
+        for processes in [1, 2]:
+            pool = executor.EvaluationExecutor(processes=processes)
+            try:
+                key = pool.publish(offset=10)
+                results = pool.map(_add, range(100), key=key, chunksize=7)
+                self.assertEqual(sorted(results), list(range(10, 110)))
+                pool.release(key)
+            finally:
+                pool.close()
+
+        # Released objects are evicted from the cache of the workers
+        pool = executor.EvaluationExecutor(processes=1)
+        try:
+            first = pool.publish(offset=1)
+            second = pool.publish(offset=2)
+            self.assertEqual(executor._worker_objects(first), {'offset': 1})
+            pool.release(first)
+            self.assertEqual(executor._worker_objects(second), {'offset': 2})
+            self.assertNotIn(first, executor._worker_cache)
+            pool.release(second)
+            executor._evict_released()
+            self.assertNotIn(second, executor._worker_cache)
+        finally:
+            pool.close()
+
+        return
+
     def test_heuristic_analytic(self):
         '''Test the analytic heuristic assignment evaluation.'''
         correct_results = [{'servers': 6, 'batches': 48, 'delay': 11.3/6},
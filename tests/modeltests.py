@@ -20,6 +20,7 @@
 
 import math
 import unittest
+import numpy as np
 import model
 
 class Modeltests(unittest.TestCase):
@@ -87,3 +88,22 @@ class Modeltests(unittest.TestCase):
         self.assertAlmostEqual(load_1, 2.8888888888888897/parameters.num_outputs)
         self.assertAlmostEqual(load_2, 2.7222222222222223/parameters.num_outputs)
         return
+
+    def test_unpartitioned_load_overheads(self):
+        '''Verify that the load of an array of overheads is computed
+        correctly.'''
+        parameters = model.SystemParameters(rows_per_batch=5, num_servers=10, q=9, num_outputs=9,
+                                            server_storage=1/3, num_partitions=5)
+        overheads = np.linspace(1, 1.5, 11)
+        for design_overhead in [None, 1]:
+            loads = parameters.unpartitioned_load(
+                overhead=overheads,
+                design_overhead=design_overhead,
+            )
+            self.assertEqual(len(loads), len(overheads))
+            for overhead, load in zip(overheads, loads):
+                self.assertEqual(load, parameters.unpartitioned_load(
+                    overhead=overhead,
+                    design_overhead=design_overhead,
+                ))
+        return
@@ -76,3 +76,27 @@ class Tests(unittest.TestCase):
                 rows = overhead._rows_from_batches(p, batches)
                 self.assertLess(rows, p.num_source_rows*overh)
 
+
+    def test_servers_from_overheads(self):
+        p = get_parameters()
+        order = list(range(p.num_servers))
+        storage = overhead._batches_by_server(p.num_servers, p.muq)
+        overheads = [1, 1.25, 1.3, 1.43, 1.44]
+        servers = overhead.servers_from_overheads(p, overheads)
+        df = overhead.delay_from_overheads(p, overheads)
+        self.assertEqual(list(df['servers']), list(servers))
+        for overh, x in zip(overheads, servers):
+            self.assertEqual(overhead.delay_from_order(p, order, overh)['servers'], x)
+            batches = overhead._batches_from_order(storage, order[:x])
+            self.assertEqual(overhead.rows_from_q(p, q=x), len(batches)*p.rows_per_batch)
+        return
+
+    def test_performance_from_overhead(self):
+        p = get_parameters()
+        overheads = [1, 1.25, 1.3, 1.43, 1.44]
+        df = overhead.performance_from_overheads(overheads, parameters=p)
+        for i, overh in enumerate(overheads):
+            result = overhead.performance_from_overhead(parameters=p, overhead=overh)
+            for column in ['servers', 'delay', 'load']:
+                self.assertAlmostEqual(result[column][0], df[column][i])
+        return
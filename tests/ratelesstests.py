@@ -0,0 +1,143 @@
+'''tests of the rateless.py module'''
+
+import os
+import math
+import tempfile
+import unittest
+import unittest.mock
+import numpy as np
+import pandas as pd
+import complexity
+import rateless
+
+# columns of the simulated decoding complexity files
+ADDITION_COLUMNS = [
+    'diagonalize_decoding_additions', 'diagonalize_rowadds',
+    'solve_dense_decoding_additions', 'solve_dense_rowadds',
+    'backsolve_decoding_additions', 'backsolve_rowadds',
+]
+MULTIPLICATION_COLUMNS = [
+    'diagonalize_decoding_multiplications', 'diagonalize_rowmuls',
+    'solve_dense_decoding_multiplications', 'solve_dense_rowmuls',
+    'backsolve_decoding_multiplications', 'backsolve_rowmuls',
+]
+
+class DecodingComplexityTests(unittest.TestCase):
+    '''tests of the lt decoding complexity lookup'''
+
+    def setUp(self):
+        '''write a file with 10*n+o additions and n+2*o multiplications for
+        n inputs at an overhead of o symbols.'''
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rows = list()
+        for num_inputs in [100, 200]:
+            for overhead in [0, 10, 20]:
+                row = {'num_inputs': num_inputs, 'overhead': overhead}
+                row.update({column: 0 for column in ADDITION_COLUMNS + MULTIPLICATION_COLUMNS})
+                row['diagonalize_decoding_additions'] = 10*num_inputs + overhead
+                row['backsolve_rowmuls'] = num_inputs + 2*overhead
+                rows.append(row)
+        filename = os.path.join(self.tmpdir.name, 'LT_1e-1.csv')
+        pd.DataFrame(rows).to_csv(filename, index=False)
+        self.files = unittest.mock.patch.dict(rateless.LT_COMPLEXITY_FILES, {1e-1: filename})
+        self.files.start()
+        rateless._lt_decoding_complexity_index.cache_clear()
+        return
+
+    def tearDown(self):
+        self.files.stop()
+        rateless._lt_decoding_complexity_index.cache_clear()
+        self.tmpdir.cleanup()
+        return
+
+    def complexity(self, num_inputs, target_overhead):
+        return rateless.lt_decoding_complexity(
+            num_inputs=num_inputs,
+            failure_prob=1e-1,
+            target_overhead=target_overhead,
+        )
+
+    def test_interpolation(self):
+        '''test interpolation between overheads and numbers of inputs'''
+        a, m = complexity.ADDITION_COMPLEXITY, complexity.MULTIPLICATION_COMPLEXITY
+        self.assertAlmostEqual(self.complexity(100, 1.1), (1000+10)*a + (100+20)*m)
+        self.assertAlmostEqual(self.complexity(100, 1.05), (1000+5)*a + (100+10)*m)
+        self.assertAlmostEqual(self.complexity(150, 1.05), (1500+7.5)*a + (150+15)*m)
+        return
+
+    def test_out_of_range(self):
+        '''test that points outside of the simulations are infinitely complex'''
+        self.assertEqual(self.complexity(100, 1.5), math.inf)
+        self.assertEqual(self.complexity(50, 1.1), math.inf)
+        self.assertEqual(self.complexity(300, 1.1), math.inf)
+        self.assertEqual(self.complexity(150, 1.15), math.inf)
+        self.assertEqual(rateless.lt_decoding_complexity(
+            num_inputs=100, failure_prob=0.5, target_overhead=1.1), math.inf)
+        return
+
+    def test_complexity_constants(self):
+        '''test that changing the complexity constants after the file is
+        loaded changes the result'''
+        self.complexity(100, 1.1)
+        with unittest.mock.patch.object(complexity, 'ADDITION_COMPLEXITY', 2), \
+             unittest.mock.patch.object(complexity, 'MULTIPLICATION_COMPLEXITY', 3):
+            self.assertAlmostEqual(self.complexity(100, 1.1), 1010*2 + 120*3)
+        return
+
+class InverseCDFTests(unittest.TestCase):
+    '''tests of sampling the lt decoding overhead'''
+
+    def get_code(self):
+        return {'num_inputs': 100, 'mode': 98, 'delta': 0.9999999701976676}
+
+    def test_table(self):
+        '''test that the tabulated cdf is monotone and reaches 1'''
+        values, overheads = rateless.lt_inverse_cdf_table(**self.get_code())
+        self.assertEqual(len(values), len(overheads))
+        self.assertTrue((np.diff(values) > 0).all())
+        self.assertTrue((np.diff(overheads) > 0).all())
+        self.assertGreaterEqual(overheads[0], 1)
+        self.assertLessEqual(overheads[-1], rateless.LT_CDF_MAX_OVERHEAD)
+        self.assertGreaterEqual(values[0], 0)
+        self.assertAlmostEqual(values[-1], 1, delta=rateless.LT_CDF_TAIL)
+        with self.assertRaises(ValueError):
+            values[0] = 0
+        return
+
+    def test_samples(self):
+        '''test that seeded samples are reproducible'''
+        first = rateless.lt_success_samples(
+            1000, target_overhead=1.1, rng=np.random.default_rng(1), **self.get_code())
+        second = rateless.lt_success_samples(
+            1000, target_overhead=1.1, rng=np.random.default_rng(1), **self.get_code())
+        self.assertTrue(np.array_equal(first, second))
+        self.assertTrue((first >= 1.1).all())
+        _, overheads = rateless.lt_inverse_cdf_table(**self.get_code())
+        self.assertTrue((first <= max(overheads[-1], 1.1)).all())
+        return
+
+class ParameterCacheTests(unittest.TestCase):
+    '''tests of the lt code parameter cache'''
+
+    def test_cache(self):
+        '''test that optimized parameters are loaded from the disk cache'''
+        default = rateless.LT_PARAMETER_CACHE_DIRECTORY
+        kwargs = {'num_inputs': 100, 'target_overhead': 1.3, 'target_failure_probability': 1e-1}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rateless.set_lt_parameter_cache_directory(tmpdir)
+            try:
+                with unittest.mock.patch.object(
+                        rateless.pyrateless, 'heuristic',
+                        wraps=rateless.pyrateless.heuristic) as heuristic:
+                    first = rateless.optimize_lt_parameters(**kwargs)
+
+                    # forget the parameters kept in memory
+                    rateless._optimize_lt_parameters.cache_clear()
+                    second = rateless.optimize_lt_parameters(**kwargs)
+                    self.assertEqual(first, second)
+                    self.assertEqual(heuristic.call_count, 1)
+                self.assertTrue(os.listdir(tmpdir))
+            finally:
+                rateless._lt_parameter_cache(tmpdir).close()
+                rateless.set_lt_parameter_cache_directory(default)
+        return
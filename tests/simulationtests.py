@@ -23,13 +23,19 @@ import math
 import unittest
 import tempfile
 import pandas as pd
+import results
 import simulation
+import evaluation.executor
 
 from functools import partial
 from model import SystemParameters
 from solvers.heuristicsolver import HeuristicSolver
 from evaluation.binsearch import SampleEvaluator
 
+def _add(value, offset=None):
+    '''Helper function used by the sweep tests.'''
+    return value + offset
+
 class EvaluationTests(unittest.TestCase):
     '''Tests of the simulation module.'''
 
@@ -117,3 +123,118 @@ class EvaluationTests(unittest.TestCase):
             self.verify_result(dataframe, correct)
 
         return
+
+class ResultsStoreTests(unittest.TestCase):
+    '''Tests of the results store.'''
+
+    def test_store(self):
+        '''Test appending, loading and merging results.'''
+        first = pd.DataFrame({'delay': [1.0, 2.0], 'servers': [3, 4]})
+        second = pd.DataFrame({'delay': [5.0], 'servers': [6]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = results.ResultsStore(tmpdir)
+            self.assertIsNone(store.load('first'))
+            store.append('first', first)
+            store.append('second', first)
+            store.append('second', second)
+
+            # a new store finds the results on disk
+            store = results.ResultsStore(tmpdir)
+            self.assertTrue(store.contains('first'))
+            pd.testing.assert_frame_equal(store.load('first'), first)
+            pd.testing.assert_frame_equal(store.load('second'), second)
+            pd.testing.assert_frame_equal(
+                store.load('first', columns=['delay']),
+                first[['delay']],
+            )
+
+            store.merge()
+            self.assertEqual(len(os.listdir(store.path)), 1)
+            loaded = results.ResultsStore(tmpdir).load_many(['first', 'second', 'third'])
+            self.assertEqual(set(loaded), {'first', 'second'})
+            pd.testing.assert_frame_equal(loaded['first'], first)
+            pd.testing.assert_frame_equal(loaded['second'], second)
+
+    def test_cache(self):
+        '''Test that the results kept in memory are bounded.'''
+        dataframe = pd.DataFrame({'delay': [1.0, 2.0], 'servers': [3, 4]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = results.ResultsStore(tmpdir)
+            identifiers = [str(i) for i in range(results.CACHE_SIZE + 2)]
+            for identifier in identifiers:
+                store.append(identifier, dataframe)
+            self.assertEqual(len(store._cache), results.CACHE_SIZE)
+            self.assertNotIn(identifiers[0], store._cache)
+
+            # evicted results are read from disk and cached again
+            pd.testing.assert_frame_equal(store.load(identifiers[0]), dataframe)
+            self.assertEqual(next(reversed(store._cache)), identifiers[0])
+            self.assertEqual(len(store._cache), results.CACHE_SIZE)
+
+    def test_legacy(self):
+        '''Test importing results stored in a CSV file.'''
+        dataframe = pd.DataFrame({'delay': [1.0, 2.0], 'servers': [3, 4]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dataframe.to_csv(os.path.join(tmpdir, 'legacy.csv'))
+            store = results.ResultsStore(tmpdir)
+            pd.testing.assert_frame_equal(store.load('legacy'), dataframe)
+            os.remove(os.path.join(tmpdir, 'legacy.csv'))
+            store = results.ResultsStore(tmpdir)
+            pd.testing.assert_frame_equal(store.load('legacy'), dataframe)
+
+class SweepTests(unittest.TestCase):
+    '''Tests of parameter sweeps.'''
+
+    def test_sweep(self):
+        '''Test that a sweep run in several processes returns the results in
+        order and stores them.'''
+        parameter_list = [
+            SystemParameters(rows_per_batch=5, num_servers=6, q=4, num_outputs=4,
+                             server_storage=1/2, num_partitions=5),
+            SystemParameters(rows_per_batch=5, num_servers=10, q=9, num_outputs=9,
+                             server_storage=1/3, num_partitions=5),
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            simulate_fun = partial(
+                simulation.simulate,
+                directory=tmpdir,
+                samples=1,
+                solver=HeuristicSolver(),
+                assignment_eval=SampleEvaluator(num_samples=10),
+            )
+            dataframes = simulation.run_sweep(simulate_fun, parameter_list, processes=2)
+            for parameters, dataframe in zip(parameter_list, dataframes):
+                self.assertEqual(dataframe['num_servers'].mean(), parameters.num_servers)
+
+            store = results.ResultsStore(tmpdir)
+            for parameters in parameter_list:
+                self.assertTrue(store.contains(parameters.identifier()))
+
+    def test_sweep_after_pooled_evaluation(self):
+        '''Test that sweep workers don't close the evaluation executor they
+        inherit from the parent.'''
+        parameters = SystemParameters(rows_per_batch=5, num_servers=6, q=4, num_outputs=4,
+                                      server_storage=1/2, num_partitions=5)
+        pool = evaluation.executor.configure(processes=2)
+        try:
+            key = pool.publish(offset=10)
+            self.assertEqual(sorted(pool.map(_add, range(10), key=key)), list(range(10, 20)))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                simulate_fun = partial(
+                    simulation.simulate,
+                    directory=tmpdir,
+                    samples=1,
+                    solver=HeuristicSolver(),
+                    assignment_eval=SampleEvaluator(num_samples=10),
+                )
+                dataframes = simulation.run_sweep(simulate_fun, [parameters] * 2, processes=2)
+                for dataframe in dataframes:
+                    self.assertEqual(dataframe['num_servers'].mean(), parameters.num_servers)
+
+            # The pool and published objects of the parent are still usable
+            self.assertTrue(os.path.isfile(key))
+            self.assertEqual(sorted(pool.map(_add, range(10), key=key)), list(range(10, 20)))
+            pool.release(key)
+        finally:
+            evaluation.executor.configure()
+        return
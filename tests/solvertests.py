@@ -19,9 +19,11 @@
 '''
 
 import math
+import time
 import unittest
 import tempfile
 import logging
+import numpy as np
 import model
 import plot
 from solvers import heuristicsolver
@@ -43,6 +45,22 @@ class HybridSolverTests(unittest.TestCase):
         self.assertTrue(assignment.is_valid())
         return
 
+    def test_portfolio(self):
+        '''Test the hybrid solver with parallel improvement chains.'''
+        parameters = self.get_parameters()
+        initialsolver = heuristicsolver.HeuristicSolver()
+        initial = initialsolver.solve(parameters, assignment_type=CachedAssignment)
+        solver = HybridSolver(initialsolver=[initialsolver, RandomSolver()],
+                              chains=2, seed=0, time_budget=60)
+        assignment = solver.solve(parameters)
+        self.assertTrue(assignment.is_valid())
+        self.assertLessEqual(assignment.score, initial.score)
+
+        # Statistics of the searches are returned by the workers
+        statistics = solver.statistics
+        self.assertGreater(statistics['expanded'] + statistics['pruned'], 0)
+        return
+
     def test_deassign_branch_and_bound(self):
         '''Test the solver de-assignment and branch-and-bound.'''
         initialsolver = RandomSolver()
@@ -68,6 +86,39 @@ class HybridSolverTests(unittest.TestCase):
         self.assertLessEqual(bb_assignment.score, assignment.score)
         return
 
+    def test_branch_and_bound_budget(self):
+        '''Test that the branch-and-bound search respects its node budget.'''
+        initialsolver = RandomSolver(seed=0)
+        parameters = self.get_parameters()
+        assignment = initialsolver.solve(parameters, assignment_type=CachedAssignment)
+        assignment = CachedAssignment(parameters, gamma=assignment.gamma,
+                                      assignment_matrix=assignment.assignment_matrix,
+                                      labels=assignment.labels)
+        for node_budget in [None, 1]:
+            hybrid = HybridSolver(initialsolver=initialsolver, clear=5, seed=0,
+                                  node_budget=node_budget)
+            partition_count = [0] * parameters.num_partitions
+            new_assignment = hybrid.deassign(parameters, assignment, partition_count, 5)
+            matrix = new_assignment.assignment_matrix.copy()
+            bb_assignment = hybrid.branch_and_bound(parameters, new_assignment,
+                                                    partition_count, assignment)
+            self.assertTrue(bb_assignment.is_valid())
+            self.assertLessEqual(bb_assignment.score, assignment.score)
+            self.assertTrue((new_assignment.assignment_matrix == matrix).all())
+            self.assertLessEqual(hybrid.statistics['depth'], 5)
+            if node_budget:
+                self.assertLessEqual(hybrid.statistics['expanded'], node_budget)
+
+        # The search stops at the deadline of the solver
+        partition_count = [0] * parameters.num_partitions
+        new_assignment = hybrid.deassign(parameters, assignment, partition_count, 5)
+        bb_assignment = hybrid.branch_and_bound(parameters, new_assignment, partition_count,
+                                                assignment, deadline=time.time())
+        self.assertIs(bb_assignment, assignment)
+        self.assertEqual(hybrid.statistics['expanded'], 0)
+        self.assertTrue(hybrid.statistics['exhausted'])
+        return
+
     def get_parameters(self):
         '''Get some test parameters.'''
         return model.SystemParameters(6, # Rows per batch
@@ -109,6 +160,12 @@ class SolverTests(unittest.TestCase):
             assignment = solver.solve(par, assignment_type=CachedAssignment)
             self.assertTrue(assignment.is_valid())
 
+        # Seeded solvers are reproducible
+        par = self.get_parameters_partitioning()[1]
+        first = RandomSolver(seed=0).solve(par).batch_counts()
+        second = RandomSolver(seed=0).solve(par).batch_counts()
+        self.assertTrue(np.array_equal(first, second))
+        self.assertTrue((first.sum(axis=1) == par.rows_per_batch).all())
         return
 
     def get_parameters_partitioning(self):
@@ -0,0 +1,103 @@
+'''tests of the stats.py module'''
+
+import unittest
+import numpy as np
+import pandas as pd
+import model
+import stats
+import simulation
+
+class OrderStatisticTests(unittest.TestCase):
+    '''tests of the shifted exponential order statistics'''
+
+    def test_harmonic_sum(self):
+        '''test that array input gives the scalar results elementwise'''
+        total, order = np.meshgrid(np.arange(1, 40), np.arange(0, 40))
+        valid = order <= total
+        total, order = total[valid], order[valid]
+        for power in [1, 2]:
+            sums = stats.harmonic_sum(total, order, power=power)
+            self.assertEqual(sums.shape, total.shape)
+            for t, o, value in zip(total, order, sums):
+                correct = sum(1 / i**power for i in range(t-o+1, t+1))
+                self.assertAlmostEqual(value, correct)
+                self.assertAlmostEqual(stats.harmonic_sum(int(t), int(o), power=power), correct)
+
+        with self.assertRaises(ValueError):
+            stats.harmonic_sum(np.array([5, 5]), np.array([3, 6]))
+        return
+
+    def test_vectorized(self):
+        '''test that the vectorized order statistic functions give the scalar
+        results elementwise'''
+        total = 9
+        orders = np.arange(1, total+1)
+        parameters = np.array([0.5, 1, 2])
+        means = stats.order_mean_shiftexp(total, orders[:, None], parameter=parameters)
+        variances = stats.order_variance_shiftexp(total, orders[:, None], parameters)
+        values = np.linspace(0, 10, 7)
+        cdf = stats.order_cdf_shiftexp(values[:, None], total=total, order=orders, parameter=2)
+        for i, order in enumerate(orders):
+            for j, parameter in enumerate(parameters):
+                self.assertAlmostEqual(means[i, j], stats.order_mean_shiftexp(
+                    total, int(order), parameter=parameter))
+                self.assertAlmostEqual(variances[i, j], stats.order_variance_shiftexp(
+                    total, int(order), parameter))
+            for k, value in enumerate(values):
+                self.assertAlmostEqual(cdf[k, i], stats.order_cdf_shiftexp(
+                    value, total=total, order=int(order), parameter=2))
+        return
+
+    def test_exact_samples(self):
+        '''test that exact samples are reproducible and have the right
+        moments'''
+        total, parameter, n = 9, 2, 200000
+        first = stats.order_samples_shiftexp(total, 6, parameter=parameter, n=n,
+                                             rng=np.random.default_rng(1))
+        second = stats.order_samples_shiftexp(total, 6, parameter=parameter, n=n,
+                                              rng=np.random.default_rng(1))
+        self.assertTrue(np.array_equal(first, second))
+
+        # one order per sample
+        orders = np.arange(n) % (total + 1)
+        samples = stats.order_samples_shiftexp(total, orders, parameter=parameter, n=n,
+                                               rng=np.random.default_rng(2))
+        for order in range(total + 1):
+            selected = samples[orders == order]
+            mean = stats.order_mean_shiftexp(total, order, parameter=parameter)
+            variance = stats.order_variance_shiftexp(total, order, parameter)
+            self.assertAlmostEqual(selected.mean(), mean,
+                                   delta=5*np.sqrt(variance/len(selected))+1e-12)
+            self.assertAlmostEqual(selected.var(), variance, delta=0.05*variance+1e-12)
+
+        variable = stats.ShiftexpOrder(parameter=parameter, total=total, order=6)
+        first = variable.sample(n=n, method='exact', rng=np.random.default_rng(3))
+        second = variable.sample(n=n, method='exact', rng=np.random.default_rng(3))
+        self.assertTrue(np.array_equal(first, second))
+        self.assertAlmostEqual(first.mean(), variable.mean(),
+                               delta=5*np.sqrt(variable.variance()/n))
+        return
+
+    def test_exact_delay_samples(self):
+        '''test that the exact delay samples are reproducible and agree with
+        the gamma approximation in mean'''
+        parameters = model.SystemParameters(rows_per_batch=5, num_servers=6, q=4,
+                                            num_outputs=4, server_storage=1/2,
+                                            num_partitions=5)
+        dataframe = pd.DataFrame({'servers': [4, 5], 'weight': [0.75, 0.25]})
+        kwargs = {
+            'num_samples': 100000,
+            'parameters': parameters,
+            'map_complexity_fun': lambda p: 1,
+            'encode_complexity_fun': lambda p: 2,
+            'reduce_complexity_fun': lambda p: 3,
+        }
+        first = simulation.delay_samples(dataframe, method='exact',
+                                         rng=np.random.default_rng(1), **kwargs)
+        second = simulation.delay_samples(dataframe, method='exact',
+                                          rng=np.random.default_rng(1), **kwargs)
+        self.assertTrue(np.array_equal(first, second))
+        gamma = simulation.delay_samples(dataframe, method='gamma',
+                                         rng=np.random.default_rng(1), **kwargs)
+        self.assertAlmostEqual(first.mean(), gamma.mean(), delta=0.01*gamma.mean())
+        return